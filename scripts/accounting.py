@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Slurm job accounting and resource right-sizing for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import re
+import json
+import math
+import sqlite3
+from time import time
+from pathlib import Path
+from subprocess import Popen, PIPE
+
+from .config import get_state_dir
+from .utils import esc_colors
+
+
+ACCT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    out_to TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    state TEXT,
+    elapsed REAL,
+    alloc_cpus INTEGER,
+    total_cpu REAL,
+    req_mem REAL,
+    max_rss REAL,
+    timelimit REAL,
+    collected REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_rule ON jobs (rule);
+"""
+SACCT_FIELDS = ('JobID', 'JobName', 'State', 'ElapsedRaw', 'AllocCPUS', 'TotalCPU', 'ReqMem', 'MaxRSS', 'Timelimit')
+# sacct is looked up on the PATH unless overridden, e.g. with a script replaying recorded output
+SACCT = os.environ.get('WEAVE_SACCT', 'sacct')
+SACCT_BATCH = 500
+MASTER_RULE = 'masterjob'
+MASTER_LOG = re.compile(r'weave_masterjob_(\d+)\.(?:out|err)$')
+RULE_LINE = re.compile(r'^(?:local)?(?:rule|checkpoint) (\S+):')
+JOBID_LINE = re.compile(r'^\s+jobid: (\d+)')
+SUBMIT_LINE = re.compile(r"Submitted (?:group )?job (\S+) with external jobid '\D*(\d+)")
+# right-sizing: percentile of observed usage and the headroom added on top of it
+PERCENTILE = 95
+MEM_HEADROOM = 1.2
+TIME_HEADROOM = 1.5
+MEM_UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+
+def sacct_seconds(value):
+    """Seconds of a sacct duration, `[DD-][HH:]MM:SS[.mmm]`, None for unlimited or empty values"""
+    value = value.strip()
+    if not value or value in ('UNLIMITED', 'Partition_Limit', 'INVALID'):
+        return None
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+    parts = [float(p) for p in value.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return int(days) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def sacct_mem_mb(value, cpus=1):
+    """Megabytes of a sacct memory value (`16G`, `4000Mc`, `123456K`), per-cpu requests are scaled
+    to the whole allocation"""
+    match = re.match(r'^([\d.]+)([KMGT]?)([cn]?)$', value.strip())
+    if not match:
+        return None
+    mb = float(match.group(1)) * MEM_UNITS[match.group(2) or 'M']
+    if match.group(3) == 'c':
+        mb *= cpus or 1
+    return mb
+
+
+def percentile(values, pct=PERCENTILE):
+    """Nearest rank percentile"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def parse_master_logs(out_to):
+    """Map the slurm job ids of a run to rule names from the master job logs.
+
+    Master job logs are named after the master job id, the snakemake output they hold names every
+    submitted rule instance and the external (slurm) job id it was submitted as.
+
+    Returns:
+        (dict): slurm job id to rule name, master job ids map to `MASTER_RULE`
+    """
+    log_dirs = [Path(out_to, 'logs', 'masterjob'), Path(out_to, '.snakemake', 'log')]
+    jobs = {}
+    for log_dir in log_dirs:
+        if not log_dir.exists():
+            continue
+        for log_file in sorted(log_dir.iterdir(), key=lambda p: p.stat().st_mtime):
+            master = MASTER_LOG.search(log_file.name)
+            if master:
+                jobs[master.group(1)] = MASTER_RULE
+            # snakemake job ids are only unique within one invocation, resolve them as they are read
+            rules, this_rule = {}, None
+            with open(log_file, errors='replace') as fh:
+                for line in fh:
+                    rule_match = RULE_LINE.match(line)
+                    if rule_match:
+                        this_rule = rule_match.group(1)
+                        continue
+                    jobid_match = JOBID_LINE.match(line)
+                    if jobid_match and this_rule:
+                        rules[jobid_match.group(1)] = this_rule
+                        this_rule = None
+                        continue
+                    submit_match = SUBMIT_LINE.search(line)
+                    if submit_match and submit_match.group(1) in rules:
+                        jobs[submit_match.group(2)] = rules[submit_match.group(1)]
+    return jobs
+
+
+def query_sacct(jobids):
+    """Query slurm accounting for `jobids`, job steps are folded into their job.
+
+    Returns:
+        (dict): slurm job id to a record of the job's accounting fields
+    """
+    records = {}
+    jobids = list(jobids)
+    for start in range(0, len(jobids), SACCT_BATCH):
+        cmd = [SACCT, '-P', '-n', '--format=' + ','.join(SACCT_FIELDS), '-j', ','.join(jobids[start:start + SACCT_BATCH])]
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise ValueError(f"sacct failed: {err.decode('utf-8', errors='replace').strip()}")
+        for line in out.decode('utf-8', errors='replace').splitlines():
+            fields = line.split('|')
+            if len(fields) < len(SACCT_FIELDS):
+                continue
+            row = dict(zip(SACCT_FIELDS, fields))
+            jobid, _, step = row['JobID'].partition('.')
+            record = records.setdefault(jobid, dict(jobid=jobid, max_rss=None))
+            rss = sacct_mem_mb(row['MaxRSS']) if row['MaxRSS'] else None
+            if rss is not None:
+                record['max_rss'] = max(record['max_rss'] or 0, rss)
+            if step:
+                continue
+            cpus = int(row['AllocCPUS']) if row['AllocCPUS'].isdigit() else None
+            record.update(
+                name=row['JobName'], state=row['State'].split(' ')[0],
+                elapsed=float(row['ElapsedRaw']) if row['ElapsedRaw'].isdigit() else sacct_seconds(row['ElapsedRaw']),
+                alloc_cpus=cpus, total_cpu=sacct_seconds(row['TotalCPU']),
+                req_mem=sacct_mem_mb(row['ReqMem'], cpus), timelimit=sacct_seconds(row['Timelimit']),
+            )
+    return {jobid: record for jobid, record in records.items() if 'state' in record}
+
+
+class JobHistory():
+    """History of the slurm accounting records of weave runs, stored in the weave state directory"""
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = Path(get_state_dir(), 'accounting.sqlite')
+        self.db = sqlite3.connect(str(db_path), timeout=60)
+        self.db.executescript(ACCT_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def collect(self, out_to):
+        """Collect the accounting records of the master job and every child job of the run in `out_to`
+
+        Returns:
+            (int): number of job records stored
+        """
+        out_to = Path(out_to).absolute()
+        jobs = parse_master_logs(out_to)
+        if not jobs:
+            return 0
+        records = query_sacct(jobs)
+        now = time()
+        with self.db:
+            for jobid, record in records.items():
+                rule = jobs.get(jobid) or record['name']
+                self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (jobid, out_to.name, str(out_to), rule, record['state'], record['elapsed'],
+                                 record['alloc_cpus'], record['total_cpu'], record['req_mem'], record['max_rss'],
+                                 record['timelimit'], now))
+        return len(records)
+
+    def efficiency(self, rules=None):
+        """CPU and memory efficiency of completed jobs, per rule.
+
+        Returns:
+            (dict): rule to summary of its jobs' requested and used resources
+        """
+        query = 'SELECT rule, elapsed, alloc_cpus, total_cpu, req_mem, max_rss, timelimit FROM jobs ' + \
+                "WHERE state = 'COMPLETED' AND elapsed > 0"
+        summary = {}
+        for rule, elapsed, cpus, total_cpu, req_mem, max_rss, timelimit in self.db.execute(query):
+            if rules and rule not in rules:
+                continue
+            this_rule = summary.setdefault(rule, dict(jobs=0, cpu_eff=[], mem_eff=[], cpus_used=[],
+                                                      rss=[], elapsed=[], req_cpus=[], req_mem=[], timelimit=[]))
+            this_rule['jobs'] += 1
+            this_rule['elapsed'].append(elapsed)
+            if cpus and total_cpu is not None:
+                this_rule['cpu_eff'].append(total_cpu / (elapsed * cpus))
+                this_rule['cpus_used'].append(total_cpu / elapsed)
+                this_rule['req_cpus'].append(cpus)
+            if max_rss is not None:
+                this_rule['rss'].append(max_rss)
+                if req_mem:
+                    this_rule['mem_eff'].append(max_rss / req_mem)
+                    this_rule['req_mem'].append(req_mem)
+            if timelimit:
+                this_rule['timelimit'].append(timelimit)
+        return summary
+
+    def recommend(self, rules=None):
+        """Recommend rule resources from the history, the `PERCENTILE` of observed usage plus headroom.
+
+        Returns:
+            (dict): rule to recommended `threads`, `mem_mb` and `runtime` (minutes) along with the
+                median efficiencies and the resources currently requested
+        """
+        recommendations = {}
+        for rule, this_rule in sorted(self.efficiency(rules).items()):
+            rss, cpus_used = percentile(this_rule['rss']), percentile(this_rule['cpus_used'])
+            recommendations[rule] = dict(
+                jobs=this_rule['jobs'],
+                cpu_eff=percentile(this_rule['cpu_eff'], 50),
+                mem_eff=percentile(this_rule['mem_eff'], 50),
+                requested=dict(threads=max(this_rule['req_cpus'], default=None),
+                               mem_mb=max(this_rule['req_mem'], default=None),
+                               runtime=max(this_rule['timelimit'], default=0) / 60 or None),
+                threads=max(1, math.ceil(cpus_used)) if cpus_used is not None else None,
+                mem_mb=int(math.ceil(rss * MEM_HEADROOM / 1024) * 1024) if rss is not None else None,
+                runtime=max(1, math.ceil(percentile(this_rule['elapsed']) * TIME_HEADROOM / 60)),
+            )
+        return recommendations
+
+
+def fmt_pct(value):
+    return f"{value * 100:.0f}%" if value is not None else '-'
+
+
+def fmt_num(value):
+    return f"{value:.0f}" if value is not None else '-'
+
+
+def print_report(recommendations):
+    header = ('rule', 'jobs', 'cpu eff', 'mem eff', 'threads', 'mem_mb', 'runtime (min)')
+    rows = [header]
+    for rule, rec in recommendations.items():
+        req = rec['requested']
+        rows.append((rule, str(rec['jobs']), fmt_pct(rec['cpu_eff']), fmt_pct(rec['mem_eff']),
+                     f"{fmt_num(req['threads'])} -> {fmt_num(rec['threads'])}",
+                     f"{fmt_num(req['mem_mb'])} -> {fmt_num(rec['mem_mb'])}",
+                     f"{fmt_num(req['runtime'])} -> {fmt_num(rec['runtime'])}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for i, row in enumerate(rows):
+        line = '  '.join(col.ljust(width) for col, width in zip(row, widths))
+        print(f"{esc_colors.BOLD}{line}{esc_colors.ENDC}" if i == 0 else line)
+
+
+def account(out_dirs, collect=True, rules=None, profile_out=None):
+    """Collect accounting records for the runs in `out_dirs` and report rule efficiencies and
+    recommended resources from the whole job history
+
+    Returns:
+        (bool): True if accounting could be collected for every run
+    """
+    success = True
+    with JobHistory() as history:
+        if collect:
+            for out_to in out_dirs:
+                try:
+                    n_jobs = history.collect(out_to)
+                except (ValueError, OSError) as error:
+                    print(f"{esc_colors.FAIL}{out_to}: {error}{esc_colors.ENDC}")
+                    success = False
+                    continue
+                print(f"{esc_colors.OKGREEN}> {esc_colors.ENDC}Collected {n_jobs} job records for {Path(out_to).name}")
+        recommendations = history.recommend(rules)
+
+    if not recommendations:
+        print(f"{esc_colors.WARNING}No completed jobs in the accounting history{esc_colors.ENDC}")
+        return success
+    print_report(recommendations)
+    if profile_out:
+        profile = {rule: {k: rec[k] for k in ('threads', 'mem_mb', 'runtime')}
+                   for rule, rec in recommendations.items() if rule != MASTER_RULE}
+        with open(profile_out, 'w') as fh:
+            json.dump(profile, fh, indent=4)
+        print(f"{esc_colors.OKGREEN}> {esc_colors.ENDC}Recommended rule resources written to {profile_out}")
+    return success
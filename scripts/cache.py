@@ -4,35 +4,70 @@
 #   Miscellaneous utility functions for caching 
 #   pipeline resources
 # ~~~~~~~~~~~~~~~
+import os
 import subprocess
 import json
+import urllib.error
 import urllib.request
 from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import Lock
+from time import time
 from urllib.parse import urlparse
 
 from .config import remote_resource_confg
-from .utils import esc_colors
+from .images import ImageStore
+from .utils import esc_colors, write_prefixed, mk_sbatch_script, submit_sbatch
 
 
-parse_uri = lambda uri: (str(uri).split('://')[0], str(uri).split('://')[1]) if '://' in uri else None
-info_download = lambda msg: print(esc_colors.OKGREEN + msg + esc_colors.ENDC)
+parse_uri = lambda uri: tuple(str(uri).split('://', 1)) if '://' in uri else None
+info_download = lambda msg: write_prefixed(esc_colors.OKGREEN + msg + esc_colors.ENDC + '\n')
+CHUNK_SIZE = 4 * 1024 * 1024
+TARBALL_SUFFIXES = ('.tar.gz', '.tgz', '.tar', '.tar.bz2')
 
 
-class DownloadProgressBar():
-    def __init__(self):
-        self.pbar = None
+# ~~~ slurm array resource hints per class of resource ~~~
+TASK_RESOURCES = {
+    'tarball': {'cpus-per-task': 2, 'mem': '16g', 'time': '1-00:00:00'},
+    'container': {'cpus-per-task': 4, 'mem': '16g', 'tmp': '50g', 'time': '06:00:00'},
+    'file': {'cpus-per-task': 1, 'mem': '4g', 'time': '06:00:00'},
+}
+GATHER_RESOURCES = {'cpus-per-task': 1, 'mem': '2g', 'time': '01:00:00'}
 
-    def __call__(self, block_num, block_size, total_size):
-        if not self.pbar:
-            self.pbar=progressbar.ProgressBar(maxval=total_size)
-            self.pbar.start()
 
-        downloaded = block_num * block_size
-        if downloaded < total_size:
-            self.pbar.update(downloaded)
-        else:
-            self.pbar.finish()
+class DownloadProgress():
+    """Progress aggregated across all download workers, reported at most once every `interval` seconds"""
+    def __init__(self, n_tasks, interval=10):
+        self.lock = Lock()
+        self.n_tasks = n_tasks
+        self.n_done = 0
+        self.expected = 0
+        self.received = 0
+        self.interval = interval
+        self.last_report = 0
+
+    def expect(self, nbytes):
+        with self.lock:
+            self.expected += nbytes
+
+    def update(self, nbytes):
+        with self.lock:
+            self.received += nbytes
+            if time() - self.last_report < self.interval:
+                return
+            self.last_report = time()
+        self.report()
+
+    def done(self):
+        with self.lock:
+            self.n_done += 1
+        self.report()
+
+    def report(self):
+        gb = lambda nbytes: f"{nbytes / 1024**3:.2f}"
+        total = f" of {gb(self.expected)}" if self.expected else ""
+        write_prefixed(f"\t{gb(self.received)}{total} GB downloaded, {self.n_done}/{self.n_tasks} resources complete\n")
 
 
 def valid_dir(path):
@@ -56,51 +91,227 @@ def valid_dir(path):
     
 
 
-def download(output_dir, local=False):
-    """Download the resource bundle for 
+def download(output_dir, local=False, jobs=4):
+    """Download the resource bundle for the pipeline with a bounded pool of concurrent
+    workers, web resources are resumed from partial downloads and all resources are
+    written atomically.
 
     Returns:
         (bool): True if successful, False otherwise.
     """
-    print(esc_colors.WARNING + 'Warning: cache download only implemented in serial local mode currently' + esc_colors.ENDC)
-    #TODO: slurm implementation
     resources_to_download = json.loads(open(remote_resource_confg).read())
+    tasks = resource_tasks(output_dir, resources_to_download)
+    if not local:
+        return submit_download_array(output_dir, tasks)
+    progress = DownloadProgress(len(tasks))
 
-    for resource, uri in resources_to_download.items():
-        protocol, url = parse_uri(uri)
-        handle_download(output_dir, resource, protocol, url)
+    def _download(task):
+        try:
+            handle_download(*task, progress=progress)
+        except Exception as error:
+            write_prefixed(f"{esc_colors.FAIL}Failed to get resource {task[1]}: {error}{esc_colors.ENDC}\n")
+            return False
+        progress.done()
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(_download, tasks))
+
+    if not all(results):
+        print(esc_colors.FAIL + f'{results.count(False)} of {len(results)} resources failed to download!' + esc_colors.ENDC)
+        return False
 
     print(esc_colors.OKGREEN + 'All resources downloaded!' + esc_colors.ENDC)
 
     return True
 
 
-def handle_download(output_dir, resource, protocol, url):
+def task_class(task):
+    _, _, protocol, url = task
+    if protocol == 'docker':
+        return 'container'
+    if Path(urlparse(protocol + '://' + url).path).name.endswith(TARBALL_SUFFIXES):
+        return 'tarball'
+    return 'file'
+
+
+def task_output(output_dir, resource, protocol, url):
+    """Path of the file a download task produces"""
+    if protocol == 'docker':
+        docker_name, docker_v = url.split('/')[-1].split(':')
+        return Path(output_dir, f"{docker_name}_{docker_v}.sif")
+    return Path(output_dir, Path(urlparse(protocol + '://' + url).path).name)
+
+
+def submit_download_array(output_dir, tasks):
+    """Submit the download tasks as slurm job arrays, one array per class of resource so each 
+    task gets resource hints for its class, followed by a gather job that verifies every 
+    resource once all arrays have finished.
+
+    Returns:
+        (bool): True if all jobs were submitted, False otherwise.
+    """
+    job_dir = Path(output_dir, '.cache_jobs')
+    job_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    weave_exec = Path(Path(__file__).parent.parent, 'weave').resolve()
+
+    classes = {}
+    for task in tasks:
+        classes.setdefault(task_class(task), []).append(task)
+
+    array_jids = []
+    for this_class, class_tasks in classes.items():
+        manifest = Path(job_dir, f'{this_class}_tasks.json')
+        json.dump(class_tasks, open(manifest, 'w'), indent=4)
+        sbatch_opts = dict(TASK_RESOURCES[this_class], array=f'0-{len(class_tasks) - 1}')
+        jobscript = mk_sbatch_script(output_dir, f"{weave_exec} cache {output_dir} --array-task {manifest}", 
+                                     job_name=f'weave_cache_{this_class}', log_dir='cache', 
+                                     script_name=f'{this_class}_jobscript.sh', sbatch_opts=sbatch_opts)
+        submitted, jid, sbatch_out = submit_sbatch(jobscript, cwd=output_dir)
+        if not submitted or not jid:
+            print(esc_colors.FAIL + f'Failed to submit {this_class} download array:\n' + sbatch_out + esc_colors.ENDC)
+            return False
+        info_download(f"Submitted {len(class_tasks)} {this_class} download(s) as array job {jid}")
+        array_jids.append(jid)
+
+    manifest = Path(job_dir, 'all_tasks.json')
+    json.dump(tasks, open(manifest, 'w'), indent=4)
+    jobscript = mk_sbatch_script(output_dir, f"{weave_exec} cache {output_dir} --verify {manifest}", 
+                                 job_name='weave_cache_gather', log_dir='cache', 
+                                 script_name='gather_jobscript.sh', sbatch_opts=GATHER_RESOURCES)
+    submitted, jid, sbatch_out = submit_sbatch(jobscript, cwd=output_dir, dependency='afterany:' + ':'.join(array_jids))
+    if not submitted or not jid:
+        print(esc_colors.FAIL + 'Failed to submit cache verification job:\n' + sbatch_out + esc_colors.ENDC)
+        return False
+    info_download(f"Submitted cache verification job {jid}, logs in {Path(output_dir, 'logs', 'cache')}")
+    return True
+
+
+def run_array_task(manifest, task_id=None):
+    """Execute the download task of a manifest for this slurm array task"""
+    task_id = int(task_id if task_id is not None else os.environ['SLURM_ARRAY_TASK_ID'])
+    task = json.load(open(manifest))[task_id]
+    handle_download(*task)
+    return True
+
+
+def verify(manifest):
+    """Verify every resource of a download manifest exists and is not empty
+
+    Returns:
+        (bool): True if all resources are present, False otherwise.
+    """
+    missing = []
+    for task in json.load(open(manifest)):
+        this_output = task_output(*task)
+        if not this_output.exists() or this_output.stat().st_size == 0:
+            missing.append(f"{task[1]}: {this_output}")
+    if missing:
+        print(esc_colors.FAIL + f'{len(missing)} resource(s) missing from cache:\n\t' + '\n\t'.join(missing) + esc_colors.ENDC)
+        return False
+    print(esc_colors.OKGREEN + 'All resources verified!' + esc_colors.ENDC)
+    return True
+
+
+def read_filelist(url):
+    """Return the resource uris listed in a remote file list"""
+    with urllib.request.urlopen('https://' + url if '://' not in url else url) as fl:
+        lines = fl.read().decode('utf-8').splitlines()
+    return [line.strip() for line in lines if '://' in line and not line.strip().startswith('#')]
+
+
+def resource_tasks(output_dir, resources):
+    """Expand the remote resource configuration into individual download tasks, members of 
+    file lists become one task each stored under a directory named for the resource.
+
+    Returns:
+        (list): list of (output directory, resource, protocol, url) tuples
+    """
+    tasks = []
+    for resource, uri in resources.items():
+        protocol, url = parse_uri(uri)
+        if protocol == 'filelist':
+            file_uris = read_filelist(url)
+            url_dirs = [str(Path(urlparse(file_uri).path).parent) for file_uri in file_uris]
+            common = os.path.commonpath(url_dirs) if url_dirs else '/'
+            for file_uri, url_dir in zip(file_uris, url_dirs):
+                this_protocol, this_url = parse_uri(file_uri)
+                this_dir = Path(output_dir, resource, os.path.relpath(url_dir, common))
+                tasks.append((str(this_dir), resource, this_protocol, this_url))
+        else:
+            tasks.append((output_dir, resource, protocol, url))
+    return tasks
+
+
+def fetch_url(uri, dest, progress=None):
+    """Download a web resource to `dest` through a partial file, resuming an existing partial 
+    file with an HTTP Range request and moving it into place only once it is complete.
+    """
+    dest = Path(dest)
+    if dest.exists():
+        return dest
+    dest.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    partial = Path(dest.parent, dest.name + '.part')
+    offset = partial.stat().st_size if partial.exists() else 0
+
+    request = urllib.request.Request(uri)
+    if offset and uri.startswith('http'):
+        request.add_header('Range', f'bytes={offset}-')
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as error:
+        if error.code != 416:
+            raise
+        # range not satisfiable, the partial file is already complete
+        os.replace(partial, dest)
+        return dest
+
+    with response:
+        if getattr(response, 'status', None) != 206:
+            offset = 0
+        length = response.headers.get('Content-Length')
+        expected = offset + int(length) if length is not None else None
+        if progress and length is not None:
+            progress.expect(int(length))
+        with open(partial, 'ab' if offset else 'wb') as fo:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fo.write(chunk)
+                if progress:
+                    progress.update(len(chunk))
+
+    if expected is not None and partial.stat().st_size != expected:
+        raise IOError(f"Incomplete download of {uri}, {partial.stat().st_size} of {expected} bytes, rerun to resume")
+    os.replace(partial, dest)
+    return dest
+
+
+def handle_download(output_dir, resource, protocol, url, progress=None):
     uri = protocol + "://" + url
     if protocol in ('http', 'https', 'ftp'):
         info_download(f"Getting web resource {resource}...")
-        fnurl = Path(urlparse(url).path).stem
-        try:
-            import progressbar
-            urllib.request.urlretrieve(uri, filename=Path(output_dir, fnurl), reporthook=DownloadProgressBar())
-        except ModuleNotFoundError:
-            print('Downloading resources....')
-            urllib.request.urlretrieve(uri, filename=Path(output_dir, fnurl))
-            print('....done.')
+        fetch_url(uri, task_output(output_dir, resource, protocol, url), progress=progress)
 
     elif protocol in ('docker'):
         info_download(f"Getting docker resource {resource}...")
-        docker_tag = url.split('/')[-1]
-        docker_v = docker_tag.split(':')[1]
-        docker_name = docker_tag.split(':')[0]
-        subprocess.check_call(['singularity', 'pull', '-F', f"{docker_name}_{docker_v}.sif", uri], cwd=output_dir)
+        sif = task_output(output_dir, resource, protocol, url)
+        if not sif.exists():
+            tmp_sif = Path(output_dir, f".{sif.name}.{os.getpid()}.tmp")
+            pull = subprocess.run(['singularity', 'pull', '-F', tmp_sif.name, uri], cwd=output_dir, 
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if pull.returncode != 0:
+                tmp_sif.unlink(missing_ok=True)
+                raise subprocess.CalledProcessError(pull.returncode, pull.args, output=pull.stdout)
+            os.replace(tmp_sif, sif)
+        # runs take their images from the host image store
+        ImageStore().add(sif, names=[resource])
     elif protocol in ('filelist'):
         info_download(f"Getting meta-resource {resource}...")
-        file_list = urllib.request(url)
-        for i, _file_uri in enumerate(file_list, start=1):
+        for _file_uri in read_filelist(url):
             this_protocol, this_url = parse_uri(_file_uri)
-            print(f"\t Getting resource {str(i)} of {str(len(file_list))}")
-            handle_download(output_dir, resource, this_protocol, this_url)
+            handle_download(output_dir, resource, this_protocol, this_url, progress=progress)
     else:
         raise ValueError(f"Unsupported resource protocol: {protocol}")
-    return
\ No newline at end of file
+    return
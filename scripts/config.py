@@ -3,13 +3,43 @@ import json
 import traceback
 import logging
 from pathlib import Path
-from os import access as check_access, R_OK
+from os import access as check_access, R_OK, environ
 from os.path import expandvars, expanduser
 from socket import gethostname
 from uuid import uuid4
 from collections import defaultdict
+from collections.abc import Mapping
+from functools import lru_cache
 
 
+class lazy():
+    """Marker for a configuration value that is computed by `loader` on first access"""
+    def __init__(self, loader):
+        self.loader = loader
+
+
+class LazyConfig(Mapping):
+    """Read-only configuration mapping, values wrapped with `lazy` are resolved on first access 
+    and memoized, so importing a configuration table never touches the file system.
+    """
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        if isinstance(value, lazy):
+            value = value.loader()
+            self._values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+@lru_cache(maxsize=None)
 def get_current_server():
     """Return the current server name by looking at the hostname
 
@@ -68,6 +98,7 @@ SNAKEFILE = {
 remote_resource_confg = Path(Path(__file__).parent, '..', 'config', 'remote.json').absolute()
 
 
+@lru_cache(maxsize=None)
 def get_resource_config():
     """Return a dictionary containing server specific references utilized in 
     the workflow for directories or reference files.
@@ -95,13 +126,20 @@ def get_resource_config():
     return json.load(open(resource_json))
 
 
-def base_config(keys=None, qc=True, slurm_id=None):
-    base_keys = ('runs', 'run_ids', 'project', 'rnums', 'bcl_files', \
+def base_config(keys=None, qc=True, slurm_id=None, qc_sampling=None, qc_stats='fastqc', disambiguate_engine='ngs_disambiguate'):
+    base_keys = ('runs', 'run_ids', 'projects', 'rnums', 'bcl_manifest', \
                 'sample_sheet', 'samples', 'sids', 'out_to', 'demux_input_dir', \
-                'bclconvert', 'demux_data')
+                'bclconvert', 'demux_data', 'analysis_dir', 'barcode_mismatches', \
+                'demux_lanes', 'stage_scratch')
     this_config = {k: [] for k in base_keys}
     this_config['resources'] = get_resource_config()
     this_config['runqc'] = qc
+    # fast QC/QA of a seeded sample of the reads, {"reads", "seed"}, empty for QC/QA of every read
+    this_config['qc_sampling'] = qc_sampling or {}
+    # read statistics by fastqc or by weave's native fastq statistics (`scripts/fastqstats.py`)
+    this_config['qc_stats'] = qc_stats
+    # host/pathogen disambiguation by weave (`scripts/disambiguate.py`) or by the ngs_disambiguate container
+    this_config['disambiguate_engine'] = disambiguate_engine
     this_config['use_scratch'] = True if slurm_id else False
 
     if keys:
@@ -110,6 +148,7 @@ def base_config(keys=None, qc=True, slurm_id=None):
     return this_config
 
 
+@lru_cache(maxsize=None)
 def get_biowulf_seq_dirs():
     """Get a list of sequence directories, that have the required illumnia file artifacts:
     RTAComplete.txt - breadcrumb file created by bigsky transfer process and illumnia sequencing
@@ -124,6 +163,7 @@ def get_biowulf_seq_dirs():
     return [xx for x in top_dir.iterdir() if x.is_dir() for xx in x.iterdir() if xx.is_dir() and Path(xx, transfer_breadcrumb).exists()]
 
 
+@lru_cache(maxsize=None)
 def get_bigsky_seq_dirs():
     """Get a list of sequence directories, that have the required illumnia file artifacts:
     RTAComplete.txt - breadcrumb file created by bigsky transfer process and illumnia sequencing
@@ -168,23 +208,35 @@ def get_tmp_dir(host):
         return TMP_CONFIGS[host]['global']
 
 
-DIRECTORY_CONFIGS = {
-    "bigsky": {
+def get_state_dir():
+    """Return the directory used for weave's persistent local state (run index, histories, ledgers),
+    `$WEAVE_STATE_DIR` if set otherwise `~/.cache/weave`.
+
+    Returns:
+        (pathlib.Path): absolute path to the state directory, created if it does not exist
+    """
+    state_dir = Path(expandvars(expanduser(environ.get('WEAVE_STATE_DIR', '~/.cache/weave')))).absolute()
+    state_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    return state_dir
+
+
+DIRECTORY_CONFIGS = LazyConfig({
+    "bigsky": LazyConfig({
         "seqroot": "/gs1/RTS/NextGen/SequencerRuns/",
-        "seq": get_bigsky_seq_dirs(),
-        "profile": Path(Path(__file__).parent.parent, "utils", "profiles", "bigsky").resolve(),
-    },
-    "biowulf": {
+        "seq": lazy(get_bigsky_seq_dirs),
+        "profile": lazy(lambda: Path(Path(__file__).parent.parent, "utils", "profiles", "bigsky").resolve()),
+    }),
+    "biowulf": LazyConfig({
         "seqroot": "/data/RTB_GRS/SequencerRuns/",
-        "seq": get_biowulf_seq_dirs(),
-        "profile": Path(Path(__file__).parent.parent, "utils", "profiles", "biowulf").resolve(),
-    },
-    "skyline": {
+        "seq": lazy(get_biowulf_seq_dirs),
+        "profile": lazy(lambda: Path(Path(__file__).parent.parent, "utils", "profiles", "biowulf").resolve()),
+    }),
+    "skyline": LazyConfig({
         "seqroot": "/data/rtb_grs/SequencerRuns/",
-        "seq": get_bigsky_seq_dirs(),
-        "profile": Path(Path(__file__).parent.parent, "utils", "profiles", "skyline").resolve(),
-    }
-}
+        "seq": lazy(get_bigsky_seq_dirs),
+        "profile": lazy(lambda: Path(Path(__file__).parent.parent, "utils", "profiles", "skyline").resolve()),
+    }),
+})
 
 
 GENOME_CONFIGS = {
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Demultiplexing statistics summaries for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import csv
+import json
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from pathlib import Path
+
+
+# statistics of bcl2fastq, relative to a demultiplexing output directory, in order of preference
+BCL2FASTQ_STATS = ('Stats/Stats.json', 'Stats/DemultiplexingStats.xml')
+# report directories of bcl-convert, of on-instrument DRAGEN analyses linked by weave and of an analysis itself
+REPORT_DIRS = ('Reports', 'dragen_reports', 'Data/Reports')
+UNDETERMINED = 'Undetermined'
+SUMMARY_COLUMNS = ('level', 'lane', 'project', 'sample', 'index', 'reads', 'yield_bases', 'pct_perfect_index', 'pct_of_lane',
+                   'pct_undetermined')
+# unknown barcodes listed per lane in the summary
+TOP_UNKNOWN = 10
+
+
+def locate_stats(demux_dir):
+    """Demultiplexing statistics of a demultiplexing output directory from their known locations, without
+    walking the directory tree
+
+    Returns:
+        (dict): {"format": "bcl2fastq" or "bclconvert", "stats": statistics file, "quality": bcl-convert
+            Quality_Metrics.csv or None, "unknown": bcl-convert Top_Unknown_Barcodes.csv or None}, None if
+            there are no statistics
+    """
+    demux_dir = Path(demux_dir)
+    for rel in BCL2FASTQ_STATS:
+        if Path(demux_dir, rel).is_file():
+            return dict(format='bcl2fastq', stats=Path(demux_dir, rel), quality=None, unknown=None)
+    for report_dir in REPORT_DIRS:
+        stats = Path(demux_dir, report_dir, 'Demultiplex_Stats.csv')
+        if stats.is_file():
+            optional = {key: Path(demux_dir, report_dir, name) for key, name in
+                        (('quality', 'Quality_Metrics.csv'), ('unknown', 'Top_Unknown_Barcodes.csv'))}
+            return dict(format='bclconvert', stats=stats, **{key: path if path.is_file() else None for key, path in optional.items()})
+    return None
+
+
+def _count(value):
+    try:
+        return int(float(value or 0))
+    except ValueError:
+        return 0
+
+
+def stats_json_records(path):
+    """Per lane and sample records of a bcl2fastq Stats.json, with its unknown barcodes"""
+    with open(path) as fh:
+        stats = json.load(fh)
+    records = []
+    for lane in stats.get('ConversionResults', []):
+        lane_number = str(lane.get('LaneNumber'))
+        for sample in lane.get('DemuxResults', []):
+            indexes = sample.get('IndexMetrics') or []
+            records.append(dict(
+                lane=lane_number, project='', sample=sample.get('SampleId') or sample.get('SampleName', ''),
+                index=indexes[0].get('IndexSequence', '') if indexes else '',
+                reads=_count(sample.get('NumberReads')), yield_bases=_count(sample.get('Yield')),
+                perfect=sum(_count(index.get('MismatchCounts', {}).get('0')) for index in indexes),
+            ))
+        undetermined = lane.get('Undetermined') or {}
+        records.append(dict(lane=lane_number, project='', sample=UNDETERMINED, index='', reads=_count(undetermined.get('NumberReads')),
+                            yield_bases=_count(undetermined.get('Yield')), perfect=0))
+    unknown = [
+        (str(lane.get('Lane')), barcode, _count(reads))
+        for lane in stats.get('UnknownBarcodes', []) for barcode, reads in (lane.get('Barcodes') or {}).items()
+    ]
+    return records, unknown
+
+
+def demux_xml_records(path):
+    """Per lane and sample records of a bcl2fastq DemultiplexingStats.xml, parsed incrementally so the
+    elements of finished samples are released as the file is read"""
+    records, project, sample, barcode = [], None, None, None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'Project':
+                project = elem.get('name')
+            elif elem.tag == 'Sample':
+                sample = elem.get('name')
+            elif elem.tag == 'Barcode':
+                barcode = elem.get('name')
+            continue
+        if elem.tag == 'Lane' and project != 'all' and barcode != 'all':
+            undetermined = barcode == 'unknown' or sample == UNDETERMINED
+            records.append(dict(
+                lane=elem.get('number'), project='' if undetermined else project, sample=UNDETERMINED if undetermined else sample,
+                index='' if undetermined else barcode, reads=_count(elem.findtext('BarcodeCount')), yield_bases=None,
+                perfect=_count(elem.findtext('PerfectBarcodeCount')),
+            ))
+        if elem.tag in ('Sample', 'Project'):
+            elem.clear()
+    return records, []
+
+
+def demux_csv_records(stats, quality=None, unknown=None):
+    """Per lane and sample records of a bcl-convert Demultiplex_Stats.csv, with the yield of Quality_Metrics.csv
+    and the unknown barcodes of Top_Unknown_Barcodes.csv, each read as a stream"""
+    yields = defaultdict(int)
+    if quality:
+        with open(quality, newline='') as fh:
+            for row in csv.DictReader(fh):
+                yields[(row.get('Lane'), row.get('SampleID'))] += _count(row.get('Yield'))
+    records = []
+    with open(stats, newline='') as fh:
+        for row in csv.DictReader(fh):
+            sample = row.get('SampleID', '')
+            records.append(dict(
+                lane=row.get('Lane'), project=row.get('Sample_Project', '') if sample != UNDETERMINED else '', sample=sample,
+                index=row.get('Index', '') if sample != UNDETERMINED else '', reads=_count(row.get('# Reads')),
+                yield_bases=yields.get((row.get('Lane'), sample)) if quality else None,
+                perfect=_count(row.get('# Perfect Index Reads')),
+            ))
+    unknown_barcodes = []
+    if unknown:
+        with open(unknown, newline='') as fh:
+            for row in csv.DictReader(fh):
+                index = '+'.join(part for part in (row.get('index'), row.get('index2')) if part)
+                unknown_barcodes.append((row.get('Lane'), index, _count(row.get('# Reads'))))
+    return records, unknown_barcodes
+
+
+def _pct(part, whole):
+    return round(100 * part / whole, 2) if whole else 0.0
+
+
+def summarize_demux(demux_dir, projects=None):
+    """Per lane and per sample yield, percent perfect index and undetermined fractions of a demultiplexing output
+    directory. `projects` maps sample ids to their project for statistics that do not record it (bcl2fastq).
+
+    Returns:
+        (list): summary rows, dicts of `SUMMARY_COLUMNS`, an empty list when there are no statistics
+    """
+    located = locate_stats(demux_dir)
+    if located is None:
+        return []
+    if located['format'] == 'bclconvert':
+        records, unknown = demux_csv_records(located['stats'], located['quality'], located['unknown'])
+    elif located['stats'].suffix == '.json':
+        records, unknown = stats_json_records(located['stats'])
+    else:
+        records, unknown = demux_xml_records(located['stats'])
+
+    samples, lanes = {}, {}
+    for record in records:
+        key = (record['lane'], record['project'] or (projects or {}).get(record['sample'], ''), record['sample'], record['index'])
+        sample = samples.setdefault(key, dict(reads=0, yield_bases=None, perfect=0))
+        lane = lanes.setdefault(record['lane'], dict(reads=0, yield_bases=None, perfect=0, determined=0, undetermined=0))
+        for totals in (sample, lane):
+            totals['reads'] += record['reads']
+            if record['yield_bases'] is not None:
+                totals['yield_bases'] = (totals['yield_bases'] or 0) + record['yield_bases']
+        sample['perfect'] += record['perfect']
+        if record['sample'] == UNDETERMINED:
+            lane['undetermined'] += record['reads']
+        else:
+            lane['perfect'] += record['perfect']
+            lane['determined'] += record['reads']
+
+    by_lane = lambda lane: (int(lane) if str(lane).isdigit() else 0, str(lane))
+    rows = []
+    run = dict(reads=0, yield_bases=None, perfect=0, determined=0, undetermined=0)
+    for lane_number in sorted(lanes, key=by_lane):
+        lane = lanes[lane_number]
+        for key in run:
+            if lane[key] is not None:
+                run[key] = (run[key] or 0) + lane[key]
+        rows.append(dict(level='lane', lane=lane_number, reads=lane['reads'], yield_bases=lane['yield_bases'],
+                         pct_perfect_index=_pct(lane['perfect'], lane['determined']), pct_undetermined=_pct(lane['undetermined'], lane['reads'])))
+    rows.insert(0, dict(level='run', lane='all', reads=run['reads'], yield_bases=run['yield_bases'],
+                        pct_perfect_index=_pct(run['perfect'], run['determined']), pct_undetermined=_pct(run['undetermined'], run['reads'])))
+    for (lane_number, project, sample_id, index), sample in sorted(samples.items(), key=lambda item: (by_lane(item[0][0]), item[0][2] == UNDETERMINED, item[0][1:])):
+        rows.append(dict(level='sample', lane=lane_number, project=project, sample=sample_id, index=index, reads=sample['reads'],
+                         yield_bases=sample['yield_bases'], pct_perfect_index=_pct(sample['perfect'], sample['reads']) if sample_id != UNDETERMINED else None,
+                         pct_of_lane=_pct(sample['reads'], lanes[lane_number]['reads'])))
+    top = defaultdict(list)
+    for lane_number, index, reads in unknown:
+        top[lane_number].append((reads, index))
+    for lane_number in sorted(top, key=by_lane):
+        for reads, index in sorted(top[lane_number], key=lambda barcode: (-barcode[0], barcode[1]))[:TOP_UNKNOWN]:
+            rows.append(dict(level='unknown_barcode', lane=lane_number, index=index, reads=reads,
+                             pct_of_lane=_pct(reads, lanes.get(lane_number, {}).get('reads', 0))))
+    return rows
+
+
+def merge_csv_reports(parts, merged):
+    """Concatenate the per lane reports of bcl-convert into a run level report with a shared header row"""
+    Path(merged).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(merged, 'w', newline='') as fh:
+        merged_rows = csv.writer(fh, lineterminator='\n')
+        for i, part in enumerate(parts):
+            with open(part, newline='') as part_fh:
+                rows = csv.reader(part_fh)
+                header = next(rows, None)
+                if i == 0 and header:
+                    merged_rows.writerow(header)
+                merged_rows.writerows(rows)
+
+
+def merge_stats_json(parts, merged):
+    """Merge the per lane Stats.json of bcl2fastq into a run level Stats.json, the lane lists of every part are
+    concatenated and the run fields are those of the first part"""
+    stats = None
+    for part in parts:
+        with open(part) as fh:
+            lane_stats = json.load(fh)
+        if stats is None:
+            stats = lane_stats
+            continue
+        for key in ('ConversionResults', 'UnknownBarcodes', 'ReadInfosForLanes'):
+            stats.setdefault(key, []).extend(lane_stats.get(key, []))
+    Path(merged).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(merged, 'w') as fh:
+        json.dump(stats, fh, indent=4)
+
+
+def write_demux_summary(path, rows):
+    """Write summary rows as a tab separated table, empty cells for values a row does not have"""
+    Path(path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(path, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=SUMMARY_COLUMNS, delimiter='\t', lineterminator='\n', restval='')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: '' if value is None else value for key, value in row.items()})
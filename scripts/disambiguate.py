@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Streaming, read name sharded host/pathogen disambiguation for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import re
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pysam
+
+
+# outputs of a sample, `<prefix>.<output>.bam`, in the order of the AstraZeneca disambiguate tool
+OUTPUTS = ('disambiguatedSpeciesA', 'disambiguatedSpeciesB', 'ambiguousSpeciesA', 'ambiguousSpeciesB')
+# bwa alignment tags compared in order, with the sign that makes higher scores better
+BWA_TAGS = (('AS', 1), ('NM', -1))
+# score of alignments without a tag, the reference implementation's `-2^13` (a bitwise xor, -15), kept
+# so reads are classified exactly as they are there
+MISSING_SCORE = -2 ^ 13
+SUMMARY_HEADER = "sample\tunique species A pairs\tunique species B pairs\tambiguous pairs\n"
+# digit runs with leading zeros, `samtools sort -n` compares numbers by value so r01 and r1 sort as equals
+_leading_zeros = re.compile(r'(?<![0-9])0+(?=[0-9])')
+
+
+def name_tie(name):
+    """Read name with the leading zeros of its numbers removed, read names `samtools sort -n` compares as
+    equal (r1, r01) share it and their alignments can be interleaved in a name sorted BAM"""
+    return _leading_zeros.sub('', name)
+
+
+def strnum_cmp(a, b):
+    """Compare two read names the way `samtools sort -n` orders them: numbers by value, any other character
+    by its code
+
+    Returns:
+        (int): negative if `a` sorts first, positive if `b` does, 0 for names sorted as equals
+    """
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if not (a[i].isdigit() and b[j].isdigit()):
+            if a[i] != b[j]:
+                return ord(a[i]) - ord(b[j])
+            i, j = i + 1, j + 1
+            continue
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        end_a, end_b = i, j
+        while end_a < len(a) and a[end_a].isdigit():
+            end_a += 1
+        while end_b < len(b) and b[end_b].isdigit():
+            end_b += 1
+        # longer numbers are larger, numbers of the same length compare digit by digit
+        if end_a - i != end_b - j:
+            return (end_a - i) - (end_b - j)
+        if a[i:end_a] != b[j:end_b]:
+            return -1 if a[i:end_a] < b[j:end_b] else 1
+        i, j = end_a, end_b
+    return (i < len(a)) - (j < len(b))
+
+
+def name_shard(name, shards):
+    return zlib.crc32(name.encode()) % shards
+
+
+def name_blocks(bam, shard=0, shards=1):
+    """Stream the alignments of a name sorted BAM in blocks of read names sorted as equals, almost always a
+    single read name, as `(first read name, {read name: alignments})`, only for the read names of `shard`.
+    Only one block is held in memory at a time."""
+    first, tie, groups = None, None, {}
+    name, owned = None, False
+    for read in bam.fetch(until_eof=True):
+        if read.query_name != name:
+            name = read.query_name
+            owned = shards == 1 or name_shard(name, shards) == shard
+            if name not in groups and name_tie(name) != tie:
+                if groups:
+                    yield first, groups
+                first, tie, groups = name, name_tie(name), {}
+        if owned:
+            groups.setdefault(name, []).append(read)
+    if groups:
+        yield first, groups
+
+
+def classify(reads_a, reads_b):
+    """Species of a read name aligned to both genomes, with the bwa algorithm of the AstraZeneca tool: the best
+    score of each mate for every tag, tags compared in order, a species wins on its best mate and then on its
+    worst mate
+
+    Returns:
+        (int): 1 for species A, -1 for species B and 0 when ambiguous
+    """
+    scores = [[MISSING_SCORE] * 4 for _ in BWA_TAGS]
+    for offset, reads in ((0, reads_a), (2, reads_b)):
+        for read in reads:
+            if read.is_unmapped:
+                continue
+            mate = offset + (0 if read.flag & 0x40 else 1)
+            for tag_scores, (tag, sign) in zip(scores, BWA_TAGS):
+                score = sign * read.get_tag(tag) if read.has_tag(tag) else MISSING_SCORE
+                if tag_scores[mate] < score:
+                    tag_scores[mate] = score
+    for tag_scores in scores:
+        best_a, worst_a = max(tag_scores[0:2]), min(tag_scores[0:2])
+        best_b, worst_b = max(tag_scores[2:4]), min(tag_scores[2:4])
+        if best_a > best_b or best_a == best_b and worst_a > worst_b:
+            return 1
+        if best_a < best_b or best_a == best_b and worst_a < worst_b:
+            return -1
+    return 0
+
+
+def disambiguate_shard(bam_a, bam_b, out_paths, shard=0, shards=1, mode='wb'):
+    """Merge the name grouped alignments of both BAMs in one pass and write those of the read names of `shard`
+    to `out_paths` (output name to path), in input order
+
+    Returns:
+        (dict): read names assigned to species A ("A"), species B ("B") or "ambiguous", and "records" read
+    """
+    counts = dict(A=0, B=0, ambiguous=0, records=0)
+    with pysam.AlignmentFile(bam_a, 'rb') as in_a, pysam.AlignmentFile(bam_b, 'rb') as in_b:
+        templates = dict(zip(OUTPUTS, (in_a, in_b, in_a, in_b)))
+        outs = {key: pysam.AlignmentFile(str(out_paths[key]), mode, template=templates[key]) for key in OUTPUTS}
+        try:
+            blocks_a, blocks_b = name_blocks(in_a, shard, shards), name_blocks(in_b, shard, shards)
+            next_a, next_b = next(blocks_a, None), next(blocks_b, None)
+            while next_a is not None or next_b is not None:
+                order = 0 if next_a is None or next_b is None else strnum_cmp(next_a[0], next_b[0])
+                if next_b is None or next_a is not None and order < 0:
+                    # read names only in the alignments to species A
+                    groups_a, groups_b = next_a[1], {}
+                    next_a = next(blocks_a, None)
+                elif next_a is None or order > 0:
+                    groups_a, groups_b = {}, next_b[1]
+                    next_b = next(blocks_b, None)
+                else:
+                    groups_a, groups_b = next_a[1], next_b[1]
+                    next_a, next_b = next(blocks_a, None), next(blocks_b, None)
+                for name in dict.fromkeys([*groups_a, *groups_b]):
+                    reads_a, reads_b = groups_a.get(name, []), groups_b.get(name, [])
+                    species = classify(reads_a, reads_b) if reads_a and reads_b else (1 if reads_a else -1)
+                    counts['records'] += len(reads_a) + len(reads_b)
+                    if species > 0:
+                        counts['A'] += 1
+                        written = [(outs['disambiguatedSpeciesA'], reads_a)]
+                    elif species < 0:
+                        counts['B'] += 1
+                        written = [(outs['disambiguatedSpeciesB'], reads_b)]
+                    else:
+                        counts['ambiguous'] += 1
+                        written = [(outs['ambiguousSpeciesA'], reads_a), (outs['ambiguousSpeciesB'], reads_b)]
+                    for out, reads in written:
+                        for read in reads:
+                            out.write(read)
+        finally:
+            for out in outs.values():
+                out.close()
+    return counts
+
+
+def run_shard(args):
+    return disambiguate_shard(*args)
+
+
+def disambiguate(bam_a, bam_b, out_dir, prefix, workers=1):
+    """Disambiguate the name sorted alignments of a sample to species A (`bam_a`) and B (`bam_b`), writing the
+    outputs and `<prefix>_summary.txt` of the AstraZeneca disambiguate tool to `out_dir`.
+
+    With more than one worker, read names are sharded by the hash of the name across worker processes. Every
+    worker streams both inputs and disambiguates the read names of its shard into shard BAMs, which are then
+    merged back into input order with `samtools merge -n`. Memory is bounded by one read name per input and
+    worker.
+
+    Returns:
+        (dict): counts of `disambiguate_shard` summed over the shards, with the "seconds" taken
+    """
+    start = time.time()
+    out_dir = Path(out_dir)
+    out_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    out_paths = {key: Path(out_dir, f'{prefix}.{key}.bam') for key in OUTPUTS}
+    if workers < 2:
+        counts = disambiguate_shard(bam_a, bam_b, out_paths)
+    else:
+        shard_dir = Path(tempfile.mkdtemp(prefix=f'.{prefix}.shards.', dir=out_dir))
+        try:
+            shard_paths = [{key: Path(shard_dir, f'{shard}.{key}.bam') for key in OUTPUTS} for shard in range(workers)]
+            # shards are only read back once, they are written uncompressed
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(run_shard, [(bam_a, bam_b, paths, shard, workers, 'wbu') for shard, paths in enumerate(shard_paths)]))
+            counts = {key: sum(result[key] for result in results) for key in results[0]}
+            for key, bam in zip(OUTPUTS, (bam_a, bam_b, bam_a, bam_b)):
+                pysam.merge('-n', '-c', '-p', '-f', '--no-PG', '-@', str(workers), '-h', str(bam), str(out_paths[key]),
+                            *[str(paths[key]) for paths in shard_paths])
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    with open(Path(out_dir, f'{prefix}_summary.txt'), 'w') as fh:
+        fh.write(SUMMARY_HEADER)
+        fh.write(f"{prefix}\t{counts['A']}\t{counts['B']}\t{counts['ambiguous']}\n")
+    counts['seconds'] = time.time() - start
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Disambiguate reads aligned to two species (bwa alignments, name sorted BAMs)')
+    parser.add_argument('bam_a', metavar='<species A bam>', help='Name sorted alignments to species A (host)')
+    parser.add_argument('bam_b', metavar='<species B bam>', help='Name sorted alignments to species B (pathogen)')
+    parser.add_argument('-o', '--outdir', required=True, metavar='<output directory>', help='Directory to write the outputs to')
+    parser.add_argument('-s', '--prefix', required=True, metavar='<sample>', help='Sample name, the prefix of the outputs')
+    parser.add_argument('-t', '--threads', type=int, default=1, metavar='<workers>', help='Worker processes read names are sharded across')
+    args = parser.parse_args(argv)
+
+    counts = disambiguate(args.bam_a, args.bam_b, args.outdir, args.prefix, workers=args.threads)
+    names = counts['A'] + counts['B'] + counts['ambiguous']
+    seconds = max(counts['seconds'], 1e-6)
+    print(f"{args.prefix}: {names} read names ({counts['records']} alignments) disambiguated in {seconds:.1f}s with "
+          f"{args.threads} worker(s), {names / seconds:,.0f} read names/s, {counts['records'] / seconds:,.0f} alignments/s")
+    print(f"{args.prefix}: species A {counts['A']}, species B {counts['B']}, ambiguous {counts['ambiguous']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Native multi-process fastq statistics for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import gzip
+import json
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+# decompressed bytes decoded per block, working memory of a worker is a small multiple of this
+BLOCK_BYTES = 8 * 1024 * 1024
+PHRED_OFFSET = 33
+BASES = 'ACGTN'
+# MultiQC custom content files written per sample, `<prefix>_<section>_mqc.json`
+MQC_SECTIONS = ('summary', 'quality', 'length', 'gc')
+# base code of every byte: A, C, G, T (either case) and N for anything else
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = BASE_CODES[ord(_base.lower())] = _code
+
+
+def add_counts(total, counts):
+    """Element wise sum of two count arrays of different lengths"""
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total = total.copy()
+    total[:len(counts)] += counts
+    return total
+
+
+def fastq_blocks(fastq, block_bytes=BLOCK_BYTES):
+    """Stream a (gzipped) fastq as uint8 arrays of whole records, with the offsets of the newlines of each array"""
+    opener = gzip.open if str(fastq).endswith('.gz') else open
+    carry = b''
+    with opener(fastq, 'rb') as fh:
+        while True:
+            chunk = fh.read(block_bytes)
+            block = carry + chunk
+            if not chunk and block and not block.endswith(b'\n'):
+                block += b'\n'
+            buf = np.frombuffer(block, dtype=np.uint8)
+            newlines = np.flatnonzero(buf == 10)
+            n_lines = len(newlines) - len(newlines) % 4
+            if not chunk:
+                if len(newlines) != n_lines:
+                    raise ValueError(f'{fastq} ends with a truncated record')
+                if n_lines:
+                    yield buf, newlines
+                return
+            if n_lines:
+                end = newlines[n_lines - 1] + 1
+                yield buf[:end], newlines[:n_lines]
+                carry = block[end:]
+            else:
+                carry = block
+
+
+class FastqStats():
+    """Per fastq accumulators: read count, length distribution, per cycle mean quality and base composition,
+    per read GC and mean quality distributions and N rate"""
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.bases = 0
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.cycle_quality = np.zeros(0, dtype=np.int64)
+        self.cycle_bases = np.zeros(0, dtype=np.int64)
+        self.base_counts = np.zeros((0, len(BASES)), dtype=np.int64)
+        self.read_gc = np.zeros(101, dtype=np.int64)
+        self.read_quality = np.zeros(0, dtype=np.int64)
+
+    def add_block(self, buf, newlines):
+        """Decode the records of one block at once: the sequence and quality bytes of the reads are gathered
+        into (read, cycle) matrices padded to the longest read, the statistics are sums along either axis"""
+        line_starts = np.concatenate(([0], newlines[:-1] + 1))
+        seq_starts, seq_ends = line_starts[1::4], newlines[1::4]
+        qual_starts, qual_ends = line_starts[3::4], newlines[3::4]
+        # tolerate windows line endings
+        seq_ends = seq_ends - (buf[np.maximum(seq_ends - 1, 0)] == 13)
+        qual_ends = qual_ends - (buf[np.maximum(qual_ends - 1, 0)] == 13)
+        lengths = seq_ends - seq_starts
+        if not np.array_equal(lengths, qual_ends - qual_starts):
+            raise ValueError(f'{self.name} has records whose sequence and quality lengths differ')
+        if np.any(buf[line_starts[0::4]] != ord('@')):
+            raise ValueError(f'{self.name} has records that do not start with a header line')
+        n_bases = int(lengths.sum())
+        self.reads += len(lengths)
+        self.bases += n_bases
+        self.lengths = add_counts(self.lengths, np.bincount(lengths))
+        if not n_bases:
+            return
+
+        n_cycles = int(lengths.max())
+        cycles = np.arange(n_cycles)
+        in_read = cycles < lengths[:, None]
+        # positions past the end of a read are masked, padding keeps those of the last read inside the buffer
+        padded = np.concatenate((buf, np.zeros(n_cycles, dtype=np.uint8)))
+        codes = BASE_CODES[padded[seq_starts[:, None] + cycles]]
+        codes[~in_read] = len(BASES)
+        quals = padded[qual_starts[:, None] + cycles].astype(np.int16) - PHRED_OFFSET
+        quals[~in_read] = 0
+
+        self.cycle_quality = add_counts(self.cycle_quality, quals.sum(axis=0, dtype=np.int64))
+        self.cycle_bases = add_counts(self.cycle_bases, in_read.sum(axis=0, dtype=np.int64))
+        cycle_codes = np.stack([(codes == code).sum(axis=0, dtype=np.int64) for code in range(len(BASES))], axis=1)
+        if len(self.base_counts) < n_cycles:
+            self.base_counts = np.vstack((self.base_counts, np.zeros((n_cycles - len(self.base_counts), len(BASES)), dtype=np.int64)))
+        self.base_counts[:n_cycles] += cycle_codes
+
+        has_bases = lengths > 0
+        read_lengths = lengths[has_bases]
+        gc = ((codes == 1) | (codes == 2)).sum(axis=1)[has_bases]
+        self.read_gc += np.bincount(np.rint(100 * gc / read_lengths).astype(np.int64), minlength=101)
+        read_quals = quals.sum(axis=1, dtype=np.int64)[has_bases]
+        self.read_quality = add_counts(self.read_quality, np.bincount(np.maximum(read_quals // read_lengths, 0)))
+
+    def summary(self):
+        """
+        Returns:
+            (dict): statistics of the fastq, distributions keyed by cycle, length or percentage
+        """
+        base_totals = self.base_counts.sum(axis=0)
+        cycles = np.flatnonzero(self.cycle_bases)
+        return dict(
+            name=self.name,
+            reads=self.reads,
+            bases=self.bases,
+            mean_length=round(self.bases / self.reads, 2) if self.reads else 0,
+            min_length=int(np.flatnonzero(self.lengths)[0]) if self.reads else 0,
+            max_length=len(self.lengths) - 1 if self.reads else 0,
+            percent_gc=round(100 * (base_totals[1] + base_totals[2]) / self.bases, 2) if self.bases else 0,
+            percent_n=round(100 * base_totals[4] / self.bases, 4) if self.bases else 0,
+            mean_quality=round(self.cycle_quality.sum() / self.bases, 2) if self.bases else 0,
+            length_distribution={int(length): int(n) for length, n in enumerate(self.lengths) if n},
+            cycle_mean_quality={int(c) + 1: round(self.cycle_quality[c] / self.cycle_bases[c], 2) for c in cycles},
+            cycle_base_content={
+                int(c) + 1: {base: round(100 * self.base_counts[c][i] / self.cycle_bases[c], 2) for i, base in enumerate(BASES)}
+                for c in cycles
+            },
+            read_gc_distribution={gc: int(n) for gc, n in enumerate(self.read_gc)},
+            read_quality_distribution={int(q): int(n) for q, n in enumerate(self.read_quality) if n},
+        )
+
+
+def fastq_name(fastq):
+    """Sample name of a fastq as FastQC reports it, the file name without its fastq extensions"""
+    name = Path(fastq).name
+    for ext in ('.gz', '.fastq', '.fq'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def fastq_stats(fastq, block_bytes=BLOCK_BYTES):
+    """Statistics of a single fastq, see `FastqStats.summary`"""
+    stats = FastqStats(fastq_name(fastq))
+    for buf, newlines in fastq_blocks(fastq, block_bytes):
+        stats.add_block(buf, newlines)
+    return stats.summary()
+
+
+def collect_stats(fastqs, processes=None):
+    """Statistics of every fastq, computed concurrently with one worker process per fastq (up to `processes`)
+
+    Returns:
+        (list): `fastq_stats` of every fastq, in the order given
+    """
+    processes = min(processes or len(fastqs), len(fastqs)) or 1
+    if processes == 1:
+        return [fastq_stats(fastq) for fastq in fastqs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(fastq_stats, fastqs))
+
+
+def multiqc_sections(stats):
+    """MultiQC custom content sections of fastq statistics, sections of every sample share their ids and are
+    merged into one section per report
+
+    Returns:
+        (dict): `<file suffix>` to custom content
+    """
+    return {
+        'summary': dict(
+            id='weave_fastq_stats', section_name='FASTQ statistics', plot_type='table',
+            description='Read statistics computed by weave (<code>--qc-stats native</code>).',
+            headers={
+                'reads': dict(title='Reads', format='{:,.0f}'),
+                'mean_length': dict(title='Mean length'),
+                'percent_gc': dict(title='% GC', suffix='%', max=100, min=0),
+                'percent_n': dict(title='% N', suffix='%', max=100, min=0),
+                'mean_quality': dict(title='Mean quality'),
+            },
+            data={s['name']: {key: s[key] for key in ('reads', 'mean_length', 'percent_gc', 'percent_n', 'mean_quality')} for s in stats},
+        ),
+        'quality': dict(
+            id='weave_fastq_quality', section_name='Per cycle mean quality', plot_type='linegraph',
+            description='Mean Phred quality of the bases of every sequencing cycle.',
+            pconfig=dict(id='weave_fastq_quality_plot', title='Per cycle mean quality', xlab='Cycle', ylab='Phred quality', ymin=0),
+            data={s['name']: s['cycle_mean_quality'] for s in stats},
+        ),
+        'length': dict(
+            id='weave_fastq_length', section_name='Read length distribution', plot_type='linegraph',
+            description='Number of reads of every length.',
+            pconfig=dict(id='weave_fastq_length_plot', title='Read length distribution', xlab='Read length (bp)', ylab='Reads', ymin=0),
+            data={s['name']: s['length_distribution'] for s in stats},
+        ),
+        'gc': dict(
+            id='weave_fastq_gc', section_name='Per read GC content', plot_type='linegraph',
+            description='Distribution of the GC content of reads, as a percentage of the reads of a fastq.',
+            pconfig=dict(id='weave_fastq_gc_plot', title='Per read GC content', xlab='% GC', ylab='% of reads', ymin=0, xmax=100),
+            data={
+                s['name']: {gc: round(100 * n / s['reads'], 4) if s['reads'] else 0 for gc, n in s['read_gc_distribution'].items()}
+                for s in stats
+            },
+        ),
+    }
+
+
+def write_stats(stats, outdir, prefix):
+    """Write the statistics of the fastqs of a sample to `<outdir>/<prefix>_fastq_stats.json` and its MultiQC
+    custom content to `<outdir>/<prefix>_<section>_mqc.json`
+
+    Returns:
+        (list): paths written
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    written = [Path(outdir, f'{prefix}_fastq_stats.json')]
+    with open(written[0], 'w') as fh:
+        json.dump(stats, fh, indent=4)
+    for section, content in multiqc_sections(stats).items():
+        written.append(Path(outdir, f'{prefix}_{section}_mqc.json'))
+        with open(written[-1], 'w') as fh:
+            json.dump(content, fh, indent=4)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read statistics of fastq files with MultiQC custom content output')
+    parser.add_argument('fastqs', nargs='+', metavar='<fastq>', help='(gzipped) fastq files of a sample')
+    parser.add_argument('-o', '--outdir', required=True, metavar='<output directory>', help='Directory to write statistics to')
+    parser.add_argument('--prefix', required=True, metavar='<prefix>', help='Prefix of the files written, usually the sample id')
+    parser.add_argument('-t', '--threads', type=int, default=1, metavar='<processes>', help='Fastqs read concurrently')
+    args = parser.parse_args(argv)
+    write_stats(collect_stats(args.fastqs, processes=args.threads), args.outdir, args.prefix)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,17 @@
 # ~~~~~~~~~~~~~~~
 #   file system helper functions for the Dmux software package
 # ~~~~~~~~~~~~~~~
-import xml.etree.ElementTree as ET
+import os
+import json
+import shutil
 from pathlib import Path
 from os import access as check_access, R_OK, W_OK
 from functools import partial
+from . import trace
 from .samplesheet import IllumniaSampleSheet
+from .runinfo import IllumniaRunInfo
+from .runindex import SequencingRunIndex
+from .demuxstats import locate_stats
 from .config import get_current_server, GENOME_CONFIGS, DIRECTORY_CONFIGS
 
 
@@ -28,14 +34,318 @@ def get_all_seq_dirs(top_dir, server):
     return _dirs
 
 
+ANALYSIS_COMPLETE_MARKERS = ('CopyComplete.txt', 'Secondary_Analysis_Complete.txt', 'Data/Secondary_Analysis_Complete.txt')
+
+
+def has_fastq(top_dir, max_depth=3):
+    """
+        Bounded `os.scandir` search that stops at the first FASTQ file found
+    """
+    pending = [(str(top_dir), 0)]
+    while pending:
+        this_dir, depth = pending.pop()
+        try:
+            with os.scandir(this_dir) as entries:
+                for entry in entries:
+                    if '.fastq' in entry.name and entry.is_file():
+                        return True
+                    if depth < max_depth and entry.is_dir(follow_symlinks=False):
+                        pending.append((entry.path, depth + 1))
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            continue
+    return False
+
+
+def analysis_attempts(run_dir):
+    """
+        Numbered on-instrument analysis attempts (Analysis/<n>) of a run, most recent first, 
+        with their modification times.
+    """
+    attempts = []
+    try:
+        with os.scandir(Path(run_dir, 'Analysis')) as entries:
+            for entry in entries:
+                if entry.name.isnumeric() and entry.is_dir():
+                    attempts.append((int(entry.name), Path(entry.path), entry.stat().st_mtime))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    return sorted(attempts, reverse=True)
+
+
+def is_analysis_complete(attempt_dir):
+    """
+        An analysis attempt is complete and reusable if it has a completion marker, or if it has its 
+        demultiplexing report and at least one FASTQ.
+    """
+    if any(Path(attempt_dir, marker).exists() for marker in ANALYSIS_COMPLETE_MARKERS):
+        return has_fastq(Path(attempt_dir, 'Data'))
+    return Path(attempt_dir, 'Data', 'Reports', 'Demultiplex_Stats.csv').exists() and \
+        has_fastq(Path(attempt_dir, 'Data'))
+
+
+def mtime_or_none(path):
+    try:
+        return os.stat(path).st_mtime
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+
+
+def analysis_state(attempt_dir):
+    """
+        Modification times (None if missing) of the `Data` directory, completion markers and demultiplexing
+        report of an analysis attempt, the files written last by an analysis, deep enough in the tree that 
+        they do not change the modification time of the attempt directory itself.
+    """
+    watched = [Path(attempt_dir, 'Data'), Path(attempt_dir, 'Data', 'Reports', 'Demultiplex_Stats.csv')] + \
+        [Path(attempt_dir, marker) for marker in ANALYSIS_COMPLETE_MARKERS]
+    return [mtime_or_none(path) for path in watched]
+
+
+@trace.traced()
+def find_demux_analysis(run_dir):
+    """
+        Return the most recent complete on-instrument analysis attempt of a run (e.g. 
+        <run>/Analysis/2) whose FASTQs can be reused instead of demultiplexing, or None.
+
+        Results are cached in the run index keyed on the modification times of the Analysis 
+        directory, its attempts and their `analysis_state`, so unchanged runs are not rescanned.
+    """
+    run_dir = Path(run_dir).absolute()
+    analysis_dir = Path(run_dir, 'Analysis')
+    try:
+        analysis_mtime = os.stat(analysis_dir).st_mtime
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    attempts = analysis_attempts(run_dir)
+    signature = json.dumps([analysis_mtime] + [(n, mtime, analysis_state(attempt_dir)) for n, attempt_dir, mtime in attempts])
+    with SequencingRunIndex() as run_index:
+        hit, attempt = run_index.get_demux_state(run_dir, signature)
+        if hit:
+            return Path(attempt) if attempt else None
+
+        attempt = None
+        for _, attempt_dir, _ in attempts:
+            if is_analysis_complete(attempt_dir):
+                attempt = attempt_dir
+                break
+        run_index.set_demux_state(run_dir, signature, attempt)
+    return attempt
+
+
 def check_if_demuxed(data_dir):
-    do_demuxed = True
-    if Path(data_dir, 'Analysis').exists():
-        if list(Path(data_dir, 'Analysis').rglob('*.fastq*')):
-            do_demuxed = False
-    return do_demuxed
+    """
+        True if the run still needs to be demultiplexed, False if a complete analysis can be reused
+    """
+    return find_demux_analysis(data_dir) is None
 
 
+# ~~~ binary base call layouts ~~~
+#   name: (per tile, path of a single base call file relative to Data/Intensities/BaseCalls, minimum sane size in bytes)
+BCL_LAYOUTS = {
+    # NovaSeq, NextSeq 1k/2k
+    'cbcl': (False, lambda lane, cycle, surface, tile: f"L{lane:03d}/C{cycle}.1/L{lane:03d}_{surface}.cbcl", 32),
+    # NextSeq 500/550
+    'bgzf': (False, lambda lane, cycle, surface, tile: f"L{lane:03d}/{cycle:04d}.bcl.bgzf", 28),
+    # HiSeq 2500/3000/4000
+    'gz': (True, lambda lane, cycle, surface, tile: f"L{lane:03d}/C{cycle}.1/s_{lane}_{tile}.bcl.gz", 20),
+    # MiSeq
+    'bcl': (True, lambda lane, cycle, surface, tile: f"L{lane:03d}/C{cycle}.1/s_{lane}_{tile}.bcl", 4),
+}
+BCL_SUFFIXES = ('.cbcl', '.bcl', '.bcl.gz', '.bcl.bgzf')
+MAX_BCL_REPORTS = 10
+
+
+def report_bcl_problem(kind, bcl_file, count):
+    if count <= MAX_BCL_REPORTS:
+        print(f"Warning: {kind} base call file {bcl_file}")
+
+
+def detect_bcl_layout(basecalls, run_info):
+    """
+        Probe the first cycle of the first lane for each known base call file layout, 
+        return the name of the matching layout or None.
+    """
+    first_lane = run_info.lanes[0] if run_info.lanes else 1
+    first_tiles = run_info.lane_tiles(first_lane)
+    for name, (per_tile, this_layout, _) in BCL_LAYOUTS.items():
+        if per_tile and not first_tiles:
+            continue
+        probe = this_layout(first_lane, 1, 1, first_tiles[0] if per_tile else None)
+        if Path(basecalls, probe).exists():
+            return name
+    return None
+
+
+def expected_bcl_files(basecalls, run_info, layout):
+    """
+        Generator of all base call files expected for a run given the flowcell layout in RunInfo.xml
+    """
+    per_tile, this_layout, _ = BCL_LAYOUTS[layout]
+    for lane in run_info.lanes:
+        for cycle in run_info.cycles:
+            if per_tile:
+                for tile in run_info.lane_tiles(lane):
+                    yield Path(basecalls, this_layout(lane, cycle, None, tile))
+            elif layout == 'cbcl':
+                for surface in run_info.surfaces:
+                    yield Path(basecalls, this_layout(lane, cycle, surface, None))
+            else:
+                yield Path(basecalls, this_layout(lane, cycle, None, None))
+
+
+def scan_bcl_files(basecalls, max_depth=2):
+    """
+        Single bounded `os.scandir` pass over the BaseCalls directory (lane and cycle 
+        directories only) collecting base call files and their sizes.
+    """
+    found = []
+    pending = [(str(basecalls), 0)]
+    while pending:
+        this_dir, depth = pending.pop()
+        try:
+            with os.scandir(this_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth < max_depth and 'tmp' not in entry.name.lower():
+                            pending.append((entry.path, depth + 1))
+                    elif entry.name.endswith(BCL_SUFFIXES):
+                        found.append((Path(entry.path), entry.stat().st_size))
+        except (PermissionError, FileNotFoundError):
+            continue
+    return sorted(found)
+
+
+@trace.traced()
+def find_bcl_files(run_dir, run_info=None):
+    """
+        Enumerate the binary base call files (BCL/CBCL) of a run.
+
+        The expected files are derived from the lanes, surfaces, tiles, and cycles in RunInfo.xml and
+        checked with a single stat each, missing or truncated files are reported as they are found.
+        When the layout can not be determined from RunInfo.xml a single bounded scan of 
+        Data/Intensities/BaseCalls is used instead of walking the entire run directory.
+
+        Returns:
+            (list): (absolute `pathlib.Path`, size in bytes) of the base call files present in the run
+    """
+    run_dir = Path(run_dir).absolute()
+    basecalls = Path(run_dir, 'Data', 'Intensities', 'BaseCalls')
+    if not basecalls.exists():
+        return []
+
+    if run_info is None and Path(run_dir, 'RunInfo.xml').exists():
+        run_info = IllumniaRunInfo(Path(run_dir, 'RunInfo.xml'))
+
+    layout = detect_bcl_layout(basecalls, run_info) if run_info is not None else None
+    if layout is None:
+        scanned = [(bcl, size) for bcl, size in scan_bcl_files(basecalls) if size > 0]
+        trace.count('bcl files', files=len(scanned), bytes=sum(size for _, size in scanned))
+        return scanned
+
+    min_size = BCL_LAYOUTS[layout][2]
+    bcls, missing, truncated, total = [], 0, 0, 0
+    for bcl in expected_bcl_files(basecalls, run_info, layout):
+        try:
+            size = os.stat(bcl).st_size
+        except FileNotFoundError:
+            missing += 1
+            report_bcl_problem('missing', bcl, missing)
+            continue
+        if size < min_size:
+            truncated += 1
+            report_bcl_problem('truncated', bcl, truncated)
+        bcls.append((bcl, size))
+        total += size
+
+    trace.count('bcl files', files=len(bcls), bytes=total)
+
+    if missing or truncated:
+        print(f"Warning: run {run_dir.name} has {missing} missing and {truncated} truncated base call files")
+    return bcls
+
+
+@trace.traced()
+def plan_lane_units(sample_sheet, config_dir, settings=None):
+    """Split the sample sheet of a run into per lane sample sheets, so each lane can be demultiplexed 
+    as an independent unit and the lanes merged afterwards.
+
+    Samples are numbered (S1, S2, ...) by the demultiplexer in the order of their first appearance in a 
+    sheet, so each unit records the sample id a run level sample id has within the lane.
+
+    Returns:
+        (dict): lane number (str) to lane unit::
+
+            {
+                "1": {
+                    "sample_sheet": "/path/to/.config/SampleSheet_L1.csv",
+                    "sids": {"<run sid>": "<lane sid>", ...}
+                },
+                ...
+            }
+
+            empty for sheets without a `Lane` column or with samples in a single lane.
+    """
+    lane_groups = sample_sheet.lane_groups()
+    if len(lane_groups) < 2:
+        return {}
+    run_sids = {sample.Sample_ID: f"{sample.Sample_ID}_S{i}" 
+                for i, sample in enumerate(sample_sheet.unique_samples(), start=1)}
+    mk_or_pass_dirs(config_dir)
+    units = {}
+    for lane, samples in lane_groups.items():
+        lane_sheet = sample_sheet.write(Path(config_dir, f"SampleSheet_L{lane}.csv"), settings=settings, samples=samples)
+        units[str(lane)] = dict(
+            sample_sheet=str(lane_sheet),
+            sids={run_sids[sample.Sample_ID]: f"{sample.Sample_ID}_S{i}" 
+                  for i, sample in enumerate(sample_sheet.unique_samples(samples), start=1)},
+        )
+    return units
+
+
+def skip_lanes(lane_units, lanes):
+    """Lane units without those of `lanes`, samples of a skipped lane are merged from their other lanes
+
+    Returns:
+        (tuple): the kept lane units (dict) and the run level sample ids still in one of them (set)
+    """
+    kept = {lane: unit for lane, unit in lane_units.items() if int(lane) not in {int(lane) for lane in lanes}}
+    return kept, {sid for unit in kept.values() for sid in unit['sids']}
+
+
+def lane_demuxed_fastq(lane_units, lane_dir, lane, project, sid, rnum):
+    """Fastq of a run level sample id in the demultiplexing output of a lane, under its lane level sample id"""
+    return lane_dir.format(lane=lane) + f"/{project}/{lane_units[lane]['sids'][sid]}_R{rnum}_001.fastq.gz"
+
+
+def lane_fastq_parts(lane_units, lane_dir, project, sid, rnum):
+    """Per lane fastq files of a run level sample id, in lane order, the parts its run level fastq is merged from"""
+    return [
+        lane_dir.format(lane=lane) + f"/parts/{project}/{sid}_R{rnum}_001.fastq.gz"
+        for lane, unit in sorted(lane_units.items(), key=lambda unit: int(unit[0])) if sid in unit['sids']
+    ]
+
+
+def merge_files(parts, merged):
+    """Concatenate (gzip members concatenate into a valid gzip file) `parts` into `merged`, a single part is 
+    hard linked. The parts are temporary outputs of the workflow, removed by snakemake once merged."""
+    tmp = str(merged) + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    if len(parts) == 1:
+        try:
+            os.link(parts[0], tmp)
+        except OSError:
+            shutil.copyfile(parts[0], tmp)
+    else:
+        with open(tmp, 'wb') as fh:
+            for part in parts:
+                with open(part, 'rb') as part_fh:
+                    shutil.copyfileobj(part_fh, fh, length=16 * 1024 * 1024)
+    os.replace(tmp, merged)
+
+
+@trace.traced()
 def valid_run_output(output_directory, dry_run=False):
     if dry_run:
         return Path(output_directory).absolute()
@@ -78,10 +388,12 @@ def get_all_staged_dirs(top_dir, server):
     return list(filter(partial(is_dir_staged, server), get_all_seq_dirs(top_dir, server)))
 
 
-def runid2samplesheet(runid, top_dir=DIRECTORY_CONFIGS['bigsky']['seq']):
+def runid2samplesheet(runid, top_dir=None):
     """
         Given a valid run id return the path to the sample sheet
     """
+    if top_dir is None:
+        top_dir = DIRECTORY_CONFIGS[get_current_server()]['seqroot']
     ss_path = Path(top_dir, runid)
     if not ss_path.exists():
         raise FileNotFoundError(f"Run directory does not exist: {ss_path}")
@@ -143,44 +455,41 @@ def is_dir_staged(server, run_dir):
 
 
 def find_demux_dir(run_dir):
-    demux_stat_files = [x for x in Path(run_dir).rglob('DemultiplexingStats.xml')]
-
-    if len(demux_stat_files) != 1:
-        raise FileNotFoundError
-    
-    return Path(demux_stat_files[0], '..').absolute()
+    """
+        Directory of the demultiplexing statistics (bcl2fastq `Stats/`, bcl-convert or DRAGEN `Reports/`) of a 
+        run or demultiplexing output directory, looked up at their known locations instead of walking the run.
+    """
+    for demux_dir in (Path(run_dir), Path(run_dir, 'demux')):
+        located = locate_stats(demux_dir)
+        if located:
+            return located['stats'].parent.absolute()
+    raise FileNotFoundError(f'No demultiplexing statistics in {run_dir}')
 
 
+@trace.traced()
 def get_run_directories(runids, seq_dir=None, sheetname=None):
     host = get_current_server()
     seq_dirs = Path(seq_dir).absolute() if seq_dir else Path(DIRECTORY_CONFIGS[host]['seqroot'])
-    seq_contents = [_child for _child in seq_dirs.iterdir()]
-    for firstchild in seq_dirs.iterdir():
-        if firstchild.is_dir():
-            for secondchild in firstchild.iterdir():
-                seq_contents.append(secondchild)
-    seq_contents_names = [child for child in map(lambda d: d.name, seq_contents)]
-    
+
     run_paths, invalid_runs  = [], []
     run_return = []
-    for run in runids:
-        if Path(run).exists():
-            # this is a full pathrun directory
-            run_paths.append(Path(run))
-        elif run in seq_contents_names:
-            for _r in seq_contents:
-                if run == _r.name:
-                    run_paths.append(_r)
-        else:
-            invalid_runs.append(run)
+    with SequencingRunIndex() as run_index, trace.span('refresh run index', seqroot=seq_dirs):
+        run_index.refresh(seq_dirs)
+        for run in runids:
+            if Path(run).exists():
+                # this is a full pathrun directory
+                run_paths.append(Path(run))
+            elif run_index.lookup(seq_dirs, run):
+                run_paths.extend(run_index.lookup(seq_dirs, run))
+            else:
+                invalid_runs.append(run)
 
     for run_p in run_paths:
-        runinfo_xml = ET.parse(Path(run_p, 'RunInfo.xml').absolute())
-        try:
-            rid = runinfo_xml.find("Run").attrib['Id']
-        except (KeyError, AttributeError):
-            rid = run_p.name
-        this_run_info = dict(run_id=rid)
+        with trace.span('IllumniaRunInfo', run=run_p):
+            run_info = IllumniaRunInfo(Path(run_p, 'RunInfo.xml'))
+        trace.count('run directories', runs=1)
+        rid = run_info.run_id
+        this_run_info = dict(run_id=rid, runinfo=run_info)
 
         if Path(run_p, 'SampleSheet.csv').exists():
             sheet = Path(run_p, 'SampleSheet.csv').absolute()
@@ -194,8 +503,7 @@ def get_run_directories(runids, seq_dir=None, sheetname=None):
             raise FileNotFoundError(f'Run {rid}({run_p}) does not have a find-able sample sheet.')
         
         this_run_info['samplesheet'] = parse_samplesheet(sheet)
-        this_run_info.update({info.tag: info.text for run in runinfo_xml.getroot() for info in run \
-                             if info.text is not None and info.text.strip() not in ('\n', '')})
+        this_run_info.update(dict(run_info.items()))
         run_return.append((run_p, this_run_info))
 
     if invalid_runs:
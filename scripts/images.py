@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Shared content addressed singularity image store for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+from .config import get_state_dir, get_resource_config
+
+
+# images the workflow runs, by the key rules refer to them with: (sif file name in the host sif directory,
+# resource name in config/remote.json)
+WORKFLOW_IMAGES = {
+    'bcl2fastq': ('bcl2fastq.sif', 'bcl2fastq'),
+    'bclconvert': ('weave_bclconvert_0.0.3.sif', 'bclconvert'),
+    'ngsqc_0.0.1': ('weave_ngsqc_0.0.1.sif', 'weave'),
+    'ngsqc': ('weave_ngsqc_0.0.2.sif', None),
+    'disambiguate': ('ngs_disambiguate_2018.05.03.sif', 'disambiguate'),
+}
+HASH_CHUNK = 16 * 1024 * 1024
+
+
+def image_store_dir():
+    """Root of the image store, `$WEAVE_IMAGE_STORE`, the `image_store` of the host configuration or
+    `images` in the weave state directory"""
+    if os.environ.get('WEAVE_IMAGE_STORE'):
+        return Path(os.environ['WEAVE_IMAGE_STORE']).absolute()
+    resources = get_resource_config() or {}
+    if resources.get('image_store'):
+        return Path(resources['image_store']).absolute()
+    return Path(get_state_dir(), 'images')
+
+
+def singularity_cache_dir():
+    """Singularity cache of the user, `$SINGULARITY_CACHEDIR` or `singularity` in the weave state directory"""
+    if os.environ.get('SINGULARITY_CACHEDIR'):
+        return Path(os.environ['SINGULARITY_CACHEDIR']).absolute()
+    return Path(get_state_dir(), 'singularity')
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageStore():
+    """Singularity images stored once per host by the sha256 of their content (`sha256/<digest>.sif`, a hard
+    link to the imported file or, across file systems, a symbolic link to it), with an index of the names they
+    are known by and the files they were imported from. Writers hold an exclusive lock on the store, so
+    concurrent runs and cache jobs can fill it safely. Images already in the store are looked up without
+    writing to it, so users without write access to a shared store can still read it.
+    """
+    def __init__(self, root=None):
+        self.root = Path(root).absolute() if root else image_store_dir()
+        self.blobs = Path(self.root, 'sha256')
+        self.index_file = Path(self.root, 'index.json')
+
+    @contextmanager
+    def lock(self):
+        self.blobs.mkdir(mode=0o775, parents=True, exist_ok=True)
+        with open(Path(self.root, '.lock'), 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def index(self):
+        try:
+            with open(self.index_file) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {'names': {}, 'sources': {}}
+
+    def write_index(self, index):
+        tmp_index = Path(self.root, f'.index.{os.getpid()}.tmp')
+        with open(tmp_index, 'w') as fh:
+            json.dump(index, fh, indent=4)
+        os.replace(tmp_index, self.index_file)
+
+    def blob(self, digest):
+        return Path(self.blobs, f'{digest}.sif')
+
+    def lookup(self, *names):
+        """Stored image of the first of `names` the store knows, None if there is none"""
+        known = self.index()['names']
+        for name in names:
+            if name and name in known and self.blob(known[name]).exists():
+                return self.blob(known[name])
+        return None
+
+    def add(self, sif, names=()):
+        """Import a sif file under `names`, a file already imported unchanged (same size and modification
+        time) is not hashed again and identical images are only stored once. Images are linked, not copied.
+        The store is only locked and written to when the file or one of `names` is not indexed yet.
+
+        Returns:
+            (pathlib.Path): the stored image
+        """
+        sif = Path(sif).absolute()
+        stat = sif.stat()
+        index = self.index()
+        known = index['sources'].get(str(sif))
+        if known and known[:2] == [stat.st_size, stat.st_mtime] and self.blob(known[2]).exists():
+            digest = known[2]
+            if all(index['names'].get(name) == digest for name in (sif.name, *names)):
+                return self.blob(digest)
+        else:
+            # hash outside of the lock, only placing the image and updating the index is serialized
+            digest = sha256_file(sif)
+        blob = self.blob(digest)
+        with self.lock():
+            if known and known[2] != digest and self.blob(known[2]).is_symlink() and \
+                    Path(os.readlink(self.blob(known[2]))) == sif:
+                # a referenced image changed in place, its old digest no longer names its content
+                self.blob(known[2]).unlink()
+            if not blob.exists():
+                tmp_blob = Path(self.blobs, f'.{digest}.{os.getpid()}.tmp')
+                try:
+                    os.link(sif, tmp_blob)
+                except OSError:
+                    # on another file system the image is referenced where it is, never copied
+                    os.symlink(sif, tmp_blob)
+                os.replace(tmp_blob, blob)
+            index = self.index()
+            index['sources'][str(sif)] = [stat.st_size, stat.st_mtime, digest]
+            for name in (sif.name, *names):
+                index['names'][name] = digest
+            self.write_index(index)
+        return blob
+
+    def resolve(self, sif_dir=None, populate=True):
+        """Image of every workflow container key, taken from the store, imported into the store from the host
+        sif directory (`populate`) or, when neither has it, the path in the host sif directory. Images are
+        taken from the host sif directory when the store can not be written to.
+
+        Returns:
+            (dict): workflow image key to sif path
+        """
+        containers = {}
+        for key, (sif_name, resource) in WORKFLOW_IMAGES.items():
+            host_sif = Path(sif_dir, sif_name) if sif_dir else None
+            if populate and host_sif and host_sif.exists():
+                try:
+                    stored = self.add(host_sif, names=[resource] if resource else [])
+                except PermissionError:
+                    stored = host_sif
+            else:
+                stored = self.lookup(sif_name, resource)
+            containers[key] = str(stored or host_sif or sif_name)
+        return containers
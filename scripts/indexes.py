@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Index (barcode) collision analysis of sample sheets for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import numpy as np
+
+from . import trace
+
+
+# bcl2fastq and bcl-convert both accept 0, 1 or 2 mismatches per index read
+MAX_MISMATCHES = 2
+# barcodes are packed 16 bases per 64 bit word, one bit per base in a nibble, so the
+# exclusive or of two words has a non zero nibble for every mismatching position
+BASES_PER_WORD = 16
+NIBBLE_LOW_BITS = np.uint64(0x1111111111111111)
+# unknown bases (N and anything else) only match themselves, padding only matches padding
+BASE_NIBBLES = np.full(256, 0xF, dtype=np.uint64)
+BASE_NIBBLES[0] = 0
+for _base, _bit in zip('ACGT', (1, 2, 4, 8)):
+    BASE_NIBBLES[ord(_base)] = BASE_NIBBLES[ord(_base.lower())] = _bit
+BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return BYTE_POPCOUNT[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def encode_barcodes(barcodes):
+    """Pack barcode strings into an (n, words) array of 64 bit words, 4 bits per base"""
+    width = max([len(bc) for bc in barcodes] + [1])
+    n_words = -(-width // BASES_PER_WORD)
+    raw = np.array([bc.encode('ascii') for bc in barcodes], dtype=f'S{n_words * BASES_PER_WORD}')
+    nibbles = BASE_NIBBLES[raw.view(np.uint8).reshape(len(barcodes), n_words, BASES_PER_WORD)]
+    shifts = np.arange(BASES_PER_WORD, dtype=np.uint64) * np.uint64(4)
+    return np.bitwise_or.reduce(nibbles << shifts, axis=2)
+
+
+def mismatches(diff):
+    """Number of mismatching bases of exclusive or'ed encoded barcodes, summed over the last axis"""
+    diff |= diff >> np.uint64(1)
+    diff |= diff >> np.uint64(2)
+    diff &= NIBBLE_LOW_BITS
+    counts = popcount(diff)
+    if counts.shape[-1] == 1:
+        return counts[..., 0]
+    return counts.sum(axis=-1, dtype=np.uint8)
+
+
+def close_pairs(index1, index2=None, max_distance=2 * MAX_MISMATCHES, chunk_cells=1 << 22):
+    """Find every pair of barcodes that is within `max_distance` on both index reads.
+
+    Index 1 distances are computed for the upper triangle of the pairwise matrix in row blocks, so
+    memory stays bounded by `chunk_cells` pairs regardless of the number of barcodes, index 2
+    distances only for the pairs close on index 1.
+
+    Returns:
+        (tuple): arrays (i, j, index 1 distance, index 2 distance) of the close pairs, i < j
+    """
+    codes1 = encode_barcodes(index1)
+    n = len(index1)
+    # blocks of at most an eighth of the rows keep the computed cells close to the upper triangle
+    rows = max(1, min(chunk_cells // max(n, 1), -(-n // 8)))
+    found_i, found_j, found_d1 = [], [], []
+    for start in range(0, n, rows):
+        stop = min(n, start + rows)
+        d1 = mismatches(codes1[start:stop, None, :] ^ codes1[None, start:, :])
+        ii, jj = np.nonzero(d1 <= max_distance)
+        upper = ii < jj
+        ii, jj = ii[upper], jj[upper]
+        found_i.append(ii + start)
+        found_j.append(jj + start)
+        found_d1.append(d1[ii, jj])
+    ii, jj, d1 = (np.concatenate(found) if found else np.empty(0, dtype=np.intp) 
+                  for found in (found_i, found_j, found_d1))
+
+    if index2 is None:
+        # single index, pairs only differ on the first index
+        d2 = np.zeros(len(ii), dtype=np.uint8)
+    else:
+        codes2 = encode_barcodes(index2)
+        d2 = mismatches(codes2[ii] ^ codes2[jj])
+        close = d2 <= max_distance
+        ii, jj, d1, d2 = ii[close], jj[close], d1[close], d2[close]
+    return ii, jj, d1.astype(np.int16), d2.astype(np.int16)
+
+
+def analyze_indexes(sample_sheet, max_mismatches=MAX_MISMATCHES, report=(0, 0)):
+    """Check the barcodes of every lane of a sample sheet for collisions.
+
+    Two samples of a lane are indistinguishable with (m1, m2) allowed mismatches when their index 1
+    barcodes are within 2*m1 and their index 2 barcodes are within 2*m2 of each other, in that case a
+    read could be within the allowed mismatches of both samples.
+
+    Returns:
+        (dict): analysis of the sample sheet indexes::
+
+            {
+                "dual": True if samples have a second index,
+                "safe": [(m1, m2), ...] mismatch settings without collisions in any lane,
+                "lanes": {lane: [(m1, m2), ...]} mismatch settings without collisions in each lane,
+                "collisions": [(lane, sample 1, sample 2, index 1 distance, index 2 distance), ...]
+                    pairs of samples colliding with the `report` mismatch setting
+            }
+    """
+    dual = any('Index2' in sample for sample in sample_sheet.samples)
+    m2_range = range(max_mismatches + 1) if dual else (0,)
+    every_setting = {(m1, m2) for m1 in range(max_mismatches + 1) for m2 in m2_range}
+    safe, lanes = set(every_setting), {}
+    collisions = []
+    for lane, samples in sample_sheet.lane_groups().items():
+        lanes[lane] = sorted(every_setting)
+        if len(samples) < 2 or not any('Index' in sample for sample in samples):
+            continue
+        index1 = [sample.get('Index', '') for sample in samples]
+        index2 = [sample.get('Index2', '') for sample in samples] if dual else None
+        ii, jj, d1, d2 = close_pairs(index1, index2, max_distance=2 * max_mismatches)
+        lanes[lane] = sorted(m for m in every_setting if not np.any((d1 <= 2 * m[0]) & (d2 <= 2 * m[1])))
+        safe.intersection_update(lanes[lane])
+        colliding = np.nonzero((d1 <= 2 * report[0]) & (d2 <= 2 * report[1]))[0]
+        for k in colliding:
+            collisions.append((lane, samples[ii[k]].get('Sample_ID'), samples[jj[k]].get('Sample_ID'),
+                               int(d1[k]), int(d2[k]) if dual else None))
+    return dict(dual=dual, safe=sorted(safe), lanes=lanes, collisions=collisions)
+
+
+def largest_setting(settings):
+    """Mismatch setting allowing the most mismatches, preferring balanced settings and then index 1"""
+    return max(settings, key=lambda m: (sum(m), min(m), m[0])) if settings else None
+
+
+@trace.traced()
+def barcode_mismatches(sample_sheet, max_mismatches=MAX_MISMATCHES):
+    """Choose the largest barcode mismatch setting without index collisions in any lane. Mismatches
+    already set in the sample sheet (`BarcodeMismatchesIndex1/2`) are kept if they are safe.
+
+    Returns:
+        (tuple): (index 1 mismatches, index 2 mismatches), index 2 mismatches is None for single
+            index sheets, None if the sheet has no indexes
+    """
+    if not any('Index' in sample for sample in sample_sheet.samples):
+        return None
+    requested = getattr(sample_sheet, 'BarcodeMismatchesIndex1', None)
+    limit = (int(requested), int(getattr(sample_sheet, 'BarcodeMismatchesIndex2', 1))) if requested is not None else (0, 0)
+    analysis = analyze_indexes(sample_sheet, max_mismatches=max_mismatches, report=limit)
+    dual = analysis['dual']
+
+    if requested is not None:
+        chosen = (limit[0], limit[1] if dual else 0)
+        chosen = chosen if chosen in analysis['safe'] else None
+    else:
+        chosen = largest_setting(analysis['safe'])
+
+    if chosen is None:
+        lines = [f"\t{'lane ' + str(lane) if lane is not None else 'all lanes'}: {s1} and {s2} " + \
+                 f"(index 1 distance {d1}" + (f", index 2 distance {d2})" if d2 is not None else ")")
+                 for lane, s1, s2, d1, d2 in analysis['collisions']]
+        raise ValueError(f"Index collisions in sample sheet {sample_sheet.path} with {limit[0]} index 1 " + \
+                         f"mismatches" + (f" and {limit[1]} index 2 mismatches" if dual else "") + ":\n" + "\n".join(lines))
+    return chosen if dual else (chosen[0], None)
+
+
+def mismatch_report(sample_sheet, chosen, bclconvert=False, max_mismatches=MAX_MISMATCHES):
+    """Lines logging the barcode mismatches every lane is demultiplexed with, the largest collision free
+    setting of the lane on its own and whether the run differs from the demultiplexer default (1 mismatch
+    per index for both bcl2fastq and bcl-convert)
+
+    Returns:
+        (list): one line per lane
+    """
+    if chosen is None:
+        return []
+    analysis = analyze_indexes(sample_sheet, max_mismatches=max_mismatches)
+    fmt = lambda m: ','.join(str(n) for n, used in zip(m, (True, analysis['dual'])) if used)
+    tool = 'bcl-convert' if bclconvert else 'bcl2fastq'
+    setting = (chosen[0], chosen[1] if chosen[1] is not None else 0)
+    default = (1, 1 if analysis['dual'] else 0)
+    lines = []
+    for lane, lane_safe in analysis['lanes'].items():
+        name = f"lane {lane}" if lane is not None else "all lanes"
+        note = f", {tool} default is {fmt(default)}" if setting != default else ""
+        lines.append(f"{name}: {fmt(setting)} barcode mismatches (largest collision free in lane {fmt(largest_setting(lane_safe))}{note})")
+    return lines
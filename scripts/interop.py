@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Memory-mapped Illumina InterOp metrics and the pre-demultiplexing lane gate for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import numpy as np
+from pathlib import Path
+
+
+INTEROP_DIR = 'InterOp'
+TILE_METRICS = 'TileMetricsOut.bin'
+QUALITY_METRICS = 'QMetricsOut.bin'
+ERROR_METRICS = 'ErrorMetricsOut.bin'
+EXTRACTION_METRICS = 'ExtractionMetricsOut.bin'
+# tile metric codes of TileMetricsOut.bin version 2
+DENSITY_CODE, DENSITY_PF_CODE, CLUSTERS_CODE, CLUSTERS_PF_CODE = 100, 101, 102, 103
+# record code of the cluster counts of a tile in TileMetricsOut.bin version 3
+TILE_COUNTS_CODE = ord('t')
+# records summed per numpy call, bounds the memory of aggregating a metrics file regardless of its size
+CHUNK_RECORDS = 1 << 16
+# lanes below either threshold fail the gate of `weave run`
+MIN_PCT_PF = 50.0
+MIN_PCT_Q30 = 70.0
+LANE_COLUMNS = ('lane', 'tiles', 'density_k', 'pct_pf', 'pct_q30', 'error_rate', 'intensity_c1', 'fwhm')
+
+
+def _tile_dtype(version):
+    if version == 2:
+        return np.dtype([('lane', '<u2'), ('tile', '<u2'), ('code', '<u2'), ('value', '<f4')])
+    if version == 3:
+        # 't' records hold the cluster and PF cluster counts of a tile, 'r' records a read number and % aligned
+        return np.dtype([('lane', '<u2'), ('tile', '<u4'), ('code', 'u1'), ('first', '<f4'), ('second', '<f4')])
+    return None
+
+
+def _error_dtype(version):
+    if version == 3:
+        return np.dtype([('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('error_rate', '<f4'), ('errors', '<u4', (5,))])
+    if version == 4:
+        return np.dtype([('lane', '<u2'), ('tile', '<u4'), ('cycle', '<u2'), ('error_rate', '<f4')])
+    return None
+
+
+class InterOpFile():
+    """Header of a binary InterOp metrics file and its records as a read-only memory map, nothing beyond the
+    header is read until records are accessed.
+
+    Every metrics file starts with a version byte and a record size byte, some versions follow them with
+    format specific header fields. Records are fixed size little endian structures described by a numpy
+    structured dtype. Trailing bytes of a record still being written are ignored.
+
+    Properties:
+        version(int): format version of the file
+        record_size(int): bytes per record
+        header(dict): format specific header fields
+        records(np.ndarray): structured records, a `np.memmap` unless the file has none
+    """
+    def __init__(self, path, kind):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fh:
+            head = fh.read(2)
+            if len(head) < 2:
+                raise ValueError(f'InterOp file {self.path} has no header')
+            self.version, self.record_size = head[0], head[1]
+            dtype, self.header = getattr(self, f'_{kind}_header')(fh)
+            offset = fh.tell()
+        if dtype is None:
+            raise ValueError(f'InterOp file {self.path} has unsupported {kind} metrics version {self.version}')
+        if dtype.itemsize != self.record_size:
+            raise ValueError(f'InterOp file {self.path} has {self.record_size} byte records, expected {dtype.itemsize} ' + \
+                             f'for {kind} metrics version {self.version}')
+        n_records = (self.path.stat().st_size - offset) // self.record_size
+        self.records = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(n_records,)) \
+            if n_records else np.zeros(0, dtype=dtype)
+
+    def _read(self, fh, n_bytes):
+        data = fh.read(n_bytes)
+        if len(data) < n_bytes:
+            raise ValueError(f'InterOp file {self.path} has a truncated header')
+        return data
+
+    def _tile_header(self, fh):
+        header = {}
+        if self.version == 3:
+            header['area'] = float(np.frombuffer(self._read(fh, 4), dtype='<f4')[0])
+        return _tile_dtype(self.version), header
+
+    def _quality_header(self, fh):
+        # version 5 and later describe the quality bins of binned base calls, version 7 widened the tile number
+        bins = None
+        if self.version >= 5 and self._read(fh, 1)[0]:
+            n_bins = self._read(fh, 1)[0]
+            lower, upper, remapped = (list(self._read(fh, n_bins)) for _ in range(3))
+            bins = dict(lower=lower, upper=upper, remapped=remapped)
+        if self.version not in (4, 5, 6, 7):
+            return None, dict(bins=bins)
+        n_values = len(bins['remapped']) if bins and self.version >= 6 else 50
+        tile = '<u4' if self.version == 7 else '<u2'
+        dtype = np.dtype([('lane', '<u2'), ('tile', tile), ('cycle', '<u2'), ('histogram', '<u4', (n_values,))])
+        # quality score of every histogram value: Q1 to Q50 or the remapped quality of each bin
+        qualities = bins['remapped'] if bins and self.version >= 6 else list(range(1, 51))
+        return dtype, dict(bins=bins, qualities=np.array(qualities))
+
+    def _error_header(self, fh):
+        return _error_dtype(self.version), {}
+
+    def _extraction_header(self, fh):
+        if self.version == 2:
+            channels = ['A', 'C', 'G', 'T']
+        elif self.version == 3:
+            channels = []
+            for _ in range(self._read(fh, 1)[0]):
+                length = int(np.frombuffer(self._read(fh, 2), dtype='<u2')[0])
+                channels.append(self._read(fh, length).decode())
+        else:
+            return None, {}
+        fields = [('lane', '<u2'), ('tile', '<u2' if self.version == 2 else '<u4'), ('cycle', '<u2'),
+                  ('fwhm', '<f4', (len(channels),)), ('intensity', '<u2', (len(channels),))]
+        if self.version == 2:
+            fields.append(('datetime', '<u8'))
+        return np.dtype(fields), dict(channels=channels)
+
+    def chunks(self, chunk=CHUNK_RECORDS):
+        """Consecutive slices of the records, each at most `chunk` records"""
+        for start in range(0, len(self.records), chunk):
+            yield self.records[start:start + chunk]
+
+
+def _lane_sums(lanes, values, n_lanes):
+    return np.bincount(lanes, weights=values, minlength=n_lanes)[:n_lanes]
+
+
+def interop_path(run_dir, name):
+    path = Path(run_dir, INTEROP_DIR, name)
+    return path if path.is_file() else None
+
+
+def tile_lane_metrics(path):
+    """Cluster density (K/mm2), % passing filter and tile count of every lane in a TileMetricsOut.bin
+
+    Returns:
+        (dict): lane number (int) to {"tiles", "density_k", "pct_pf"}
+    """
+    metrics = InterOpFile(path, 'tile')
+    n_lanes = int(metrics.records['lane'].max()) + 1 if len(metrics.records) else 0
+    density, density_n = np.zeros(n_lanes), np.zeros(n_lanes)
+    clusters, clusters_pf = np.zeros(n_lanes), np.zeros(n_lanes)
+    tiles = [set() for _ in range(n_lanes)]
+    for records in metrics.chunks():
+        lanes = records['lane'].astype(np.intp)
+        if metrics.version == 2:
+            for code, total in ((CLUSTERS_CODE, clusters), (CLUSTERS_PF_CODE, clusters_pf)):
+                is_code = records['code'] == code
+                total += _lane_sums(lanes[is_code], records['value'][is_code], n_lanes)
+            is_density = records['code'] == DENSITY_CODE
+            density += _lane_sums(lanes[is_density], records['value'][is_density], n_lanes)
+            density_n += np.bincount(lanes[is_density], minlength=n_lanes)[:n_lanes]
+        else:
+            is_counts = records['code'] == TILE_COUNTS_CODE
+            lanes, counts = lanes[is_counts], records[is_counts]
+            clusters += _lane_sums(lanes, counts['first'], n_lanes)
+            clusters_pf += _lane_sums(lanes, counts['second'], n_lanes)
+            # density of a tile is its cluster count over the imaged area of a tile in the header
+            density += _lane_sums(lanes, counts['first'] / metrics.header['area'], n_lanes)
+            density_n += np.bincount(lanes, minlength=n_lanes)[:n_lanes]
+        for lane, tile in set(zip(records['lane'].tolist(), records['tile'].tolist())):
+            tiles[lane].add(tile)
+    return {
+        lane: dict(
+            tiles=len(tiles[lane]),
+            density_k=round(float(density[lane] / density_n[lane]) / 1000, 2) if density_n[lane] else None,
+            pct_pf=round(float(100 * clusters_pf[lane] / clusters[lane]), 2) if clusters[lane] else 0.0,
+        )
+        for lane in range(n_lanes) if tiles[lane]
+    }
+
+
+def quality_lane_metrics(path, cycles=None):
+    """% of base calls at or above Q30 of every lane in a QMetricsOut.bin, counted over `cycles` (all
+    cycles if not given). Binned qualities count by the quality a bin is remapped to.
+
+    Returns:
+        (dict): lane number (int) to {"pct_q30"}
+    """
+    metrics = InterOpFile(path, 'quality')
+    n_lanes = int(metrics.records['lane'].max()) + 1 if len(metrics.records) else 0
+    at_q30 = metrics.header['qualities'] >= 30
+    above, total = np.zeros(n_lanes), np.zeros(n_lanes)
+    counted = np.zeros(n_lanes, dtype=bool)
+    for records in metrics.chunks():
+        if cycles is not None:
+            records = records[np.isin(records['cycle'], cycles)]
+        lanes = records['lane'].astype(np.intp)
+        histogram = records['histogram']
+        above += _lane_sums(lanes, histogram[:, at_q30].sum(axis=1, dtype=np.uint64), n_lanes)
+        total += _lane_sums(lanes, histogram.sum(axis=1, dtype=np.uint64), n_lanes)
+        counted[np.unique(lanes)] = True
+    return {lane: dict(pct_q30=round(float(100 * above[lane] / total[lane]), 2) if total[lane] else 0.0)
+            for lane in range(n_lanes) if counted[lane]}
+
+
+def error_lane_metrics(path):
+    """Mean PhiX error rate (%) of every lane in an ErrorMetricsOut.bin
+
+    Returns:
+        (dict): lane number (int) to {"error_rate"}
+    """
+    metrics = InterOpFile(path, 'error')
+    n_lanes = int(metrics.records['lane'].max()) + 1 if len(metrics.records) else 0
+    errors, n_records = np.zeros(n_lanes), np.zeros(n_lanes)
+    for records in metrics.chunks():
+        lanes = records['lane'].astype(np.intp)
+        errors += _lane_sums(lanes, records['error_rate'], n_lanes)
+        n_records += np.bincount(lanes, minlength=n_lanes)[:n_lanes]
+    return {lane: dict(error_rate=round(float(errors[lane] / n_records[lane]), 3)) for lane in range(n_lanes) if n_records[lane]}
+
+
+def extraction_lane_metrics(path):
+    """Mean first cycle intensity and mean focus (FWHM) over the channels of every lane in an ExtractionMetricsOut.bin
+
+    Returns:
+        (dict): lane number (int) to {"intensity_c1", "fwhm"}
+    """
+    metrics = InterOpFile(path, 'extraction')
+    n_lanes = int(metrics.records['lane'].max()) + 1 if len(metrics.records) else 0
+    intensity, n_first = np.zeros(n_lanes), np.zeros(n_lanes)
+    fwhm, n_records = np.zeros(n_lanes), np.zeros(n_lanes)
+    for records in metrics.chunks():
+        lanes = records['lane'].astype(np.intp)
+        fwhm += _lane_sums(lanes, records['fwhm'].mean(axis=1), n_lanes)
+        n_records += np.bincount(lanes, minlength=n_lanes)[:n_lanes]
+        first = records['cycle'] == 1
+        intensity += _lane_sums(lanes[first], records['intensity'][first].mean(axis=1), n_lanes)
+        n_first += np.bincount(lanes[first], minlength=n_lanes)[:n_lanes]
+    return {
+        lane: dict(intensity_c1=round(float(intensity[lane] / n_first[lane]), 1) if n_first[lane] else None,
+                   fwhm=round(float(fwhm[lane] / n_records[lane]), 3))
+        for lane in range(n_lanes) if n_records[lane]
+    }
+
+
+def read_cycles(run_info):
+    """Cycles of the non-index reads of a run, None if RunInfo.xml does not describe its reads"""
+    cycles, first = [], 1
+    for read in (run_info.reads if run_info is not None else []):
+        if not read['is_index']:
+            cycles.extend(range(first, first + read['cycles']))
+        first += read['cycles']
+    return cycles or None
+
+
+def lane_metrics(run_dir, run_info=None):
+    """Per lane metrics of the InterOp files of a run directory. Quality is counted over the non-index reads
+    of `run_info` (an `IllumniaRunInfo`) when given. Metrics of a missing InterOp file are None.
+
+    Returns:
+        (list): dicts of `LANE_COLUMNS` in lane order, empty if the run has no tile metrics
+    """
+    tile_metrics = interop_path(run_dir, TILE_METRICS)
+    if tile_metrics is None:
+        return []
+    lanes = tile_lane_metrics(tile_metrics)
+    readers = (
+        (QUALITY_METRICS, lambda path: quality_lane_metrics(path, read_cycles(run_info))),
+        (ERROR_METRICS, error_lane_metrics),
+        (EXTRACTION_METRICS, extraction_lane_metrics),
+    )
+    for name, reader in readers:
+        path = interop_path(run_dir, name)
+        by_lane = reader(path) if path else {}
+        for lane, metrics in by_lane.items():
+            lanes.setdefault(lane, dict(tiles=0, density_k=None, pct_pf=None)).update(metrics)
+    return [{key: dict(lane=lane, **lanes[lane]).get(key) for key in LANE_COLUMNS} for lane in sorted(lanes)]
+
+
+def failed_lanes(metrics, min_pct_pf=MIN_PCT_PF, min_pct_q30=MIN_PCT_Q30):
+    """Lanes of `lane_metrics` below a threshold, lanes without a metric are not judged on it
+
+    Returns:
+        (dict): lane number (int) to a list of reasons the lane failed
+    """
+    failed = {}
+    for lane in metrics:
+        reasons = []
+        if lane['pct_pf'] is not None and lane['pct_pf'] < min_pct_pf:
+            reasons.append(f"{lane['pct_pf']}% PF < {min_pct_pf}%")
+        if lane['pct_q30'] is not None and lane['pct_q30'] < min_pct_q30:
+            reasons.append(f"{lane['pct_q30']}% >= Q30 < {min_pct_q30}%")
+        if reasons:
+            failed[lane['lane']] = reasons
+    return failed
+
+
+def format_lane_metrics(metrics):
+    """Tab separated table of `lane_metrics`, empty cells for missing metrics"""
+    rows = ['\t'.join(LANE_COLUMNS)]
+    for lane in metrics:
+        rows.append('\t'.join('' if lane[key] is None else str(lane[key]) for key in LANE_COLUMNS))
+    return '\n'.join(rows) + '\n'
+
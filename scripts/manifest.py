@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Compact base call manifests for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import hashlib
+from pathlib import Path
+
+
+# A manifest lists the base call files of a run relative to its BaseCalls directory, one
+# `<relative path>\t<size>` line per file, after a header:
+#   # weave bcl manifest v1
+#   # root <absolute BaseCalls directory>
+#   # files <number of files>
+#   # bytes <total size>
+#   # sha256 <digest of the file lines>
+MANIFEST_MAGIC = '# weave bcl manifest v1'
+MANIFEST_NAME = 'bcl_manifest.tsv'
+
+
+def write_bcl_manifest(path, basecalls, entries):
+    """Write the manifest of the base call files (`(path, size)` pairs) under `basecalls`
+
+    An existing manifest with the same files is left untouched, its modification time is what snakemake 
+    compares demultiplexing outputs against.
+
+    Returns:
+        (dict): manifest header, see `read_manifest_header`
+    """
+    basecalls = Path(basecalls).absolute()
+    # plain string prefixes, Path.relative_to per file dominates the cost of the manifest of a large run
+    root = os.path.join(str(basecalls), '')
+    lines, total, digest = [], 0, hashlib.sha256()
+    for bcl, size in entries:
+        bcl = os.path.abspath(bcl)
+        if not bcl.startswith(root):
+            raise ValueError(f'{bcl} is not under {basecalls}')
+        line = f"{bcl[len(root):]}\t{size}\n"
+        digest.update(line.encode())
+        lines.append(line)
+        total += size
+    header = dict(root=str(basecalls), files=len(lines), bytes=total, sha256=digest.hexdigest())
+    try:
+        if read_manifest_header(path) == header:
+            return header
+    except (OSError, ValueError):
+        pass
+    Path(path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(MANIFEST_MAGIC + '\n')
+        fh.writelines(f"# {key} {value}\n" for key, value in header.items())
+        fh.writelines(lines)
+    return header
+
+
+def read_manifest_header(path):
+    """Header of a manifest without reading its file lines
+
+    Returns:
+        (dict): {"root": BaseCalls directory, "files": number of files, "bytes": total size, "sha256": digest}
+    """
+    header = {}
+    with open(path) as fh:
+        if fh.readline().rstrip('\n') != MANIFEST_MAGIC:
+            raise ValueError(f'{path} is not a base call manifest')
+        for line in fh:
+            if not line.startswith('# '):
+                break
+            key, value = line[2:].rstrip('\n').split(' ', 1)
+            header[key] = int(value) if key in ('files', 'bytes') else value
+    return header
+
+
+def iter_bcl_manifest(path, lane=None, verify=False):
+    """Lazily yield `(absolute path, size)` for the base call files of a manifest, optionally only those
+    of one lane. With `verify` the file lines are checked against the header digest once exhausted."""
+    header, digest = {}, hashlib.sha256()
+    lane_prefix = f"L{int(lane):03d}/" if lane is not None else None
+    with open(path) as fh:
+        if fh.readline().rstrip('\n') != MANIFEST_MAGIC:
+            raise ValueError(f'{path} is not a base call manifest')
+        for line in fh:
+            if line.startswith('# '):
+                key, value = line[2:].rstrip('\n').split(' ', 1)
+                header[key] = value
+                continue
+            if verify:
+                digest.update(line.encode())
+            rel, size = line.rstrip('\n').rsplit('\t', 1)
+            if lane_prefix is None or rel.startswith(lane_prefix):
+                yield Path(header['root'], rel), int(size)
+    if verify and digest.hexdigest() != header.get('sha256'):
+        raise ValueError(f'{path} does not match its checksum, it was modified after it was written')
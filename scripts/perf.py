@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Per rule pipeline performance history for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import re
+import csv
+import json
+import sqlite3
+import statistics
+from time import time
+from pathlib import Path
+from datetime import datetime
+
+from .config import get_state_dir
+from .utils import esc_colors
+from .demuxstats import summarize_demux
+
+
+PERF_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    out_to TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    target TEXT NOT NULL,
+    wall_s REAL,
+    cpu_s REAL,
+    max_rss_mb REAL,
+    io_in_mb REAL,
+    io_out_mb REAL,
+    reads INTEGER,
+    bases INTEGER,
+    run_start REAL,
+    collected REAL NOT NULL,
+    PRIMARY KEY (out_to, rule, target)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    out_to TEXT PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    start REAL,
+    end REAL,
+    reads INTEGER,
+    bases INTEGER,
+    collected REAL NOT NULL
+);
+"""
+BENCHMARK_DIR = Path('logs', 'benchmarks')
+BENCHMARK_FIELDS = {'s': 'wall_s', 'cpu_time': 'cpu_s', 'max_rss': 'max_rss_mb', 'io_in': 'io_in_mb', 'io_out': 'io_out_mb'}
+SNAKEMAKE_TIMESTAMP = re.compile(r'^\[(\w{3} \w{3} +\d+ \d\d:\d\d:\d\d \d{4})\]$')
+MATE_SUFFIX = re.compile(r'_R\d+$')
+# a rule is flagged when its cost per million reads in the latest run exceeds the median of the
+# previous runs by this factor, with at least `REGRESSION_MIN_RUNS` previous runs
+REGRESSION_FACTOR = 1.25
+REGRESSION_MIN_RUNS = 3
+
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_benchmark(tsv):
+    """Mean of the repeats of a snakemake benchmark file
+
+    Returns:
+        (dict): `BENCHMARK_FIELDS` values, None where snakemake could not measure
+    """
+    with open(tsv, newline='') as fh:
+        rows = list(csv.DictReader(fh, delimiter='\t'))
+    measures = {}
+    for field, key in BENCHMARK_FIELDS.items():
+        values = [v for v in (as_float(row.get(field)) for row in rows) if v is not None]
+        measures[key] = statistics.mean(values) if values else None
+    return measures
+
+
+def run_configs(out_to):
+    """Job configuration written by weave for the run in `out_to`, None if it is not a weave output"""
+    configs = sorted(Path(out_to, '.config').glob('config_job_*.json'))
+    if not configs:
+        return None
+    with open(configs[0]) as fh:
+        return json.load(fh)
+
+
+def find_outputs(paths):
+    """Weave run output directories among `paths` and their immediate children"""
+    outputs = []
+    for path in map(Path, paths):
+        if run_configs(path) is not None:
+            outputs.append(path.absolute())
+        elif path.is_dir():
+            outputs.extend(child.absolute() for child in sorted(path.iterdir()) if child.is_dir() and run_configs(child))
+    return outputs
+
+
+def fastp_reads(fastp_json):
+    """(reads, bases) before filtering from a fastp json report"""
+    try:
+        with open(fastp_json) as fh:
+            summary = json.load(fh)['summary']['before_filtering']
+        return int(summary['total_reads']), int(summary['total_bases'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def demux_reads(demux_dir):
+    """Reads demultiplexed (clusters passing filter, undetermined included) from bcl2fastq or
+    bcl-convert statistics in `demux_dir`, None if there are none"""
+    try:
+        rows = summarize_demux(demux_dir)
+    except (OSError, ValueError, TypeError, KeyError, SyntaxError):
+        return None
+    return next((row['reads'] for row in rows if row['level'] == 'run'), None) or None
+
+
+def snakemake_span(out_to):
+    """(start, end) epoch seconds of the snakemake invocations of a run, from the timestamps of the
+    snakemake and master job logs"""
+    stamps = []
+    for log_dir in (Path(out_to, '.snakemake', 'log'), Path(out_to, 'logs', 'masterjob')):
+        if not log_dir.exists():
+            continue
+        for log_file in log_dir.iterdir():
+            if not log_file.is_file() or log_file.suffix not in ('.log', '.out', '.err'):
+                continue
+            with open(log_file, errors='replace') as fh:
+                for line in fh:
+                    match = SNAKEMAKE_TIMESTAMP.match(line.strip())
+                    if match:
+                        try:
+                            stamps.append(datetime.strptime(' '.join(match.group(1).split()), '%a %b %d %H:%M:%S %Y').timestamp())
+                        except ValueError:
+                            continue
+    return (min(stamps), max(stamps)) if stamps else (None, None)
+
+
+class PerfHistory():
+    """History of per job benchmarks of weave runs, stored in the weave state directory"""
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = Path(get_state_dir(), 'perf.sqlite')
+        self.db = sqlite3.connect(str(db_path), timeout=60)
+        self.db.executescript(PERF_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def collect(self, out_to):
+        """Collect the benchmarks of every job of the run in `out_to`, normalized by the reads
+        each job processed (its sample, its lane or the whole run)
+
+        Returns:
+            (int): number of job benchmarks stored
+        """
+        out_to = Path(out_to).absolute()
+        run_config = run_configs(out_to) or {}
+        run_id = run_config.get('run_ids', out_to.name)
+        sid_projects = {sid: project for project, sids in (run_config.get('projects') or {}).items() for sid in sids}
+
+        sample_reads = {sid: fastp_reads(Path(out_to, project, sid, 'fastp', f'{sid}_fastp.json'))
+                        for sid, project in sid_projects.items()}
+        total_reads = demux_reads(Path(out_to, 'demux')) or \
+            sum(reads for reads, _ in sample_reads.values() if reads) or None
+        total_bases = sum(bases for _, bases in sample_reads.values() if bases) or None
+        start, end = snakemake_span(out_to)
+
+        jobs = []
+        for tsv in sorted(Path(out_to, BENCHMARK_DIR).glob('*/**/*.tsv')):
+            rule = tsv.relative_to(Path(out_to, BENCHMARK_DIR)).parts[0]
+            target = str(tsv.relative_to(Path(out_to, BENCHMARK_DIR, rule)).with_suffix(''))
+            try:
+                measures = read_benchmark(tsv)
+            except (OSError, csv.Error):
+                continue
+            name = Path(target).name
+            sid = MATE_SUFFIX.sub('', name)
+            if sid in sample_reads:
+                reads, bases = sample_reads[sid]
+            elif re.fullmatch(r'L\d+', name):
+                reads, bases = demux_reads(Path(out_to, 'demux', 'lanes', name)), None
+            else:
+                reads, bases = total_reads, total_bases
+            jobs.append((str(out_to), run_id, rule, target, measures['wall_s'], measures['cpu_s'], measures['max_rss_mb'],
+                         measures['io_in_mb'], measures['io_out_mb'], reads, bases, start, time()))
+
+        with self.db:
+            self.db.execute('DELETE FROM jobs WHERE out_to = ?', (str(out_to),))
+            self.db.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', jobs)
+            self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (str(out_to), run_id, start, end, total_reads, total_bases, time()))
+        return len(jobs)
+
+    def rule_table(self, out_dirs=None, rules=None):
+        """Per rule wall time, cpu time, peak memory and I/O of the jobs of `out_dirs` (every run if
+        not given), with wall and cpu seconds per million reads"""
+        summary = {}
+        for out_to, rule, wall, cpu, rss, io_in, io_out, reads in self.db.execute(
+                'SELECT out_to, rule, wall_s, cpu_s, max_rss_mb, io_in_mb, io_out_mb, reads FROM jobs'):
+            if (out_dirs and out_to not in out_dirs) or (rules and rule not in rules):
+                continue
+            this_rule = summary.setdefault(rule, dict(jobs=0, runs=set(), wall=[], cpu=[], rss=[], io_in=0.0, io_out=0.0,
+                                                      wall_per_m=[], cpu_per_m=[]))
+            this_rule['jobs'] += 1
+            this_rule['runs'].add(out_to)
+            for key, value in (('wall', wall), ('cpu', cpu), ('rss', rss)):
+                if value is not None:
+                    this_rule[key].append(value)
+            this_rule['io_in'] += io_in or 0
+            this_rule['io_out'] += io_out or 0
+            if reads:
+                if wall is not None:
+                    this_rule['wall_per_m'].append(wall / (reads / 1e6))
+                if cpu is not None:
+                    this_rule['cpu_per_m'].append(cpu / (reads / 1e6))
+        return {rule: dict(
+            runs=len(this_rule['runs']), jobs=this_rule['jobs'],
+            wall_total_h=sum(this_rule['wall']) / 3600, wall_median_s=median(this_rule['wall']),
+            cpu_median_s=median(this_rule['cpu']), max_rss_gb=max(this_rule['rss']) / 1024 if this_rule['rss'] else None,
+            io_in_gb=this_rule['io_in'] / 1024, io_out_gb=this_rule['io_out'] / 1024,
+            wall_per_m=median(this_rule['wall_per_m']), cpu_per_m=median(this_rule['cpu_per_m']),
+        ) for rule, this_rule in sorted(summary.items())}
+
+    def run_table(self, out_dirs=None):
+        """Per run wall clock, summed job cpu time and reads, ordered by run start"""
+        rows = self.db.execute('SELECT r.out_to, r.run_id, r.start, r.end, r.reads, SUM(j.cpu_s), COUNT(j.rule) FROM runs r ' + \
+                               'LEFT JOIN jobs j ON j.out_to = r.out_to GROUP BY r.out_to ORDER BY r.start')
+        return [dict(out_to=out_to, run_id=run_id, start=start, wall_h=(end - start) / 3600 if start and end else None,
+                     cpu_h=cpu / 3600 if cpu else None, reads_m=reads / 1e6 if reads else None, jobs=jobs)
+                for out_to, run_id, start, end, reads, cpu, jobs in rows if not out_dirs or out_to in out_dirs]
+
+    def regressions(self, rules=None):
+        """Rules whose median cpu seconds per million reads in the most recent run exceeds the median
+        of the earlier runs by `REGRESSION_FACTOR`
+
+        Returns:
+            (list): (rule, run id, latest cost, baseline cost) of every flagged rule
+        """
+        per_run = {}
+        for rule, run_id, run_start, cpu, reads in self.db.execute(
+                'SELECT rule, run_id, run_start, cpu_s, reads FROM jobs WHERE cpu_s IS NOT NULL AND reads > 0 ' + \
+                'ORDER BY run_start'):
+            if rules and rule not in rules:
+                continue
+            per_run.setdefault(rule, {}).setdefault((run_start or 0, run_id), []).append(cpu / (reads / 1e6))
+        flagged = []
+        for rule, runs in sorted(per_run.items()):
+            ordered = [(key, median(costs)) for key, costs in sorted(runs.items())]
+            if len(ordered) <= REGRESSION_MIN_RUNS:
+                continue
+            (_, latest_run), latest = ordered[-1]
+            baseline = median([cost for _, cost in ordered[:-1]])
+            if baseline and latest > baseline * REGRESSION_FACTOR:
+                flagged.append((rule, latest_run, latest, baseline))
+        return flagged
+
+
+def median(values):
+    return statistics.median(values) if values else None
+
+
+def fmt(value, spec='.1f'):
+    return format(value, spec) if value is not None else '-'
+
+
+def print_table(header, rows):
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    print(f"{esc_colors.BOLD}{'  '.join(str(h).ljust(w) for h, w in zip(header, widths))}{esc_colors.ENDC}")
+    for row in rows:
+        print('  '.join(str(col).ljust(w) for col, w in zip(row, widths)))
+
+
+def performance(paths, collect=True, rules=None):
+    """Collect benchmarks of the runs under `paths` and report per run and per rule tables along
+    with possible regressions from the whole history
+
+    Returns:
+        (bool): True if any benchmarks could be reported
+    """
+    out_dirs = find_outputs(paths)
+    with PerfHistory() as history:
+        if collect:
+            for out_to in out_dirs:
+                n_jobs = history.collect(out_to)
+                print(f"{esc_colors.OKGREEN}> {esc_colors.ENDC}Collected {n_jobs} job benchmarks for {out_to.name}")
+        selected = {str(out_to) for out_to in out_dirs} or None
+        run_rows = history.run_table(selected)
+        rule_rows = history.rule_table(selected, rules)
+        flagged = history.regressions(rules)
+
+    if not rule_rows:
+        print(f"{esc_colors.WARNING}No job benchmarks found{esc_colors.ENDC}")
+        return False
+
+    print_table(('run', 'started', 'jobs', 'wall (h)', 'cpu (h)', 'reads (M)'), [
+        (row['run_id'], datetime.fromtimestamp(row['start']).strftime('%Y-%m-%d %H:%M') if row['start'] else '-',
+         row['jobs'], fmt(row['wall_h'], '.2f'), fmt(row['cpu_h'], '.2f'), fmt(row['reads_m'])) for row in run_rows
+    ])
+    print()
+    print_table(('rule', 'runs', 'jobs', 'wall total (h)', 'wall median (s)', 'cpu median (s)', 'max rss (GB)',
+                 'io in/out (GB)', 'wall s/M reads', 'cpu s/M reads'), [
+        (rule, row['runs'], row['jobs'], fmt(row['wall_total_h'], '.2f'), fmt(row['wall_median_s']), fmt(row['cpu_median_s']),
+         fmt(row['max_rss_gb'], '.2f'), f"{fmt(row['io_in_gb'])}/{fmt(row['io_out_gb'])}", fmt(row['wall_per_m'], '.2f'),
+         fmt(row['cpu_per_m'], '.2f')) for rule, row in rule_rows.items()
+    ])
+    for rule, run_id, latest, baseline in flagged:
+        print(f"{esc_colors.WARNING}Possible regression: {rule} used {latest:.2f} cpu s/M reads in {run_id}, " + \
+              f"{baseline:.2f} in earlier runs{esc_colors.ENDC}")
+    return True
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Shared registry of aligner indexes of disambiguate genomes for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+from .config import get_resource_config
+
+
+# files of an index per aligner, and the index format they are built for: indexes are shared between aligner
+# releases reading the same format
+ALIGNER_INDEXES = {
+    'bwa': ('bwa-0.7', ('.amb', '.ann', '.bwt', '.pac', '.sa')),
+}
+HASH_CHUNK = 16 * 1024 * 1024
+
+
+def reference_store_dir():
+    """Root of the reference registry, `$WEAVE_REFERENCE_STORE` or the `reference_store` of the host
+    configuration. Indexes of whole genomes do not belong in a home directory, there is no default."""
+    if os.environ.get('WEAVE_REFERENCE_STORE'):
+        return Path(os.environ['WEAVE_REFERENCE_STORE']).absolute()
+    resources = get_resource_config() or {}
+    if resources.get('reference_store'):
+        return Path(resources['reference_store']).absolute()
+    raise ValueError('No reference registry for disambiguate genome indexes, set $WEAVE_REFERENCE_STORE or ' + \
+                     '"reference_store" in the host configuration (config/<host>.json)')
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def has_index(prefix, aligner='bwa'):
+    return all(Path(str(prefix) + suffix).exists() for suffix in ALIGNER_INDEXES[aligner][1])
+
+
+class ReferenceRegistry():
+    """Aligner indexes of genomes keyed by the sha256 of the genome FASTA and the index format of the aligner
+    (`<digest>/<format>/`), built at most once per genome however many runs use it. The digest of every registered FASTA is kept in
+    `index.json`, a FASTA is only hashed again when its size or modification time changes. Writers hold an
+    exclusive lock on the registry. With `dry_run` nothing is written to the registry.
+    """
+    def __init__(self, root=None, dry_run=False):
+        self.root = Path(root).absolute() if root else reference_store_dir()
+        self.dry_run = dry_run
+        if not dry_run:
+            self.root.mkdir(mode=0o775, parents=True, exist_ok=True)
+        self.index_file = Path(self.root, 'index.json')
+
+    @contextmanager
+    def lock(self):
+        with open(Path(self.root, '.lock'), 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def index(self):
+        try:
+            with open(self.index_file) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def digest(self, fasta):
+        """sha256 of a FASTA, from the registry when the file is unchanged since it was last hashed"""
+        fasta = Path(fasta).absolute()
+        stat = fasta.stat()
+        known = self.index().get(str(fasta))
+        if known and known[:2] == [stat.st_size, stat.st_mtime]:
+            return known[2]
+        digest = sha256_file(fasta)
+        if self.dry_run:
+            return digest
+        with self.lock():
+            index = self.index()
+            index[str(fasta)] = [stat.st_size, stat.st_mtime, digest]
+            tmp_index = Path(self.root, f'.index.{os.getpid()}.tmp')
+            with open(tmp_index, 'w') as fh:
+                json.dump(index, fh, indent=4)
+            os.replace(tmp_index, self.index_file)
+        return digest
+
+    def register(self, fasta, aligner='bwa'):
+        """Index of a genome for an aligner, an index already next to the FASTA is used in place
+
+        Returns:
+            (dict): {"fasta", "digest", "prefix": index prefix aligners are given, "dir": registry directory
+                of the index, "ready": True if the index is already built}
+        """
+        fasta = str(Path(fasta).absolute())
+        if has_index(fasta, aligner):
+            return dict(fasta=fasta, digest=None, prefix=fasta, dir=str(Path(fasta).parent), ready=True)
+        digest = self.digest(fasta)
+        index_dir = Path(self.root, digest, ALIGNER_INDEXES[aligner][0])
+        prefix = Path(index_dir, 'genome')
+        # runs bind the genome's registry directory into their containers before the index is built
+        if not self.dry_run:
+            index_dir.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
+        ready = Path(index_dir, '.ready').exists() and has_index(prefix, aligner)
+        return dict(fasta=fasta, digest=digest, prefix=str(prefix), dir=str(index_dir), ready=ready)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Persistent index of sequencing run directories for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import json
+import sqlite3
+from time import time
+from pathlib import Path
+
+from .runinfo import IllumniaRunInfo
+from .config import get_state_dir
+
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    seqroot TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    seqroot TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    rta_complete INTEGER NOT NULL DEFAULT 0,
+    copy_complete INTEGER NOT NULL DEFAULT 0,
+    sample_sheet INTEGER NOT NULL DEFAULT 0,
+    run_info INTEGER NOT NULL DEFAULT 0,
+    runinfo TEXT,
+    PRIMARY KEY (seqroot, path)
+);
+CREATE INDEX IF NOT EXISTS runs_by_name ON runs (seqroot, name);
+CREATE TABLE IF NOT EXISTS demux_state (
+    run_dir TEXT PRIMARY KEY,
+    signature TEXT NOT NULL,
+    attempt TEXT
+);
+"""
+# staged runs modified within this window (seconds) are still checked for CopyComplete.txt
+COPY_COMPLETE_WINDOW = 7 * 24 * 60 * 60
+
+
+def stat_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (FileNotFoundError, PermissionError, NotADirectoryError):
+        return None
+
+
+def list_child_dirs(path):
+    children = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        children.append(entry.path)
+                except OSError:
+                    continue
+    except (FileNotFoundError, PermissionError, NotADirectoryError):
+        pass
+    return children
+
+
+def runinfo_fields(run_dir):
+    """Subset of RunInfo.xml fields stored in the index"""
+    try:
+        run_info = IllumniaRunInfo(Path(run_dir, 'RunInfo.xml'))
+    except Exception:
+        return None
+    return json.dumps(dict(
+        run_id=run_info.run_id, flowcell=run_info.flowcell, instrument=run_info.instrument,
+        date=run_info.date, lanes=run_info.lane_count, cycles=run_info.total_cycles,
+    ))
+
+
+class SequencingRunIndex():
+    """On-disk index of the sequencing run directories under one or more sequencing roots.
+
+    Directories at the first and second level of a sequencing root are indexed by name along with their
+    staging breadcrumbs (RTAComplete.txt, CopyComplete.txt, SampleSheet.csv, RunInfo.xml) and a few
+    parsed RunInfo.xml fields. Refreshing only lists directories whose modification time changed since
+    the last refresh and only re-checks breadcrumbs of runs that were not yet staged, so lookups by
+    run id do not walk the sequencing root.
+
+    """
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = Path(get_state_dir(), 'run_index.sqlite')
+        try:
+            self.db = sqlite3.connect(str(db_path), timeout=60)
+            self.db.executescript(INDEX_SCHEMA)
+        except (sqlite3.Error, OSError):
+            # unwritable state directory, fall back to a throw away index
+            self.db = sqlite3.connect(':memory:')
+            self.db.executescript(INDEX_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def refresh(self, seqroot):
+        """Incrementally bring the index for `seqroot` up to date with the file system"""
+        seqroot = str(Path(seqroot).absolute())
+        known_dirs = dict(self.db.execute('SELECT path, mtime FROM dirs WHERE seqroot = ?', (seqroot,)).fetchall())
+
+        with self.db:
+            root_mtime = stat_mtime(seqroot)
+            if root_mtime is None:
+                self.db.execute('DELETE FROM dirs WHERE seqroot = ?', (seqroot,))
+                self.db.execute('DELETE FROM runs WHERE seqroot = ?', (seqroot,))
+                return
+
+            if known_dirs.get(seqroot) != root_mtime:
+                first_level = list_child_dirs(seqroot)
+                self.sync_children(seqroot, seqroot, first_level)
+                self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (seqroot, seqroot, root_mtime))
+            else:
+                first_level = [path for path in known_dirs if path != seqroot]
+
+            for child in first_level:
+                child_mtime = stat_mtime(child)
+                if child_mtime is None:
+                    self.db.execute('DELETE FROM dirs WHERE path = ?', (child,))
+                    self.db.execute('DELETE FROM runs WHERE seqroot = ? AND parent = ?', (seqroot, child))
+                    continue
+                if known_dirs.get(child) != child_mtime:
+                    self.sync_children(seqroot, child, list_child_dirs(child))
+                    self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (child, seqroot, child_mtime))
+
+            self.refresh_unstaged(seqroot)
+
+    def sync_children(self, seqroot, parent, children):
+        existing = {row[0] for row in self.db.execute('SELECT path FROM runs WHERE seqroot = ? AND parent = ?',
+                                                      (seqroot, parent))}
+        for gone in existing.difference(children):
+            self.db.execute('DELETE FROM runs WHERE seqroot = ? AND path = ?', (seqroot, gone))
+            self.db.execute('DELETE FROM runs WHERE seqroot = ? AND parent = ?', (seqroot, gone))
+            self.db.execute('DELETE FROM dirs WHERE path = ?', (gone,))
+        for child in children:
+            if child in existing:
+                continue
+            self.db.execute('INSERT OR REPLACE INTO runs (seqroot, name, path, parent, mtime) VALUES (?, ?, ?, ?, ?)',
+                            (seqroot, Path(child).name, child, parent, -1))
+
+    def refresh_unstaged(self, seqroot):
+        unstaged = self.db.execute('SELECT path, mtime FROM runs WHERE seqroot = ? AND (NOT ' + \
+                                   '(rta_complete AND sample_sheet AND run_info) OR (NOT copy_complete AND mtime > ?))',
+                                   (seqroot, time() - COPY_COMPLETE_WINDOW)).fetchall()
+        for path, mtime in unstaged:
+            this_mtime = stat_mtime(path)
+            if this_mtime is None or this_mtime == mtime:
+                continue
+            crumbs = [Path(path, crumb).exists() for crumb in
+                      ('RTAComplete.txt', 'CopyComplete.txt', 'SampleSheet.csv', 'RunInfo.xml')]
+            info = runinfo_fields(path) if crumbs[3] else None
+            self.db.execute('UPDATE runs SET mtime = ?, rta_complete = ?, copy_complete = ?, sample_sheet = ?, ' + \
+                            'run_info = ?, runinfo = ? WHERE seqroot = ? AND path = ?',
+                            (this_mtime, *map(int, crumbs), info, seqroot, path))
+
+    def lookup(self, seqroot, name):
+        """Return the `pathlib.Path`s of directories named `name` under `seqroot`"""
+        seqroot = str(Path(seqroot).absolute())
+        rows = self.db.execute('SELECT path FROM runs WHERE seqroot = ? AND name = ? ORDER BY path', (seqroot, name))
+        return [Path(row[0]) for row in rows]
+
+    def staged(self, seqroot, copy_complete=False):
+        """Return the `pathlib.Path`s of staged run directories under `seqroot`"""
+        seqroot = str(Path(seqroot).absolute())
+        query = 'SELECT path FROM runs WHERE seqroot = ? AND rta_complete AND sample_sheet AND run_info'
+        if copy_complete:
+            query += ' AND copy_complete'
+        return [Path(row[0]) for row in self.db.execute(query + ' ORDER BY path', (seqroot,))]
+
+    def info(self, seqroot, path):
+        """Return the indexed breadcrumbs and RunInfo.xml fields of a run directory"""
+        seqroot = str(Path(seqroot).absolute())
+        row = self.db.execute('SELECT rta_complete, copy_complete, sample_sheet, run_info, runinfo FROM runs ' + \
+                              'WHERE seqroot = ? AND path = ?', (seqroot, str(path))).fetchone()
+        if row is None:
+            return None
+        return dict(rta_complete=bool(row[0]), copy_complete=bool(row[1]), sample_sheet=bool(row[2]),
+                    run_info=bool(row[3]), runinfo=json.loads(row[4]) if row[4] else None)
+
+    def get_demux_state(self, run_dir, signature):
+        """Return (hit, attempt) for the cached demultiplexing state of a run directory, a hit only if 
+        the cached directory modification time signature matches `signature`"""
+        row = self.db.execute('SELECT signature, attempt FROM demux_state WHERE run_dir = ?', (str(run_dir),)).fetchone()
+        if row is None or row[0] != signature:
+            return False, None
+        return True, row[1]
+
+    def set_demux_state(self, run_dir, signature, attempt):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO demux_state VALUES (?, ?, ?)',
+                            (str(run_dir), signature, str(attempt) if attempt else None))
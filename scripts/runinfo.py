@@ -0,0 +1,73 @@
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+
+class IllumniaRunInfo():
+    """Class to parse illumnia RunInfo.xml run metadata, the flowcell layout (lanes, surfaces,
+    swaths, tiles) and read structure (cycles per read) needed to derive the binary base call
+    layout of a run without walking the run directory.
+
+    Properties:
+        run_id(str): Run identifier from the `Run` element
+        lanes(list): lane numbers on the flowcell
+        surfaces(list): surface numbers imaged on the flowcell
+        tiles(list): tile names (<lane>_<tile number>), empty if RunInfo.xml does not enumerate tiles
+        total_cycles(int): total number of sequencing cycles across all reads
+
+    """
+    def __init__(self, runinfo):
+        self.path = Path(runinfo).absolute()
+        self.tree = ET.parse(self.path)
+        self.parse_runinfo(self.tree)
+
+    def parse_runinfo(self, tree):
+        run = tree.getroot().find('Run')
+        if run is None:
+            run = ET.Element('Run')
+        self.run_id = run.attrib.get('Id', self.path.parent.name)
+        self.run_number = run.attrib.get('Number', None)
+        self.flowcell = run.findtext('Flowcell')
+        self.instrument = run.findtext('Instrument')
+        self.date = run.findtext('Date')
+
+        self.reads = []
+        for read in run.iter('Read'):
+            self.reads.append(dict(
+                number=int(read.attrib.get('Number', len(self.reads) + 1)),
+                cycles=int(read.attrib.get('NumCycles', 0)),
+                is_index=read.attrib.get('IsIndexedRead', 'N').upper() == 'Y',
+            ))
+
+        layout = run.find('FlowcellLayout')
+        layout_attrs = layout.attrib if layout is not None else {}
+        self.lane_count = int(layout_attrs.get('LaneCount', 1))
+        self.surface_count = int(layout_attrs.get('SurfaceCount', 1))
+        self.swath_count = int(layout_attrs.get('SwathCount', 1))
+        self.tile_count = int(layout_attrs.get('TileCount', 0))
+        self.tiles = [tile.text.strip() for tile in run.iter('Tile') if tile.text and tile.text.strip()]
+
+    def items(self):
+        """Flattened tag to text pairs of the `Run` element children with text values"""
+        return [(info.tag, info.text) for run in self.tree.getroot() for info in run \
+                if info.text is not None and info.text.strip() not in ('\n', '')]
+
+    @property
+    def lanes(self):
+        return list(range(1, self.lane_count + 1))
+
+    @property
+    def surfaces(self):
+        return list(range(1, self.surface_count + 1))
+
+    @property
+    def total_cycles(self):
+        return sum(read['cycles'] for read in self.reads)
+
+    @property
+    def cycles(self):
+        return list(range(1, self.total_cycles + 1))
+
+    def lane_tiles(self, lane):
+        """Tile numbers of a single lane as strings, e.g. `11101`"""
+        prefix = f"{lane}_"
+        return [tile[len(prefix):] for tile in self.tiles if tile.startswith(prefix)]
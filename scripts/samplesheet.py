@@ -1,49 +1,124 @@
-from csv import DictReader
-from io import StringIO
+import csv
 from pathlib import Path
-from datetime import datetime
-from operator import itemgetter
+from collections.abc import Mapping
 from dateutil import parser as dateparser
 
+from . import trace
 
-class AttrDict(dict):
-    def __init__(self, *args, **kwargs):
-        super(AttrDict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
+
+# reformat for consistency between v1 and v2 sample sheets
+DATA_COLUMN_RENAME = {'index': 'Index', 'index2': 'Index2'}
+DATA_SECTIONS = ('Data', 'BCLConvert_Data')
+
+
+class SampleRecord(Mapping):
+    """Single row of a sample sheet data section.
+
+    Records of a section share one column name to position mapping and only hold a tuple of their own
+    values. Empty values are treated as absent, columns are accessible as attributes
+    (`record.Sample_ID`) or as keys (`record['Sample_ID']`).
+
+    """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = tuple(values)
+
+    def _value(self, key):
+        i = self._columns.get(key)
+        if i is None or i >= len(self._values):
+            return ''
+        return self._values[i]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        v = self._value(name)
+        if v == '':
+            raise AttributeError(name)
+        return v
+
+    def __getitem__(self, key):
+        v = self._value(key)
+        if v == '':
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key):
+        return self._value(key) != ''
+
+    def get(self, key, default=None):
+        v = self._value(key)
+        return default if v == '' else v
+
+    def __iter__(self):
+        return (k for k, i in self._columns.items() if i < len(self._values) and self._values[i] != '')
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())})"
 
 
 class IllumniaSampleSheet():
     """Class to parse illumnia sample sheet information according to the
     sample sheet format specified by [Illumina](https://support-docs.illumina.com/SHARE/SampleSheetv2/Content/SHARE/SampleSheetv2/SampleSheetStructure.htm)
 
+    The sheet is read in a single streaming pass, sample rows become `SampleRecord`s and are indexed by
+    project and by lane as they are read.
+
     Properties:
         pairedend(bool): True for paired end seqencing data, False for single end sequencing data
         project(str): Title of the project for this sequencing run
+        projects(list): Titles of all projects in this sequencing run, in sheet order
+        lanes(list): Lanes samples are assigned to, empty if the sheet has no `Lane` column
         run(str): Run Identifer this single sequencing run
 
     """
+    @trace.traced('IllumniaSampleSheet')
     def __init__(self, samplesheet, end=None):
         self.path = Path(samplesheet).absolute()
         self.sheet = self.parse_sheet(samplesheet)
         self.force_endedness = end
         self.validate_sheet()
-    
+        if trace.tracer.enabled:
+            trace.count('sample sheets', files=1, bytes=self.path.stat().st_size)
+
     def parse_sheet(self, sheet):
+        """Stream the sample sheet once, keeping the rows of the small settings sections and turning
+        the rows of the data sections into indexed sample records.
+
+        Returns:
+            (dict): section name to list of raw rows for every non-data section
+        """
         sheet_sections = dict()
-        with open(sheet) as opensheet:
-            this_section = None
-            for _line in opensheet:
-                line = _line.strip()
-                first = _line.split(',')[0]
+        data_sections = dict()
+        with open(sheet, newline='') as opensheet:
+            this_rows = None
+            this_data = None
+            for row in csv.reader(opensheet):
+                if not any(row):
+                    continue
+                first = row[0].strip()
                 if first.startswith('[') and first.endswith(']'):
                     this_section = first[1:-1]
-                    sheet_sections[this_section] = []
-                else:
-                    sheet_sections[this_section].append(line)
+                    if this_section in DATA_SECTIONS:
+                        this_rows, this_data = None, data_sections.setdefault(this_section, [None, []])
+                    else:
+                        this_rows, this_data = sheet_sections.setdefault(this_section, []), None
+                elif this_data is not None:
+                    if this_data[0] is None:
+                        this_data[0] = row
+                    else:
+                        this_data[1].append(row)
+                elif this_rows is not None:
+                    this_rows.append(row)
 
         if 'Header' in sheet_sections:
             self.process_simple_section(sheet_sections['Header'])
-            
+
         if 'Settings' in sheet_sections:
             self.process_simple_section(sheet_sections['Settings'])
 
@@ -54,20 +129,17 @@ class IllumniaSampleSheet():
             norm_names = {'AdapterRead1': 'Read01', 'AdapterRead2': 'Read02'}
             self.process_simple_section(sheet_sections['BCLConvert_Settings'], rename=norm_names)
 
-        if 'Data' not in sheet_sections and 'BCLConvert_Data' in sheet_sections:
-            sheet_sections['Data'] = sheet_sections['BCLConvert_Data']
-
-        assert 'Data' in sheet_sections, 'No sample data within this sample sheet'
-        filtered_data = list(filter(lambda x: len(set(x)) > 1, sheet_sections['Data']))
-        self.process_csv_section(filtered_data)
-
+        data_section = 'Data' if 'Data' in data_sections else 'BCLConvert_Data'
+        assert data_section in data_sections, 'No sample data within this sample sheet'
+        self.data_section = data_section
+        self.process_csv_section(*data_sections[data_section])
+        return sheet_sections
 
     def process_v1_reads_section(self, section):
-        section = [x for x in section if set(x) != {','}]
         r1, r2 = None, None
-        for i, line in enumerate(section):
-            this_line_name = line.split(',')[0]
-            this_line_val = line.split(',')[1]
+        for i, row in enumerate(section):
+            this_line_name = row[0]
+            this_line_val = row[1] if len(row) > 1 else ''
             if this_line_name.lower() in ('read01', 'read02') and this_line_val.isnumeric():
                 if this_line_name.endswith('1') and int(this_line_val) > 0:
                     r1 = int(this_line_val)
@@ -79,76 +151,136 @@ class IllumniaSampleSheet():
                 elif i == 1:
                     r2 = int(this_line_name)
             else:
-                self.process_simple_section([line])
+                self.process_simple_section([row])
         if r1 and r1 > 0:
             setattr(self, 'Read01', r1)
         if r2 and r2 > 0:
             setattr(self, 'Read02', r2)
         return
 
-
     def process_simple_section(self, section, rename=None):
-        """Simple section processing for Illumnia sample sheet. 
+        """Simple section processing for Illumnia sample sheet.
 
         Objective:
-            Disgard rows of all commas, collect rows with single values into self attributes which 
-            are 
+            Disgard rows without a value, collect rows with single values into self attributes which
+            are named after the first column of the row
+
+        A row without a value (`BarcodeMismatchesIndex1,`) leaves its attribute unset, so it reads as
+        absent (`getattr(sheet, name, None)` is None) like a row that is not in the sheet, and the tool
+        default applies. Setting it to '' broke `int()` of mismatch settings and `dateparser` of an empty `Date`.
 
         """
-        for _line in section:
-            index = _line.split(',')[0]
-            if ' ' in index:
-                index = index.replace(' ', '_')
-            if "\n" in _line:
-                _line = _line.replace("\n", ' ')
-            rest = ','.join(_line.split(',')[1:])
-            if set(list(rest)) == ',':
+        for row in section:
+            index = row[0].strip().replace(' ', '_')
+            second = row[1].replace("\n", ' ') if len(row) > 1 else ''
+            if not index or not second:
                 continue
+            if index == 'Date':
+                setattr(self, index, dateparser.parse(second))
             else:
-                second = _line.split(',')[1]
-                if index == 'Date':
-                    setattr(self, index, dateparser.parse(second))
-                else:
-                    if rename and index in rename:
-                        index = rename[index]
-                    setattr(self, index, second)
+                if rename and index in rename:
+                    index = rename[index]
+                setattr(self, index, second)
         return
 
-    def process_csv_section(self, section):
-        section_io = StringIO("\n".join(section))
-        csv_data = []
-        for row in DictReader(section_io, delimiter=','):
-            csv_data.append(AttrDict({k: v for k, v in row.items() if k != '' and v != ''}))
-        
-        # reformat for consistency between v1 and v2 sample sheets
-        for row in csv_data:
-            if 'index' in row:
-                row['Index'] = row['index']
-                del row['index']
-            if 'index2' in row:
-                row['Index2'] = row['index2']
-                del row['index2']
-        setattr(self, 'data', csv_data)
+    def process_csv_section(self, header, rows):
+        """Build sample records for the rows of the data section, indexing them by project and lane"""
+        header = header or []
+        self.data_header = header
+        columns = {}
+        for i, name in enumerate(header):
+            name = name.strip()
+            if name:
+                columns[DATA_COLUMN_RENAME.get(name, name)] = i
 
+        project_i, lane_i = columns.get('Sample_Project'), columns.get('Lane')
+        data, by_project, by_lane = [], {}, {}
+        for row in rows:
+            record = SampleRecord(columns, row)
+            data.append(record)
+            project = row[project_i] if project_i is not None and project_i < len(row) else ''
+            by_project.setdefault(project or None, []).append(record)
+            if lane_i is not None:
+                lane = row[lane_i].strip() if lane_i < len(row) else ''
+                by_lane.setdefault(int(lane) if lane.isdigit() else (lane or None), []).append(record)
+
+        self.data = data
+        self.by_project = by_project
+        self.by_lane = by_lane
+
+    def write(self, path, settings=None, samples=None):
+        """Write this sample sheet to `path`, overriding or adding the `settings` key value pairs in the
+        settings section and only writing the data rows of `samples` if given.
+
+        Returns:
+            (pathlib.Path): path of the written sample sheet
+        """
+        settings_section = 'BCLConvert_Settings' if self.data_section == 'BCLConvert_Data' else 'Settings'
+        sections = dict(self.sheet)
+        if settings and settings_section not in sections:
+            sections[settings_section] = []
+        with open(path, 'w', newline='') as fh:
+            sheet_writer = csv.writer(fh)
+            for name, rows in sections.items():
+                sheet_writer.writerow([f'[{name}]'])
+                pending = {k: str(v) for k, v in settings.items()} if settings and name == settings_section else {}
+                for row in rows:
+                    if row[0].strip() in pending:
+                        row = [row[0], pending.pop(row[0].strip())]
+                    sheet_writer.writerow(row)
+                for key, value in pending.items():
+                    sheet_writer.writerow([key, value])
+                sheet_writer.writerow([])
+            sheet_writer.writerow([f'[{self.data_section}]'])
+            sheet_writer.writerow(self.data_header)
+            for record in (samples if samples is not None else self.data):
+                sheet_writer.writerow(record._values)
+        return Path(path).absolute()
 
     def validate_sheet(self):
-        # this is the space we can do any type of sample sheet validation for running 
+        # this is the space we can do any type of sample sheet validation for running
         # in our snakemake pipelines
         # check values in self.sheet and continue or raise appropriate error
-        for row in self.data:
-            if not getattr(row, 'Sample_Project', None):
-                raise AttributeError("Sample sheet does not have 'Sample_Project' specified for each sample.")
-    
+        if None in self.by_project:
+            raise AttributeError("Sample sheet does not have 'Sample_Project' specified for each sample.")
+
     @property
     def samples(self):
         return getattr(self, 'data', None)
-        
+
+    @property
+    def projects(self):
+        return [project for project in self.by_project if project is not None]
+
     @property
     def project(self):
-        sheet_projects = list(set(map(itemgetter('Sample_Project'), self.data)))
+        sheet_projects = self.projects
         assert len(sheet_projects) == 1, 'Sample sheet containers multiple project, please limit to single project per sheet.'
         return sheet_projects[0]
 
+    @property
+    def lanes(self):
+        return sorted(lane for lane in self.by_lane if isinstance(lane, int))
+
+    def lane_groups(self):
+        """Samples demultiplexed together, by lane. Samples without a lane are part of every lane.
+
+        Returns:
+            (dict): lane number to list of `SampleRecord`s, a single `None` lane for sheets without lanes
+        """
+        if not self.lanes:
+            return {None: list(self.data)}
+        every_lane = self.by_lane.get(None, [])
+        return {lane: self.by_lane[lane] + every_lane for lane in self.lanes}
+
+    def unique_samples(self, samples=None):
+        """First record of every `Sample_ID` in sheet order, the order demultiplexers number samples
+        (S1, S2, ...) in"""
+        seen = dict()
+        for record in (self.data if samples is None else samples):
+            seen.setdefault(record.get('Sample_ID'), record)
+        return list(seen.values())
+
     @property
     def instrument(self):
        return getattr(self, 'Instrument', None)
@@ -156,7 +288,7 @@ class IllumniaSampleSheet():
     @property
     def platform(self):
         return getattr(self, 'InstrumentPlatform', None)
-    
+
     @staticmethod
     def intorlen(s):
         "Cast to int if possible, otherwise get length"
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Input size aware resource sizing of workflow jobs for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import math
+from pathlib import Path
+
+from .runinfo import IllumniaRunInfo
+from .manifest import read_manifest_header
+
+
+# Resources of a rule scale with the gigabytes of base calls its jobs process:
+#   basis "run" the whole run, "lane" one lane unit, "sample" one sample's share of the run.
+# A resource is either a fixed value or {"base", "per_gb", "min", "max"}, memory in MB and runtime in
+# minutes. Host configurations (config/<host>.json) override rules or single resources under "sizing".
+# `WORKLOAD` is not a rule, it holds the parameters of the workload estimate.
+WORKLOAD = "workload"
+DEFAULT_MODEL = {
+    WORKLOAD: {
+        # base call bytes per tile per cycle, used when the base call files of a run are not listed
+        "bytes_per_tile_cycle": 2.5e6,
+    },
+    "bcl2fastq": {
+        "basis": "run",
+        "threads": {"base": 8, "per_gb": 0.25, "max": 34},
+        "mem_mb": {"base": 16000, "per_gb": 128, "max": 128000},
+        "runtime": {"base": 60, "per_gb": 2, "max": 2880},
+    },
+    "bclconvert": {
+        "basis": "run",
+        "threads": {"base": 8, "per_gb": 0.25, "max": 50},
+        "mem_mb": {"base": 16000, "per_gb": 128, "max": 128000},
+        "runtime": {"base": 60, "per_gb": 1.5, "max": 2880},
+    },
+    "stage_base_calls": {
+        "basis": "run",
+        "threads": 8,
+        "mem_mb": 4096,
+        "runtime": {"base": 30, "per_gb": 0.5, "max": 1440},
+    },
+    "bcl2fastq_lane": {
+        "basis": "lane",
+        "threads": {"base": 8, "per_gb": 0.25, "max": 34},
+        "mem_mb": {"base": 16000, "per_gb": 128, "max": 128000},
+        "runtime": {"base": 60, "per_gb": 2, "max": 2880},
+    },
+    "bclconvert_lane": {
+        "basis": "lane",
+        "threads": {"base": 8, "per_gb": 0.25, "max": 50},
+        "mem_mb": {"base": 16000, "per_gb": 128, "max": 128000},
+        "runtime": {"base": 60, "per_gb": 1.5, "max": 2880},
+    },
+    "merge_lane_fastq": {
+        "basis": "sample",
+        "threads": 1,
+        "mem_mb": 2048,
+        "runtime": {"base": 30, "per_gb": 2, "max": 1440},
+    },
+    "merge_lane_undetermined": {
+        "basis": "run",
+        "threads": 1,
+        "mem_mb": 2048,
+        "runtime": {"base": 30, "per_gb": 0.25, "max": 1440},
+    },
+    "subsample_reads": {
+        "basis": "sample",
+        "threads": 1,
+        "mem_mb": 4096,
+        "runtime": {"base": 30, "per_gb": 4, "max": 1440},
+    },
+    "trim_w_fastp": {
+        "basis": "sample",
+        "threads": {"base": 4, "per_gb": 0.5, "max": 16},
+        "mem_mb": {"base": 4096, "per_gb": 256, "max": 32768},
+        "runtime": {"base": 30, "per_gb": 4, "max": 2880},
+    },
+    "fastq_screen": {
+        "basis": "sample",
+        "threads": {"base": 4, "per_gb": 0.5, "max": 16},
+        "mem_mb": {"base": 8192, "per_gb": 128, "max": 32768},
+        "runtime": {"base": 30, "per_gb": 4, "max": 2880},
+    },
+    "fastqc_untrimmed": {
+        "basis": "sample",
+        "threads": 4,
+        "mem_mb": {"base": 4096, "per_gb": 128, "max": 16384},
+        "runtime": {"base": 30, "per_gb": 3, "max": 1440},
+    },
+    "fastq_stats": {
+        "basis": "sample",
+        "threads": 4,
+        "mem_mb": {"base": 2048, "max": 4096},
+        "runtime": {"base": 15, "per_gb": 2, "max": 720},
+    },
+    "fastqc_trimmed": {
+        "basis": "sample",
+        "threads": 4,
+        "mem_mb": {"base": 4096, "per_gb": 128, "max": 16384},
+        "runtime": {"base": 30, "per_gb": 3, "max": 1440},
+    },
+    "kaiju_annotation": {
+        "basis": "sample",
+        "threads": {"base": 8, "per_gb": 2, "max": 24},
+        "mem_mb": 220000,
+        "runtime": {"base": 60, "per_gb": 20, "max": 2880},
+    },
+    "kraken_annotation": {
+        "basis": "sample",
+        "threads": {"base": 8, "per_gb": 2, "max": 24},
+        "mem_mb": 220000,
+        "runtime": {"base": 60, "per_gb": 10, "max": 2880},
+    },
+    "bwa_index": {
+        "basis": "run",
+        "threads": 1,
+        "mem_mb": 16384,
+        "runtime": 8 * 60,
+    },
+    "bwa": {
+        "basis": "sample",
+        "threads": {"base": 8, "per_gb": 2, "max": 32},
+        "mem_mb": {"base": 16384, "per_gb": 1024, "max": 64768},
+        "runtime": {"base": 60, "per_gb": 15, "max": 2880},
+    },
+    "disambiguate": {
+        "basis": "sample",
+        "threads": {"base": 8, "per_gb": 2, "max": 32},
+        "mem_mb": {"base": 16384, "per_gb": 1024, "max": 64768},
+        "runtime": {"base": 60, "per_gb": 10, "max": 2880},
+    },
+    "multiqc_report": {
+        "basis": "run",
+        "threads": 4,
+        "mem_mb": {"base": 8096, "per_gb": 16, "max": 65536},
+        "runtime": {"base": 30, "per_gb": 0.25, "max": 1440},
+    },
+    # snakemake master job, sizes its sbatch header. It waits on every queued job of the run, so it never
+    # gets less than the 5 days it always had and only grows for very large runs.
+    "masterjob": {
+        "basis": "run",
+        "threads": 2,
+        "mem_mb": {"base": 8192, "per_gb": 8, "max": 32768},
+        "runtime": {"base": 720, "per_gb": 6, "min": 7200, "max": 14400},
+    },
+}
+
+
+def merge_model(host_model=None):
+    """Host model overrides layered on `DEFAULT_MODEL`, per rule and per resource"""
+    model = {rule: dict(spec) for rule, spec in DEFAULT_MODEL.items()}
+    for rule, spec in (host_model or {}).items():
+        model.setdefault(rule, {}).update(spec)
+    return model
+
+
+def estimate_workload(run_dir, bcl_manifest=None, n_samples=1, n_lane_units=0, host_model=None):
+    """Estimate the size of a run from RunInfo.xml and the manifest of its base call files, with the
+    `workload` parameters of the host model.
+
+    Returns:
+        (dict): workload of the run::
+
+            {
+                "cycles": total cycles, "lanes": lanes on the flowcell, "tiles": tiles per lane,
+                "bcl_gb": gigabytes of base calls (estimated from the flowcell layout if not listed),
+                "samples": number of samples, "lane_units": number of lane units (0 if not lane sharded)
+            }
+    """
+    run_info = IllumniaRunInfo(Path(run_dir, 'RunInfo.xml')) if Path(run_dir, 'RunInfo.xml').exists() else None
+    cycles = run_info.total_cycles if run_info else 0
+    lanes = run_info.lane_count if run_info else 1
+    if run_info and run_info.tiles:
+        tiles = len(run_info.tiles) // max(lanes, 1)
+    else:
+        tiles = (run_info.surface_count * run_info.swath_count * run_info.tile_count) if run_info else 0
+    size = read_manifest_header(bcl_manifest)['bytes'] if bcl_manifest and Path(bcl_manifest).exists() else 0
+    if not size:
+        size = lanes * tiles * cycles * merge_model(host_model)[WORKLOAD]['bytes_per_tile_cycle']
+    return dict(cycles=cycles, lanes=lanes, tiles=tiles, bcl_gb=size / 1e9, samples=max(int(n_samples), 1),
+                lane_units=int(n_lane_units))
+
+
+def scale(spec, gb):
+    if not isinstance(spec, dict):
+        return spec
+    value = spec.get('base', 0) + spec.get('per_gb', 0) * gb
+    value = max(value, spec.get('min', value))
+    value = min(value, spec.get('max', value))
+    return int(math.ceil(round(value, 3)))
+
+
+def size_rules(workload, host_model=None):
+    """Threads, memory and runtime of every rule for a workload.
+
+    Returns:
+        (dict): rule name to {"threads", "mem_mb", "runtime"}
+    """
+    run_gb = workload['bcl_gb']
+    basis_gb = {
+        'run': run_gb,
+        'lane': run_gb / max(workload['lane_units'] or workload['lanes'], 1),
+        'sample': run_gb / workload['samples'],
+    }
+    sized = {}
+    for rule, spec in merge_model(host_model).items():
+        if rule == WORKLOAD:
+            continue
+        gb = basis_gb.get(spec.get('basis', 'run'), run_gb)
+        sized[rule] = {key: scale(spec[key], gb) for key in ('threads', 'mem_mb', 'runtime') if key in spec}
+    return sized
+
+
+def sbatch_opts(resources):
+    """Master job sbatch header options for sized resources"""
+    minutes = int(resources.get('runtime', 0))
+    opts = {}
+    if 'threads' in resources:
+        opts['cpus-per-task'] = resources['threads']
+    if 'mem_mb' in resources:
+        opts['mem'] = f"{int(math.ceil(resources['mem_mb'] / 1024))}g"
+    if minutes:
+        opts['time'] = f"{minutes // 1440:02d}-{minutes % 1440 // 60:02d}:{minutes % 60:02d}:00"
+    return opts
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Node-local scratch staging of demultiplexing inputs for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import shutil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from . import trace
+from .manifest import iter_bcl_manifest
+
+
+# run metadata demultiplexers read besides the base calls
+STAGE_METADATA = ('RunInfo.xml', 'RunParameters.xml', 'runParameters.xml')
+# scratch needed for the staged inputs plus the demultiplexed outputs, relative to the input size
+STAGE_SPACE_FACTOR = 2.2
+# written last into the scratch copy of a run, demultiplexing jobs only read from a verified copy
+STAGE_VERIFIED = '.verified'
+
+
+def top_level_files(directory):
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        files.append((entry.path, entry.stat().st_size))
+                except OSError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return files
+
+
+def stage_files(run_dir, bcl_manifest, lane=None):
+    """Files a demultiplexer reads from a run directory: run metadata, base calls, and the filter,
+    position and control files next to them, optionally limited to a single lane.
+
+    Returns:
+        (list): (path relative to `run_dir`, size in bytes) for every file
+    """
+    run_dir = Path(run_dir).absolute()
+    intensities = Path(run_dir, 'Data', 'Intensities')
+    lane_dir = f"L{int(lane):03d}" if lane is not None else None
+
+    files = [f for f in top_level_files(run_dir) if Path(f[0]).name in STAGE_METADATA]
+    files.extend(top_level_files(intensities))
+    for base in (intensities, Path(intensities, 'BaseCalls')):
+        if lane_dir:
+            lane_dirs = [lane_dir]
+        else:
+            lane_dirs = sorted(d for d in os.listdir(base) if d.startswith('L')) if base.exists() else []
+        for this_lane in lane_dirs:
+            files.extend(top_level_files(Path(base, this_lane)))
+
+    files.extend((str(bcl), size) for bcl, size in iter_bcl_manifest(bcl_manifest, lane=lane))
+
+    staged, seen = [], set()
+    for path, size in files:
+        rel = os.path.relpath(path, run_dir)
+        if rel not in seen:
+            seen.add(rel)
+            staged.append((rel, size))
+    return staged
+
+
+def write_stage_manifest(path, entries):
+    """Write a staging manifest, one `<relative path>\\t<size>` line per file
+
+    Returns:
+        (int): total bytes of the staged files
+    """
+    Path(path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(path, 'w') as fh:
+        for rel, size in entries:
+            fh.write(f"{rel}\t{size}\n")
+    return sum(size for _, size in entries)
+
+
+@trace.traced()
+def plan_staging(run_dir, bcl_manifest, config_dir, lanes=None):
+    """Write the staging manifest of a run (`stage_manifest.tsv`), or of each of its lane units
+    (`stage_manifest_L<lane>.tsv`) when lane sharded
+
+    Returns:
+        (dict): demultiplexing unit ("run" or the lane) to its manifest path, bytes staged and 
+            the scratch space (KB) staging needs
+    """
+    if lanes:
+        units = [(str(lane), lane, f'stage_manifest_L{lane}.tsv') for lane in lanes]
+    else:
+        units = [('run', None, 'stage_manifest.tsv')]
+    plans = {}
+    for unit, lane, name in units:
+        manifest = Path(config_dir, name).absolute()
+        entries = stage_files(run_dir, bcl_manifest, lane=lane)
+        total = write_stage_manifest(manifest, entries)
+        trace.count('staged files', files=len(entries), bytes=total)
+        plans[unit] = dict(manifest=str(manifest), bytes=total, need_kb=int(total * STAGE_SPACE_FACTOR / 1024) + 1)
+    return plans
+
+
+def read_stage_manifest(path):
+    """Entries of a staging manifest
+
+    Returns:
+        (list): (path relative to the run directory, size in bytes) for every file
+    """
+    with open(path) as fh:
+        return [(rel, int(size)) for rel, size in (line.rstrip('\n').split('\t') for line in fh if line.strip())]
+
+
+def scratch_dir(name):
+    """Node-local scratch directory of a staged demultiplexing unit, under `$TMPDIR`"""
+    return Path(os.environ.get('TMPDIR') or '/tmp', f"weave_stage_{name}")
+
+
+def stage_in(manifest, run_dir, stage_dir, need_kb, workers=8):
+    """Copy the files of a staging manifest from `run_dir` to `<stage_dir>/run` with parallel copy workers,
+    verify every file's size against the manifest and mark the copy verified. Staging is skipped, and any
+    earlier copy removed, when scratch has `need_kb` KB or less free.
+
+    Returns:
+        (bool): True if the run was staged
+    """
+    stage_dir = Path(stage_dir)
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    stage_dir.parent.mkdir(parents=True, exist_ok=True)
+    avail_kb = shutil.disk_usage(stage_dir.parent).free // 1024
+    if avail_kb <= need_kb:
+        print(f"staging: skipped, {avail_kb} KB free in {stage_dir.parent} and {need_kb} KB needed")
+        return False
+
+    entries = read_stage_manifest(manifest)
+    staged = Path(stage_dir, 'run')
+    for parent in sorted({Path(staged, rel).parent for rel, _ in entries}):
+        parent.mkdir(parents=True, exist_ok=True)
+    Path(stage_dir, 'out').mkdir()
+
+    def copy_verified(entry):
+        rel, size = entry
+        dest = Path(staged, rel)
+        shutil.copy2(Path(run_dir, rel), dest)
+        return rel if dest.stat().st_size != size else None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        mismatched = [rel for rel in pool.map(copy_verified, entries) if rel]
+    if mismatched:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        raise ValueError(f"staging: size verification of {staged} failed for {len(mismatched)} files, e.g. {mismatched[0]}")
+    Path(stage_dir, STAGE_VERIFIED).touch()
+    return True
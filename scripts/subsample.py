@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Seeded reservoir sampling of fastq reads for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import gzip
+import zlib
+import random
+from math import exp, log, floor
+from itertools import islice, count, zip_longest
+from collections import deque
+from pathlib import Path
+
+
+# reads (read pairs for paired end samples) kept per sample by fast QC
+DEFAULT_SAMPLE_READS = 250000
+DEFAULT_SEED = 0
+
+
+def sample_seed(seed, sample_id):
+    """Seed of a sample's sampler, stable across python processes and versions"""
+    return zlib.crc32(f"{seed}:{sample_id}".encode())
+
+
+def fastq_records(fastq):
+    """Stream the records of a (gzipped) fastq as tuples of their four lines, a truncated last record raises"""
+    opener = gzip.open if str(fastq).endswith('.gz') else open
+    with opener(fastq, 'rb') as fh:
+        for record in zip_longest(*[iter(fh)] * 4):
+            if record[3] is None:
+                raise ValueError(f"Truncated last record in {fastq}")
+            yield record
+
+
+def mate_records(mates, sample_id=''):
+    """Records of the mates of a sample in lockstep, mates running out of records at different points raise"""
+    for records in zip_longest(*mates):
+        if None in records:
+            raise ValueError(f"Mates of sample {sample_id} have different numbers of reads")
+        yield records
+
+
+def reservoir_sample(in_reads, out_reads, n_reads=DEFAULT_SAMPLE_READS, seed=DEFAULT_SEED, sample_id='', report=None):
+    """Uniformly sample `n_reads` records in a single streaming pass over the mates of a sample (R1, R2, ...)
+    with Li's algorithm L, mates are sampled in lockstep so pairs stay together. Skipped records are never
+    copied, the selection only depends on `seed`, `sample_id` and the reads. Sampled reads are written in
+    their original order, every read is kept when the sample has fewer than `n_reads`.
+
+    Returns:
+        (dict): {"sample", "reads": reads in the input, "sampled": reads written, "seed"}
+    """
+    if len(in_reads) != len(out_reads):
+        raise ValueError('Every input mate needs an output')
+    rng = random.Random(sample_seed(seed, sample_id))
+    uniform = lambda: rng.random() or 5e-324
+    mates = [fastq_records(fastq) for fastq in in_reads]
+    # the counter is only advanced for records the mates yield, it ends at the number of reads
+    counter = count()
+    indexed = zip(mate_records(mates, sample_id), counter)
+
+    reservoir = list(islice(indexed, n_reads))
+    if len(reservoir) == n_reads and n_reads > 0:
+        w = exp(log(uniform()) / n_reads)
+        while True:
+            # skip ahead to the next record that enters the reservoir
+            deque(islice(indexed, floor(log(uniform()) / log(1 - w))), maxlen=0)
+            record = next(indexed, None)
+            if record is None:
+                break
+            reservoir[rng.randrange(n_reads)] = record
+            w *= exp(log(uniform()) / n_reads)
+    total = next(counter)
+
+    reservoir.sort(key=lambda record: record[1])
+    for mate, out_fastq in enumerate(out_reads):
+        Path(out_fastq).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with gzip.open(out_fastq, 'wb', compresslevel=1) as fo:
+            for records, _ in reservoir:
+                lines = records[mate]
+                fo.write(b''.join(lines) if lines[3].endswith(b'\n') else b''.join(lines) + b'\n')
+
+    sampled = dict(sample=sample_id, reads=total, sampled=len(reservoir), seed=seed)
+    if report:
+        write_sampling_report(report, sampled)
+    return sampled
+
+
+def write_sampling_report(path, sampled):
+    """MultiQC custom content table marking the QC of a sample as run on a sample of its reads, tables of
+    every sample share an id and are merged into one report section"""
+    fraction = sampled['sampled'] / sampled['reads'] if sampled['reads'] else 0
+    with open(path, 'w') as fh:
+        fh.write("# id: 'qc_sampling'\n")
+        fh.write("# section_name: 'Sampled QC'\n")
+        fh.write("# description: 'QC/QA of these samples ran on a seeded uniform sample of their reads (weave --qc-mode fast), " + \
+                 "metrics describe the sample and not every read.'\n")
+        fh.write("# plot_type: 'table'\n")
+        fh.write("Sample\tReads\tSampled reads\tFraction sampled\tSeed\n")
+        fh.write(f"{sampled['sample']}\t{sampled['reads']}\t{sampled['sampled']}\t{fraction:.4f}\t{sampled['seed']}\n")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Phase tracing of the weave command line for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import os
+import json
+import threading
+import functools
+from time import perf_counter
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Tracer():
+    """Records spans and counters in the Chrome trace event format (chrome://tracing, ui.perfetto.dev),
+    nothing is recorded until `enable` is called"""
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = {}
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.start = perf_counter()
+
+    def now(self):
+        return (perf_counter() - self.start) * 1e6
+
+    def thread(self):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append(dict(name='thread_name', ph='M', pid=os.getpid(), tid=tid,
+                                    args=dict(name=threading.current_thread().name)))
+        return tid
+
+    def enable(self):
+        self.enabled = True
+        self.start = perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block as a complete event, `args` can be extended inside the block"""
+        if not self.enabled:
+            yield args
+            return
+        begin = self.now()
+        try:
+            yield args
+        finally:
+            end = self.now()
+            with self.lock:
+                self.events.append(dict(name=name, cat='weave', ph='X', ts=begin, dur=end - begin, pid=os.getpid(),
+                                        tid=self.thread(), args={k: str(v) if isinstance(v, Path) else v for k, v in args.items()}))
+
+    def count(self, name, **increments):
+        """Add to the running totals of a counter (e.g. files=1, bytes=size)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            totals = self.counters.setdefault(name, {})
+            for key, value in increments.items():
+                totals[key] = totals.get(key, 0) + value
+            self.events.append(dict(name=name, ph='C', ts=self.now(), pid=os.getpid(), tid=self.thread(), args=dict(totals)))
+
+    def write(self, path):
+        """Write the recorded events to `path` as a Chrome trace"""
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as fh:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms', otherData=dict(counters=self.counters)), fh)
+
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
+
+
+def traced(name=None):
+    """Decorator recording every call of a function as a span"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -10,17 +10,22 @@ import yaml
 import sys
 import textwrap
 from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from dateutil.parser import parse as date_parser
 from subprocess import Popen, PIPE, STDOUT
 from pathlib import Path, PurePath
 
 # ~~~ internals ~~~
+from . import trace
 from .files import parse_samplesheet, mk_or_pass_dirs
+from .images import ImageStore, singularity_cache_dir
+from .sizing import estimate_workload, size_rules, sbatch_opts as sized_sbatch_opts
 from .config import SNAKEFILE, DIRECTORY_CONFIGS, \
     GENOME_CONFIGS, get_current_server, get_resource_config, get_tmp_dir
 
 
-host = get_current_server()
+stdout_lock = Lock()
 
 
 class esc_colors:
@@ -96,7 +101,39 @@ def valid_run_input(run):
     raise ArgumentTypeError("Invalid run value, neither an id or existing path: " + str(run))
 
 
-def exec_snakemake(popen_cmd, local=False, dry_run=False, env=None, cwd=None):
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid value {value}, expected a positive integer")
+    if number < 1:
+        raise ArgumentTypeError(f"Invalid value {value}, expected a positive integer")
+    return number
+
+
+def percentage(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid value {value}, expected a percentage")
+    if not 0 <= number <= 100:
+        raise ArgumentTypeError(f"Invalid value {value}, expected a percentage between 0 and 100")
+    return number
+
+
+def write_prefixed(text, prefix=None):
+    """Write a block of output to stdout, optionally prefixing each line with
+    a run label, while holding the stdout lock so concurrent runs do not
+    interleave partial lines.
+    """
+    if prefix:
+        text = ''.join(f"{esc_colors.OKCYAN}[{prefix}]{esc_colors.ENDC} {_line}" for _line in text.splitlines(keepends=True))
+    with stdout_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def exec_snakemake(popen_cmd, local=False, dry_run=False, env=None, cwd=None, prefix=None, sbatch_opts=None):
     # async execution w/ filter: 
     #   - https://gist.github.com/DGrady/b713db14a27be0e4e8b2ffc351051c7c
     #   - https://lysator.liu.se/~bellman/download/asyncproc.py
@@ -123,51 +160,77 @@ def exec_snakemake(popen_cmd, local=False, dry_run=False, env=None, cwd=None):
             jid_search = re.search(r"external jobid \'(\d+)\'", lutf8, re.MULTILINE)
             if jid_search:
                 parent_jobid = int(jid_search.group(1))
-            sys.stdout.write(lutf8)
+            write_prefixed(lutf8, prefix)
         snakemake_run_out, _ = proc.communicate()
+        success = proc.returncode == 0
     else:
-        jobscript = mk_sbatch_script(cwd, ' '.join([str(x) for x in popen_cmd]))
-        proc = Popen(['sbatch', jobscript], stdout=PIPE, stderr=STDOUT, **popen_kwargs)
-        snakemake_run_out, _ = proc.communicate()
-        jid_search = re.search(r"(\d{5,10})", snakemake_run_out.decode('utf-8'), re.MULTILINE)
-        if jid_search:
-            parent_jobid = jid_search.group(1)
+        jobscript = mk_sbatch_script(cwd, ' '.join([str(x) for x in popen_cmd]), sbatch_opts=sbatch_opts)
+        success, parent_jobid, sbatch_out = submit_sbatch(jobscript, cwd=popen_kwargs['cwd'], env=popen_kwargs['env'])
+        if not success:
+            write_prefixed(sbatch_out, prefix)
     mode = "local" if local or dry_run else "headless"
     if parent_jobid:
-        print(f"{esc_colors.OKGREEN}> {esc_colors.ENDC} Master job submitted in '{mode}' mode on job {esc_colors.OKGREEN}{str(parent_jobid)}{esc_colors.ENDC}")
-    return proc.returncode == 0, parent_jobid
+        write_prefixed(f"{esc_colors.OKGREEN}> {esc_colors.ENDC} Master job submitted in '{mode}' mode on job {esc_colors.OKGREEN}{str(parent_jobid)}{esc_colors.ENDC}\n", prefix)
+    return success, parent_jobid
+
+
+def mk_sbatch_script(wd, cmd, job_name='weave_masterjob', log_dir='masterjob', script_name='master_jobscript.sh', sbatch_opts=None):
+    """
+        Write a slurm batch script that loads the pipeline dependencies and executes `cmd`.
 
+        The header defaults to the master job request (2 cpus, 16g, 5 days), any `sbatch_opts` 
+        (e.g. {'mem': '32g', 'array': '0-9'}) override or extend it.
 
-def mk_sbatch_script(wd, cmd):
-    if not Path(wd, 'logs', 'masterjob').exists():
-        Path(wd, 'logs', 'masterjob').mkdir(mode=0o755, parents=True)
+        Returns:
+            (pathlib.Path): absolute path to the batch script
+    """
+    if not Path(wd, 'logs', log_dir).exists():
+        Path(wd, 'logs', log_dir).mkdir(mode=0o755, parents=True)
     tmp_dir = get_tmp_dir(get_current_server())
+    header_opts = {'ntasks': 1, 'cpus-per-task': 2, 'time': '05-00:00:00', 'export': 'ALL', 'mem': '16g'}
+    header_opts.update(sbatch_opts or {})
+    log_name = '%x_%A_%a' if 'array' in header_opts else '%x_%j'
     master_job_script = \
     f"""#!/bin/bash --login
-    #SBATCH --job-name=weave_masterjob
-    #SBATCH --output={wd}/logs/masterjob/%x_%j.out
-    #SBATCH --error={wd}/logs/masterjob/%x_%j.err
-    #SBATCH --ntasks=1
-    #SBATCH --cpus-per-task=2
-    #SBATCH --time=05-00:00:00
-    #SBATCH --export=ALL
-    #SBATCH --mem=16g
-    #SBATCH -vvv
+    #SBATCH --job-name={job_name}
+    #SBATCH --output={wd}/logs/{log_dir}/{log_name}.out
+    #SBATCH --error={wd}/logs/{log_dir}/{log_name}.err
     """.lstrip()
+    master_job_script += ''.join(f"#SBATCH --{opt}={val}\n" for opt, val in header_opts.items())
+    master_job_script += "#SBATCH -vvv\n"
     master_job_script += get_mods(init=True) + "\n"
     master_job_script += f"if [ ! -d \"{tmp_dir}\" ]; then mkdir -p \"{tmp_dir}\"; fi\n"
     master_job_script += cmd
     master_job_script = '\n'.join([x.lstrip() for x in master_job_script.split('\n')])
-    master_script_location = Path(wd, 'logs', 'masterjob', 'master_jobscript.sh').absolute()
+    master_script_location = Path(wd, 'logs', log_dir, script_name).absolute()
     master_script_location.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
     with open(master_script_location, 'w') as fo:
         fo.write(master_job_script)
     return master_script_location
 
 
+def submit_sbatch(jobscript, cwd=None, env=None, dependency=None):
+    """
+        Submit a batch script with sbatch
+
+        Returns:
+            (tuple): (bool submission succeeded, str job id or None, str sbatch output)
+    """
+    sbatch_cmd = ['sbatch']
+    if dependency:
+        sbatch_cmd.append(f'--dependency={dependency}')
+    sbatch_cmd.append(str(jobscript))
+    proc = Popen(sbatch_cmd, stdout=PIPE, stderr=STDOUT, cwd=cwd or str(Path.cwd()), env=env or None)
+    sbatch_out, _ = proc.communicate()
+    sbatch_out = sbatch_out.decode('utf-8')
+    jid_search = re.search(r"(\d{5,10})", sbatch_out, re.MULTILINE)
+    return proc.returncode == 0, jid_search.group(1) if jid_search else None, sbatch_out
+
+
 def get_mods(init=False):
     mods_needed = ['snakemake', 'singularity']
     mod_cmd = []
+    host = get_current_server()
 
     if host == 'bigsky':
         mod_cmd.append('source /gs1/apps/user/rmlspack/share/spack/setup-env.sh')
@@ -185,6 +248,7 @@ def get_mods(init=False):
     return '; '.join(mod_cmd)
 
 
+@trace.traced()
 def get_mounts(*extras):
     mount_binds = []
     resources = get_resource_config()
@@ -222,15 +286,23 @@ def get_mounts(*extras):
         mounts.append(file_from + ':' + file_to + ':' + mode)
     
     mounts.append(r'\$TMPDIR:/tmp:rw')
+    trace.count('mounts', binds=len(mounts))
 
     return ','.join(mounts)
 
 
-def exec_pipeline(configs, dry_run=False, local=False):
+@trace.traced()
+def exec_pipeline(configs, dry_run=False, local=False, jobs=1):
     """
         Execute the BCL->FASTQ pipeline.
 
-        This executes the pipeline.
+        Builds the per-run configuration and snakemake command for every run,
+        then dispatches them concurrently with at most `jobs` runs in flight.
+        Output from each run is prefixed with its run id when more than one
+        run is dispatched.
+
+        Returns:
+            (bool): True if every run executed or submitted successfully
     """
     this_instrument = 'Illumnia'
     snake_file = SNAKEFILE[this_instrument]['ngs_qc']
@@ -239,15 +311,30 @@ def exec_pipeline(configs, dry_run=False, local=False):
     if Path(fastq_demux_profile, 'config.yaml').exists():
         profile_config.update(yaml.safe_load(open(Path(fastq_demux_profile, 'config.yaml'))))
 
-    top_singularity_dirs = [Path(c_dir, '.singularity').absolute() for c_dir in configs['out_to']]
     top_config_dirs = [Path(c_dir, '.config').absolute() for c_dir in configs['out_to']]
-    _dirs = top_singularity_dirs + top_config_dirs
-    mk_or_pass_dirs(*_dirs)
-    skip_config_keys = ('resources', 'runqc', 'use_scratch')
+    mk_or_pass_dirs(*top_config_dirs)
+    skip_config_keys = ('resources', 'runqc', 'use_scratch', 'qc_sampling', 'qc_stats', 'disambiguate_engine')
+
+    # ~~~ images from the host image store, shared by every run ~~~
+    image_store = ImageStore()
+    with trace.span('resolve images'):
+        containers = image_store.resolve((configs.get('resources') or {}).get('sif'), populate=not dry_run)
 
+    dispatches = []
     for i in range(0, len(configs['run_ids'])):
         this_config = {k: (v[i] if k not in skip_config_keys else v) for k, v in configs.items() if v}
         this_config.update(profile_config)
+        this_config['containers'] = containers
+
+        # ~~~ input size aware rule resources ~~~
+        host_model = (this_config.get('resources') or {}).get('sizing')
+        with trace.span('estimate_workload', run=this_config['run_ids']):
+            workload = estimate_workload(this_config['demux_input_dir'], bcl_manifest=this_config.get('bcl_manifest'), 
+                                         n_samples=len(this_config['sids']), n_lane_units=len(this_config.get('demux_lanes') or {}),
+                                         host_model=host_model)
+        this_config['rule_resources'] = size_rules(workload, host_model)
+        print(f"{esc_colors.OKGREEN}> {esc_colors.ENDC}Sized run {this_config['run_ids']} for {workload['bcl_gb']:.1f} GB of " + \
+              f"base calls ({workload['lanes']} lanes, {workload['cycles']} cycles, {workload['samples']} samples)")
 
         extra_to_mount = [this_config['out_to'], this_config['demux_input_dir']]
         if this_config['bclconvert']:
@@ -258,13 +345,20 @@ def exec_pipeline(configs, dry_run=False, local=False):
         if this_config.get('disambiguate', False):
             extra_to_mount.append(Path(this_config['host_genome']).parent)
             extra_to_mount.append(Path(this_config['pathogen_genome']).parent)
+            for index_key in ('host_index', 'pathogen_index'):
+                if this_config[index_key]['digest'] and not dry_run:
+                    # registry directory of the genome, the index is built in it, dry runs do not create it
+                    extra_to_mount.append(Path(this_config[index_key]['dir']).parent)
+            if this_config.get('disambiguate_engine') == 'weave':
+                # the engine runs from this directory in the ngsqc container
+                extra_to_mount.append(Path(__file__).resolve().parent)
         singularity_binds = get_mounts(*extra_to_mount)
         config_file = Path(this_config['out_to'], '.config', f'config_job_{str(i)}.json').absolute()
         json.dump(this_config, open(config_file, 'w'), cls=PathJSONEncoder, indent=4)
         top_env = {}
         top_env['PATH'] = os.environ["PATH"]
         top_env['SNK_CONFIG'] = str(config_file.absolute())
-        top_env['SINGULARITY_CACHEDIR'] = str(Path(this_config['out_to'], '.singularity').absolute())
+        top_env['SINGULARITY_CACHEDIR'] = str(singularity_cache_dir())
         this_cmd = [
             "snakemake", "-p", "--use-singularity", "--rerun-incomplete", "--keep-incomplete",
             "--rerun-triggers", "mtime", "--verbose", "-s", snake_file,
@@ -284,7 +378,48 @@ def exec_pipeline(configs, dry_run=False, local=False):
                   f"{esc_colors.OKGREEN}{this_config['run_ids']}{esc_colors.ENDC}...")
 
         print(' '.join(map(str, this_cmd)))
-        exec_snakemake(this_cmd, local=local, dry_run=dry_run, env=top_env, cwd=str(Path(this_config['out_to']).absolute()))
+        dispatches.append((this_config['run_ids'], this_cmd, top_env, str(Path(this_config['out_to']).absolute()),
+                           sized_sbatch_opts(this_config['rule_resources'].get('masterjob', {}))))
+
+    return dispatch_runs(dispatches, local=local, dry_run=dry_run, jobs=jobs)
+
+
+def dispatch_runs(dispatches, local=False, dry_run=False, jobs=1):
+    """
+        Concurrently execute a collection of snakemake invocations.
+
+        Each dispatch is a tuple of (run id, snakemake command, environment, working directory, master job 
+        sbatch options). At most
+        `jobs` dispatches are in flight at once, in local mode each one is a blocking snakemake process, in
+        headless mode each one is an sbatch submission of a master job.
+
+        Returns:
+            (bool): True if every dispatch succeeded
+    """
+    jobs = max(1, min(int(jobs or 1), len(dispatches) or 1))
+    use_prefix = len(dispatches) > 1
+
+    def _dispatch(this_dispatch):
+        run_id, this_cmd, this_env, this_cwd, this_sbatch_opts = this_dispatch
+        try:
+            with trace.span('exec_snakemake', run=run_id, local=local, dry_run=dry_run):
+                return exec_snakemake(this_cmd, local=local, dry_run=dry_run, env=this_env, cwd=this_cwd, 
+                                      prefix=run_id if use_prefix else None, sbatch_opts=this_sbatch_opts)
+        except OSError as error:
+            write_prefixed(f"{esc_colors.FAIL}{error}{esc_colors.ENDC}\n", run_id if use_prefix else None)
+            return False, None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_dispatch, dispatches))
+
+    if use_prefix:
+        print(f"{esc_colors.BOLD}Run summary:{esc_colors.ENDC}")
+        for (run_id, *_), (success, jobid) in zip(dispatches, results):
+            status = f"{esc_colors.OKGREEN}ok{esc_colors.ENDC}" if success else f"{esc_colors.FAIL}failed{esc_colors.ENDC}"
+            job_msg = f" (job {jobid})" if jobid else ""
+            print(f"\t{run_id}: {status}{job_msg}")
+
+    return all(success for success, _ in results)
 
 
 def is_bclconvert(samplesheet):
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Watch sequencing roots and launch runs as they are staged for the Dmux software package
+# ~~~~~~~~~~~~~~~
+import signal
+import sqlite3
+import traceback
+from time import time, sleep
+from pathlib import Path
+
+from .config import get_state_dir
+from .runindex import SequencingRunIndex, stat_mtime, list_child_dirs
+from .utils import esc_colors, write_prefixed
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify, inotify_flags = None, None
+
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger (
+    run_dir TEXT PRIMARY KEY,
+    seqroot TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    message TEXT
+);
+"""
+# inotify does not see writes made by other hosts on these file systems
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'gpfs', 'lustre', 'beegfs', 'panfs', 'fuse.sshfs', 'ceph', 'fuse.ceph')
+POLL_MIN, POLL_MAX = 30, 600
+# staged runs without CopyComplete.txt are launched once untouched for this long (seconds)
+SETTLE_TIME = 15 * 60
+MAX_ATTEMPTS = 3
+info_watch = lambda msg: write_prefixed(f"{esc_colors.OKGREEN}> {esc_colors.ENDC}{msg}\n")
+
+
+def fs_type(path):
+    """File system type of the mount `path` is on, from /proc/mounts"""
+    path, best, fstype = str(Path(path).resolve()), '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+def newest_mtime(run_dir):
+    """Newest modification time of the directories a copy of a run writes to: the run directory, InterOp,
+    the base calls directory and its lane and cycle directories. A copy adding base call files deep in the
+    run directory does not touch the run directory itself.
+
+    Returns:
+        (float): newest modification time, None if the run directory is gone
+    """
+    basecalls = Path(run_dir, 'Data', 'Intensities', 'BaseCalls')
+    dirs = [run_dir, Path(run_dir, 'InterOp'), basecalls]
+    for lane_dir in list_child_dirs(basecalls):
+        dirs.append(lane_dir)
+        dirs.extend(list_child_dirs(lane_dir))
+    if stat_mtime(run_dir) is None:
+        return None
+    return max(filter(None, map(stat_mtime, dirs)))
+
+
+class RunLedger():
+    """Persistent record of the run directories the watcher has seen and launched, a `scratch` ledger
+    starts from a copy of the persistent one and is discarded on close"""
+    def __init__(self, db_path=None, scratch=False):
+        if db_path is None:
+            db_path = Path(get_state_dir(), 'watch_ledger.sqlite')
+        self.db = sqlite3.connect(str(db_path), timeout=60)
+        self.db.executescript(LEDGER_SCHEMA)
+        if scratch:
+            persistent, self.db = self.db, sqlite3.connect(':memory:')
+            persistent.backup(self.db)
+            persistent.close()
+
+    def close(self):
+        self.db.close()
+
+    def known_roots(self):
+        return {row[0] for row in self.db.execute('SELECT DISTINCT seqroot FROM ledger')}
+
+    def status(self, run_dir):
+        row = self.db.execute('SELECT status, attempts FROM ledger WHERE run_dir = ?', (str(run_dir),)).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def mark(self, run_dir, seqroot, status, message=None, attempt=False):
+        _, attempts = self.status(run_dir)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?, ?)',
+                            (str(run_dir), str(seqroot), status, attempts + int(attempt), time(), message))
+
+
+class RunWatcher():
+    """Watch sequencing roots for staged runs and hand each new one to `launch` exactly once.
+
+    A run is ready once it is staged (RTAComplete.txt, SampleSheet.csv, RunInfo.xml) and either has a
+    CopyComplete.txt or none of its run, InterOp and base call directories were modified for `settle` seconds. Roots on local file systems are
+    watched with inotify when `inotify_simple` is installed, other roots are polled, the poll interval
+    backs off from `POLL_MIN` to `POLL_MAX` seconds while nothing changes.
+
+    On the first watch of a sequencing root the runs already staged there are recorded as existing and
+    not launched, unless `backfill` is set. With `dry_run` the ledger is not persisted.
+
+    """
+    def __init__(self, seqroots, launch, settle=SETTLE_TIME, backfill=False, dry_run=False, poll_min=POLL_MIN, 
+                 poll_max=POLL_MAX):
+        self.seqroots = [Path(root).absolute() for root in seqroots]
+        self.launch = launch
+        self.settle = settle
+        self.backfill = backfill
+        self.poll_min, self.poll_max = poll_min, poll_max
+        self.stopping = False
+        self.run_index = SequencingRunIndex()
+        self.ledger = RunLedger(scratch=dry_run)
+        self.inotify, self.watches = None, {}
+        self.setup_inotify()
+
+    def setup_inotify(self):
+        local_roots = [root for root in self.seqroots if fs_type(root) not in NETWORK_FS]
+        if INotify is None or not local_roots:
+            return
+        self.inotify = INotify()
+        self.watch_mask = inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.CLOSE_WRITE | \
+            inotify_flags.DELETE | inotify_flags.ATTRIB
+        for root in local_roots:
+            self.add_watch(root)
+            for child in list_child_dirs(root):
+                self.add_watch(child)
+
+    def add_watch(self, path):
+        if str(path) in self.watches.values():
+            return
+        try:
+            self.watches[self.inotify.add_watch(str(path), self.watch_mask)] = str(path)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+        self.run_index.close()
+        self.ledger.close()
+
+    def wait(self, timeout):
+        """Block until a watched directory changes or `timeout` seconds pass, waking up every second
+        to honour a stop request
+
+        Returns:
+            (bool): True if a change was seen
+        """
+        end = time() + timeout
+        while not self.stopping:
+            remaining = end - time()
+            if remaining <= 0:
+                return False
+            if self.inotify is None:
+                sleep(min(1, remaining))
+                continue
+            events = self.inotify.read(timeout=int(min(1, remaining) * 1000))
+            for event in events:
+                parent = self.watches.get(event.wd)
+                if parent and event.mask & inotify_flags.ISDIR and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    self.add_watch(Path(parent, event.name))
+            if events:
+                return True
+        return False
+
+    def is_ready(self, run_dir, now):
+        info = self.run_index.info(self.root_of(run_dir), run_dir)
+        if info and info['copy_complete']:
+            return True
+        mtime = newest_mtime(run_dir)
+        return mtime is not None and now - mtime >= self.settle
+
+    def root_of(self, run_dir):
+        for root in self.seqroots:
+            if root in run_dir.parents:
+                return root
+        return run_dir.parent
+
+    def scan(self):
+        """Refresh the run index and launch every staged run not yet in the ledger
+
+        Returns:
+            (tuple): (number of runs launched, number of staged runs waiting to settle)
+        """
+        launched, waiting, known_roots, now = 0, 0, self.ledger.known_roots(), time()
+        for root in self.seqroots:
+            self.run_index.refresh(root)
+            first_watch = str(root) not in known_roots
+            for run_dir in self.run_index.staged(root):
+                status, attempts = self.ledger.status(run_dir)
+                if status in ('existing', 'submitted') or (status == 'failed' and attempts >= MAX_ATTEMPTS):
+                    continue
+                if status is None and first_watch and not self.backfill:
+                    self.ledger.mark(run_dir, root, 'existing')
+                    continue
+                if not self.is_ready(run_dir, now):
+                    if status is None:
+                        self.ledger.mark(run_dir, root, 'waiting')
+                    waiting += 1
+                    continue
+                launched += self.launch_run(run_dir, root)
+            if first_watch and not self.run_index.staged(root):
+                # remember the root even when it has no staged runs yet
+                self.ledger.mark(root, root, 'existing')
+        return launched, waiting
+
+    def launch_run(self, run_dir, root):
+        info_watch(f"Launching run {esc_colors.BOLD}{run_dir.name}{esc_colors.ENDC}")
+        try:
+            self.launch(run_dir, root)
+        except (Exception, SystemExit) as error:
+            message = traceback.format_exc() if isinstance(error, Exception) else f"exit status {error.code}"
+            write_prefixed(f"{esc_colors.FAIL}Run {run_dir.name} failed to launch: {message}{esc_colors.ENDC}\n")
+            self.ledger.mark(run_dir, root, 'failed', message=message, attempt=True)
+            return 0
+        self.ledger.mark(run_dir, root, 'submitted', attempt=True)
+        return 1
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def watch(self, once=False):
+        """Scan until stopped (SIGINT/SIGTERM), waiting on file system events or polling in between"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        mode = 'inotify' if self.inotify is not None else 'polling'
+        info_watch(f"Watching {', '.join(map(str, self.seqroots))} ({mode})")
+        interval = self.poll_min
+        while not self.stopping:
+            launched, waiting = self.scan()
+            if once:
+                break
+            if self.inotify is None:
+                # back off while polling finds nothing new
+                interval = self.poll_min if launched or waiting else min(self.poll_max, interval * 2)
+            else:
+                # events wake the watcher up, settling runs still need a periodic look
+                interval = self.poll_min if waiting else self.poll_max
+            if self.wait(interval):
+                # let a burst of file system events settle before rescanning
+                sleep(1)
+                while self.wait(1):
+                    pass
+        self.close()
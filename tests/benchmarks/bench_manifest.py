@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Benchmark of base call manifests against base call lists embedded in the job configuration
+# ~~~~~~~~~~~~~~~
+"""Benchmark of base call manifests against base call lists embedded in the job configuration.
+
+The base call files of a synthetic run (HiSeq layout by default: 8 lanes, 48 tiles, 310 cycles, 119,040
+files) are generated in memory, no file is created outside a temporary directory. Each step is timed
+best of `--repeat`:
+
+    embedded json.dump   config with every base call path, as run() wrote it before manifests
+    embedded json.load   reading that config back, as snakemake and every job did
+    manifest write       write_bcl_manifest of a new manifest
+    manifest rewrite     write_bcl_manifest of an unchanged manifest (left untouched)
+    manifest header      read_manifest_header, what sizing reads
+    manifest lane        iter_bcl_manifest of one lane, what staging reads
+    manifest verify      iter_bcl_manifest of every file with the checksum verified
+
+Usage, from the repository root:
+
+    python tests/benchmarks/bench_manifest.py [--lanes 8] [--tiles 48] [--cycles 310] [--repeat 5]
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from scripts.manifest import MANIFEST_NAME, write_bcl_manifest, read_manifest_header, iter_bcl_manifest  # noqa: E402
+
+
+def synthetic_bcls(basecalls, lanes, tiles, cycles):
+    """(path, size) of the per tile base call files of a run, sizes are deterministic"""
+    return [
+        (Path(basecalls, f'L{lane:03d}', f'C{cycle}.1', f's_{lane}_{1101 + tile}.bcl.gz'), 150_000 + 37 * tile + cycle)
+        for lane in range(1, lanes + 1) for cycle in range(1, cycles + 1) for tile in range(tiles)
+    ]
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark base call manifests')
+    parser.add_argument('--lanes', type=int, default=8)
+    parser.add_argument('--tiles', type=int, default=48, help='tiles per lane')
+    parser.add_argument('--cycles', type=int, default=310)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        basecalls = Path(tmp, 'run', 'Data', 'Intensities', 'BaseCalls')
+        bcls = synthetic_bcls(basecalls, args.lanes, args.tiles, args.cycles)
+        config_file = Path(tmp, 'config_job_0.json')
+        manifest_file = Path(tmp, '.config', MANIFEST_NAME)
+        manifest_config = Path(tmp, 'config_manifest.json')
+
+        def dump_embedded():
+            with open(config_file, 'w') as fh:
+                json.dump({'bcl_files': [str(bcl) for bcl, _ in bcls]}, fh, indent=4)
+
+        def load_embedded():
+            with open(config_file) as fh:
+                json.load(fh)
+
+        def write_manifest():
+            manifest_file.unlink(missing_ok=True)
+            write_bcl_manifest(manifest_file, basecalls, bcls)
+
+        results = [
+            ('embedded json.dump', best_of(args.repeat, dump_embedded)),
+            ('embedded json.load', best_of(args.repeat, load_embedded)),
+            ('manifest write', best_of(args.repeat, write_manifest)),
+            ('manifest rewrite', best_of(args.repeat, lambda: write_bcl_manifest(manifest_file, basecalls, bcls))),
+            ('manifest header', best_of(args.repeat, lambda: read_manifest_header(manifest_file))),
+            ('manifest lane', best_of(args.repeat, lambda: sum(1 for _ in iter_bcl_manifest(manifest_file, lane=1)))),
+            ('manifest verify', best_of(args.repeat, lambda: sum(1 for _ in iter_bcl_manifest(manifest_file, verify=True)))),
+        ]
+        with open(manifest_config, 'w') as fh:
+            json.dump({'bcl_manifest': str(manifest_file)}, fh, indent=4)
+        sizes = [
+            ('embedded config', config_file.stat().st_size),
+            ('manifest config', manifest_config.stat().st_size),
+            ('manifest', manifest_file.stat().st_size),
+        ]
+
+    print(f"{len(bcls):,} base call files ({args.lanes} lanes, {args.tiles} tiles, {args.cycles} cycles), " + \
+          f"best of {args.repeat}")
+    for name, seconds in results:
+        print(f"{name:<20}{seconds * 1000:>10.1f} ms")
+    for name, size in sizes:
+        print(f"{name:<20}{size / 1024:>10.1f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Benchmark of sample sheet parsing
+# ~~~~~~~~~~~~~~~
+"""Benchmark of sample sheet parsing.
+
+Synthetic v1 (`[Data]`, `index`/`index2` columns) and v2 (`[BCLConvert_Data]`) sample sheets with
+`--rows` data rows over 8 lanes and 20 projects are written to a temporary directory, then parsed and
+grouped by project and lane the way `weave run` does. Time is the best of `--repeat`, memory the peak
+traced by tracemalloc during one parse.
+
+Usage, from the repository root:
+
+    python tests/benchmarks/bench_samplesheet.py [--rows 10000 100000] [--repeat 3]
+"""
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from scripts.samplesheet import IllumniaSampleSheet  # noqa: E402
+
+
+def synthetic_sheet(path, rows, version):
+    """Sample sheet with `rows` samples, indexes are deterministic"""
+    bases = 'ACGT'
+
+    def barcode(n, length=10):
+        return ''.join(bases[(n >> (2 * i)) & 3] for i in range(length))
+
+    if version == 1:
+        head = ['[Header]', 'IEMFileVersion,4', 'Date,2023-10-01', '', '[Reads]', '151', '151', '',
+                '[Settings]', 'Adapter,CTGTCTCTTATACACATCT', '', '[Data]',
+                'Lane,Sample_ID,Sample_Name,index,index2,Sample_Project,Description']
+    else:
+        head = ['[Header]', 'FileFormatVersion,2', '', '[Reads]', 'Read1Cycles,151', 'Read2Cycles,151', '',
+                '[BCLConvert_Settings]', 'AdapterRead1,CTGTCTCTTATACACATCT', 'AdapterRead2,CTGTCTCTTATACACATCT', '',
+                '[BCLConvert_Data]', 'Lane,Sample_ID,Sample_Name,Index,Index2,Sample_Project,Description']
+    with open(path, 'w') as fh:
+        fh.write('\n'.join(head) + '\n')
+        for i in range(rows):
+            fh.write(f"{i % 8 + 1},S{i},,{barcode(i)},{barcode(rows - i)},Project_{i % 20},sample {i}\n")
+    return path
+
+
+def parse_and_group(path):
+    sheet = IllumniaSampleSheet(path)
+    return sheet.projects, sheet.lane_groups(), sheet.unique_samples()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sample sheet parsing')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for version in (1, 2):
+            for rows in args.rows:
+                path = synthetic_sheet(Path(tmp, f'v{version}_{rows}.csv'), rows, version)
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    parse_and_group(path)
+                    timings.append(time.perf_counter() - start)
+                tracemalloc.start()
+                parse_and_group(path)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"v{version} {rows:>7} rows{min(timings) * 1000:>10.1f} ms{peak / 2**20:>8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
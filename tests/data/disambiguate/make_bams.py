@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# ~~~~~~~~~~~~~~~
+#   Regenerates the bwa mem alignments of the disambiguation tests, needs pybwa and pysam:
+#   python tests/data/disambiguate/make_bams.py
+# ~~~~~~~~~~~~~~~
+import random
+import tempfile
+from pathlib import Path
+
+import pysam
+from pybwa import BwaIndex, BwaMem
+
+
+HERE = Path(__file__).resolve().parent
+READ_LENGTH = 100
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(rng, seq, rate):
+    return ''.join(rng.choice('ACGT'.replace(base, '')) if rng.random() < rate else base for base in seq)
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def genomes(rng):
+    """Host (species A) and pathogen (species B) genomes, the pathogen carries an exact copy and a diverged
+    copy of host segments so some reads align equally well or nearly as well to both"""
+    host = {'chr1': random_sequence(rng, 20000), 'chr2': random_sequence(rng, 12000)}
+    pathogen = {'pathogen': random_sequence(rng, 6000) + host['chr1'][5000:7000] + random_sequence(rng, 2000) +
+                            mutate(rng, host['chr2'][3000:5000], 0.02) + random_sequence(rng, 2000)}
+    return host, pathogen
+
+
+def fragment(rng, genome, rate=0.005):
+    contig = rng.choice(sorted(genome))
+    size = rng.randint(250, 500)
+    start = rng.randint(0, len(genome[contig]) - size)
+    seq = genome[contig][start:start + size]
+    if rng.random() < 0.5:
+        seq = reverse_complement(seq)
+    return mutate(rng, seq[:READ_LENGTH], rate), mutate(rng, reverse_complement(seq)[:READ_LENGTH], rate)
+
+
+def read_pairs(rng, host, pathogen):
+    pairs = []
+    shared = {'shared': host['chr1'][5000:7000], 'diverged': host['chr2'][3000:5000]}
+    for source, n in ((host, 300), (pathogen, 200), (shared, 150)):
+        pairs += [fragment(rng, source) for _ in range(n)]
+    # mates from different genomes, and pairs aligning to neither
+    for _ in range(40):
+        r1, _ = fragment(rng, host)
+        _, r2 = fragment(rng, pathogen)
+        pairs.append((r1, r2))
+    pairs += [(random_sequence(rng, READ_LENGTH), random_sequence(rng, READ_LENGTH)) for _ in range(20)]
+    rng.shuffle(pairs)
+    names = [f'SIM:1:FC:1:{rng.randint(1101, 1116)}:{rng.randint(1000, 30000)}:{rng.randint(1000, 30000)}' for _ in pairs]
+    return list(zip(names, pairs))
+
+
+def write_fasta(path, genome):
+    with open(path, 'w') as fh:
+        for contig, seq in genome.items():
+            fh.write(f'>{contig}\n')
+            fh.write(''.join(seq[i:i + 80] + '\n' for i in range(0, len(seq), 80)))
+
+
+def align(genome, pairs, bam, tmp):
+    """Align both mates with bwa mem, pair the alignments and write them sorted by read name"""
+    fasta = Path(tmp, f'{bam.stem}.fa')
+    write_fasta(fasta, genome)
+    BwaIndex.index(fasta)
+    index = BwaIndex(prefix=fasta)
+    aligner = BwaMem(index=index)
+    unsorted = Path(tmp, bam.name)
+    with pysam.AlignmentFile(str(unsorted), 'wb', header=index.header) as out:
+        for name, mates in pairs:
+            hits = aligner.align(list(mates))
+            primaries = [next(read for read in reads if not read.is_supplementary) for reads in hits]
+            for mate, reads in enumerate(hits):
+                other = primaries[1 - mate]
+                for read in reads:
+                    read.query_name = name
+                    read.flag |= 0x1 | (0x40 if mate == 0 else 0x80)
+                    if other.is_unmapped:
+                        read.flag |= 0x8
+                    else:
+                        read.next_reference_id = other.reference_id
+                        read.next_reference_start = other.reference_start
+                        if other.is_reverse:
+                            read.flag |= 0x20
+                    if read.is_unmapped and not other.is_unmapped:
+                        read.reference_id, read.reference_start = other.reference_id, other.reference_start
+                    out.write(read)
+    pysam.sort('-n', '-o', str(bam), str(unsorted))
+
+
+def main():
+    rng = random.Random(23)
+    host, pathogen = genomes(rng)
+    pairs = read_pairs(rng, host, pathogen)
+    with tempfile.TemporaryDirectory() as tmp:
+        align(host, pairs, HERE / 'host.bam', tmp)
+        align(pathogen, pairs, HERE / 'pathogen.bam', tmp)
+
+
+if __name__ == '__main__':
+    main()
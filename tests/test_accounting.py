@@ -0,0 +1,90 @@
+import os
+import json
+from pathlib import Path
+
+import pytest
+
+from scripts import accounting
+
+
+SACCT = Path(__file__).resolve().parent / 'data' / 'sacct'
+
+
+def master_log(jobs):
+    """Snakemake output of a master job submitting `jobs`, (snakemake job id, rule, slurm job id) tuples"""
+    lines = ['Building DAG of jobs...', 'Using shell: /usr/bin/bash']
+    for jobid, rule, slurm_id in jobs:
+        lines += ['', '[Mon Oct  2 10:00:00 2023]', f'rule {rule}:', f'    output: {rule}.out', f'    jobid: {jobid}',
+                  '    resources: mem_mb=4000, runtime=60', '',
+                  f"Submitted job {jobid} with external jobid 'Submitted batch job {slurm_id}'."]
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    # the recorded sacct output replayed in place of slurm, as with WEAVE_SACCT
+    monkeypatch.setattr(accounting, 'SACCT', str(SACCT))
+    out_to = tmp_path / 'run'
+    first = out_to / 'logs' / 'masterjob' / 'weave_masterjob_4000.out'
+    first.parent.mkdir(parents=True)
+    first.write_text(master_log([(1, 'bclconvert', 5001)] + [(i + 1, 'fastqc_untrimmed', 5100 + i) for i in range(1, 11)]))
+    # snakemake job ids restart with every invocation, a rerun reuses them for other rules
+    rerun = out_to / '.snakemake' / 'log' / '2023-10-03T100000.000000.snakemake.log'
+    rerun.parent.mkdir(parents=True)
+    rerun.write_text(master_log([(i - 10, 'fastqc_untrimmed', 5100 + i) for i in range(11, 21)] +
+                                [(11, 'fastqc_untrimmed', 5200)]))
+    os.utime(first, (1000, 1000))
+    return out_to
+
+
+def test_parse_master_logs(run_dir):
+    jobs = accounting.parse_master_logs(run_dir)
+    assert jobs['4000'] == accounting.MASTER_RULE
+    assert jobs['5001'] == 'bclconvert'
+    assert all(jobs[str(5100 + i)] == 'fastqc_untrimmed' for i in range(1, 21))
+    assert jobs['5200'] == 'fastqc_untrimmed'
+    assert len(jobs) == 23
+
+
+def test_query_sacct_folds_job_steps(run_dir):
+    records = accounting.query_sacct(['5001', '5120'])
+    assert set(records) == {'5001', '5120'}
+    bclconvert = records['5001']
+    assert bclconvert['name'] == 'bclconvert' and bclconvert['state'] == 'COMPLETED'
+    assert bclconvert['alloc_cpus'] == 50 and bclconvert['elapsed'] == 7200
+    assert bclconvert['total_cpu'] == 50 * 3600
+    assert bclconvert['req_mem'] == 64 * 1024
+    # the peak memory use of a job is reported on its steps
+    assert bclconvert['max_rss'] == pytest.approx(48000000 / 1024)
+    # per cpu memory requests cover the whole allocation
+    assert records['5120']['req_mem'] == 4 * 4000
+    assert records['5120']['timelimit'] == 3600
+
+
+def test_recommend_95th_percentile(run_dir, tmp_path):
+    with accounting.JobHistory(tmp_path / 'accounting.sqlite') as history:
+        assert history.collect(run_dir) == 23
+        recommendations = history.recommend()
+
+    assert set(recommendations) == {accounting.MASTER_RULE, 'bclconvert', 'fastqc_untrimmed'}
+    fastqc = recommendations['fastqc_untrimmed']
+    # the failed (out of memory) job is left out
+    assert fastqc['jobs'] == 20
+    # nearest rank 95th percentile of 20 jobs is the 19th: 19000 MB peak memory, 1140 s elapsed, with headroom
+    assert fastqc['mem_mb'] == 23 * 1024
+    assert fastqc['runtime'] == 29
+    # every job kept 2 of its 4 cpus busy
+    assert fastqc['threads'] == 2
+    assert fastqc['cpu_eff'] == pytest.approx(0.5)
+    assert fastqc['requested'] == dict(threads=4, mem_mb=16000, runtime=60)
+
+
+def test_account_writes_profile(run_dir, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(accounting, 'get_state_dir', lambda: str(tmp_path))
+    profile = tmp_path / 'profile.json'
+    assert accounting.account([run_dir], profile_out=profile)
+    assert 'Collected 23 job records for run' in capsys.readouterr().out
+    resources = json.loads(profile.read_text())
+    # the master job is sized by weave, not from the profile
+    assert set(resources) == {'bclconvert', 'fastqc_untrimmed'}
+    assert resources['fastqc_untrimmed'] == dict(threads=2, mem_mb=23 * 1024, runtime=29)
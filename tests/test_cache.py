@@ -0,0 +1,115 @@
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from scripts import cache
+
+
+PAYLOAD = bytes(range(256)) * 64
+
+
+class ResourceHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, honouring `Range: bytes=<start>-` unless the server ignores ranges"""
+    def __init__(self, *args, honour_range=True, requests=None, **kwargs):
+        self.honour_range = honour_range
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.requests.append(header)
+        start = int(header.split('=')[1].rstrip('-')) if header and self.honour_range else 0
+        if start >= len(PAYLOAD):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(PAYLOAD)}')
+            self.end_headers()
+            return
+        body = PAYLOAD[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(honour_range=True):
+        requests = []
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(ResourceHandler, honour_range=honour_range, requests=requests))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}/resource.bin', requests
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_writes_atomically(serve, tmp_path):
+    url, requests = serve()
+    dest = tmp_path / 'resource.bin'
+    assert cache.fetch_url(url, dest) == dest
+    assert dest.read_bytes() == PAYLOAD
+    assert not Path(tmp_path, 'resource.bin.part').exists()
+    assert requests == [None]
+    # an existing download is not fetched again
+    cache.fetch_url(url, dest)
+    assert requests == [None]
+
+
+def test_fetch_resumes_partial_file(serve, tmp_path):
+    url, requests = serve()
+    dest = tmp_path / 'resource.bin'
+    Path(tmp_path, 'resource.bin.part').write_bytes(PAYLOAD[:1000])
+    cache.fetch_url(url, dest)
+    assert requests == ['bytes=1000-']
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_fetch_restarts_when_server_ignores_range(serve, tmp_path):
+    url, requests = serve(honour_range=False)
+    dest = tmp_path / 'resource.bin'
+    # stale bytes in the partial file must not be kept when the server answers with the whole resource
+    Path(tmp_path, 'resource.bin.part').write_bytes(b'x' * 1000)
+    cache.fetch_url(url, dest)
+    assert requests == ['bytes=1000-']
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_fetch_completes_partial_file_on_416(serve, tmp_path):
+    url, requests = serve()
+    dest = tmp_path / 'resource.bin'
+    Path(tmp_path, 'resource.bin.part').write_bytes(PAYLOAD)
+    cache.fetch_url(url, dest)
+    assert requests == [f'bytes={len(PAYLOAD)}-']
+    assert dest.read_bytes() == PAYLOAD
+    assert not Path(tmp_path, 'resource.bin.part').exists()
+
+
+def test_truncated_transfer_keeps_partial_file(serve, tmp_path, monkeypatch):
+    url, _ = serve()
+    dest = tmp_path / 'resource.bin'
+    real_urlopen = cache.urllib.request.urlopen
+
+    def short_urlopen(request):
+        response = real_urlopen(request)
+        body = response.read(100)
+        response.read = lambda size=-1, body=[body]: body.pop() if body else b''
+        return response
+
+    monkeypatch.setattr(cache.urllib.request, 'urlopen', short_urlopen)
+    with pytest.raises(IOError, match='rerun to resume'):
+        cache.fetch_url(url, dest)
+    assert not dest.exists()
+    assert Path(tmp_path, 'resource.bin.part').read_bytes() == PAYLOAD[:100]
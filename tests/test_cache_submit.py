@@ -0,0 +1,85 @@
+import os
+import json
+import stat
+from pathlib import Path
+
+import pytest
+
+from scripts import cache, utils
+
+
+FAKE_SBATCH = """#!/bin/sh
+# records every submission and answers like sbatch, job ids count up from 1000001
+n=$(( $(wc -l < "$SBATCH_LOG" 2>/dev/null || echo 0) + 1 ))
+echo "$*" >> "$SBATCH_LOG"
+echo "Submitted batch job $((1000000 + n))"
+"""
+
+
+@pytest.fixture
+def fake_sbatch(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    sbatch = bin_dir / 'sbatch'
+    sbatch.write_text(FAKE_SBATCH)
+    sbatch.chmod(sbatch.stat().st_mode | stat.S_IEXEC)
+    log = tmp_path / 'sbatch.log'
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('SBATCH_LOG', str(log))
+    monkeypatch.setattr(utils, 'get_current_server', lambda: 'biowulf')
+    monkeypatch.setattr(utils, 'get_tmp_dir', lambda host: str(tmp_path / 'tmp'))
+    return log
+
+
+def sbatch_header(script):
+    return dict(line[len('#SBATCH --'):].split('=', 1) for line in Path(script).read_text().splitlines()
+                if line.startswith('#SBATCH --') and '=' in line)
+
+
+def test_download_arrays_and_gather(fake_sbatch, tmp_path):
+    out = tmp_path / 'cache'
+    tasks = [
+        (str(out), 'ngsqc', 'docker', 'docker.io/org/ngsqc:0.0.1'),
+        (str(out), 'kraken', 'https', 'example.org/db/kraken.tar.gz'),
+        (str(out), 'fastq_screen', 'https', 'example.org/db/conf.txt'),
+        (str(out), 'kaiju', 'https', 'example.org/db/kaiju.tgz'),
+    ]
+    assert cache.submit_download_array(str(out), tasks)
+
+    submissions = fake_sbatch.read_text().splitlines()
+    assert len(submissions) == 4
+    scripts = {Path(line.split()[-1]).name: line for line in submissions}
+    assert set(scripts) == {'container_jobscript.sh', 'tarball_jobscript.sh', 'file_jobscript.sh', 'gather_jobscript.sh'}
+    # the gather job waits on every array
+    assert scripts['gather_jobscript.sh'].startswith('--dependency=afterany:1000001:1000002:1000003 ')
+
+    logs = Path(out, 'logs', 'cache')
+    tarball = sbatch_header(logs / 'tarball_jobscript.sh')
+    assert tarball['array'] == '0-1'
+    assert 'tmp' not in tarball
+    container = sbatch_header(logs / 'container_jobscript.sh')
+    assert container['array'] == '0-0' and container['tmp'] == '50g'
+    assert 'array' not in sbatch_header(logs / 'gather_jobscript.sh')
+
+    manifests = Path(out, '.cache_jobs')
+    assert [task[1] for task in json.load(open(manifests / 'tarball_tasks.json'))] == ['kraken', 'kaiju']
+    assert len(json.load(open(manifests / 'all_tasks.json'))) == 4
+    assert f"--array-task {manifests / 'tarball_tasks.json'}" in (logs / 'tarball_jobscript.sh').read_text()
+    assert f"--verify {manifests / 'all_tasks.json'}" in (logs / 'gather_jobscript.sh').read_text()
+
+
+def test_failed_array_submission_stops_before_gather(fake_sbatch, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'submit_sbatch', lambda *args, **kwargs: (False, None, 'sbatch: error: invalid partition'))
+    out = tmp_path / 'cache'
+    assert not cache.submit_download_array(str(out), [(str(out), 'conf', 'https', 'example.org/conf.txt')])
+    assert not Path(out, 'logs', 'cache', 'gather_jobscript.sh').exists()
+
+
+def test_array_task_runs_its_manifest_entry(tmp_path, monkeypatch):
+    manifest = tmp_path / 'tasks.json'
+    json.dump([['a', 'first', 'https', 'x/1'], ['b', 'second', 'https', 'x/2']], open(manifest, 'w'))
+    ran = []
+    monkeypatch.setattr(cache, 'handle_download', lambda *task: ran.append(task))
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '1')
+    assert cache.run_array_task(manifest)
+    assert ran == [('b', 'second', 'https', 'x/2')]
@@ -0,0 +1,94 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from scripts import demuxstats
+
+
+DATA = Path(__file__).resolve().parent / 'data' / 'demuxstats'
+PROJECTS = {'S1': 'P1', 'S2': 'P2'}
+S1_INDEX, S2_INDEX = 'ACGTACGT+TTGGCCAA', 'TGCATGCA+CCAATTGG'
+
+
+def expected_rows(yields=True, indexes=(S1_INDEX, S2_INDEX)):
+    """Summary of the fixtures: S1 in lanes 1 and 2, S2 in lane 1, 2000 reads per lane"""
+    y = (lambda bases: bases) if yields else (lambda bases: None)
+    s1, s2 = indexes
+    return [
+        dict(level='run', lane='all', reads=4000, yield_bases=y(1208000), pct_perfect_index=87.1, pct_undetermined=22.5),
+        dict(level='lane', lane='1', reads=2000, yield_bases=y(604000), pct_perfect_index=93.75, pct_undetermined=20.0),
+        dict(level='lane', lane='2', reads=2000, yield_bases=y(604000), pct_perfect_index=80.0, pct_undetermined=25.0),
+        dict(level='sample', lane='1', project='P1', sample='S1', index=s1, reads=1000, yield_bases=y(302000), pct_perfect_index=90.0, pct_of_lane=50.0),
+        dict(level='sample', lane='1', project='P2', sample='S2', index=s2, reads=600, yield_bases=y(181200), pct_perfect_index=100.0, pct_of_lane=30.0),
+        dict(level='sample', lane='1', project='', sample='Undetermined', index='', reads=400, yield_bases=y(120800), pct_perfect_index=None, pct_of_lane=20.0),
+        dict(level='sample', lane='2', project='P1', sample='S1', index=s1, reads=1500, yield_bases=y(453000), pct_perfect_index=80.0, pct_of_lane=75.0),
+        dict(level='sample', lane='2', project='', sample='Undetermined', index='', reads=500, yield_bases=y(151000), pct_perfect_index=None, pct_of_lane=25.0),
+    ]
+
+
+UNKNOWN_ROWS = [
+    dict(level='unknown_barcode', lane='1', index='GGGGGGGG+AGATCTCG', reads=300, pct_of_lane=15.0),
+    dict(level='unknown_barcode', lane='1', index='NNNNNNNN+NNNNNNNN', reads=50, pct_of_lane=2.5),
+    dict(level='unknown_barcode', lane='2', index='ACGTACGT+GGGGGGGG', reads=400, pct_of_lane=20.0),
+]
+
+
+def test_bcl2fastq_lanes_merged_json(tmp_path):
+    demux_dir = tmp_path / 'demux'
+    demuxstats.merge_stats_json([DATA / 'bcl2fastq' / f'L{lane}' / 'Stats' / 'Stats.json' for lane in (1, 2)],
+                                demux_dir / 'Stats' / 'Stats.json')
+    located = demuxstats.locate_stats(demux_dir)
+    assert located == dict(format='bcl2fastq', stats=demux_dir / 'Stats' / 'Stats.json', quality=None, unknown=None)
+    records, unknown = demuxstats.stats_json_records(located['stats'])
+    assert [(r['lane'], r['sample']) for r in records] == [('1', 'S1'), ('1', 'S2'), ('1', 'Undetermined'), ('2', 'S1'), ('2', 'Undetermined')]
+    assert unknown == [('1', 'GGGGGGGG+AGATCTCG', 300), ('1', 'NNNNNNNN+NNNNNNNN', 50), ('2', 'ACGTACGT+GGGGGGGG', 400)]
+    # Stats.json does not record projects, they come from the sample sheet
+    assert demuxstats.summarize_demux(demux_dir, projects=PROJECTS) == expected_rows() + UNKNOWN_ROWS
+    assert {row.get('project') for row in demuxstats.summarize_demux(demux_dir) if row['level'] == 'sample'} == {''}
+
+
+def test_bcl2fastq_xml(tmp_path):
+    demux_dir = tmp_path / 'demux'
+    shutil.copytree(DATA / 'bcl2fastq_xml', demux_dir)
+    assert demuxstats.locate_stats(demux_dir)['stats'] == demux_dir / 'Stats' / 'DemultiplexingStats.xml'
+    # no yields or unknown barcodes, projects are taken from the file
+    assert demuxstats.summarize_demux(demux_dir) == expected_rows(yields=False)
+
+
+def test_bclconvert_lanes_merged(tmp_path):
+    demux_dir = tmp_path / 'demux'
+    for name in ('Demultiplex_Stats', 'Quality_Metrics', 'Top_Unknown_Barcodes'):
+        demuxstats.merge_csv_reports([DATA / 'bclconvert' / f'L{lane}' / 'Reports' / f'{name}.csv' for lane in (1, 2)],
+                                     demux_dir / 'Reports' / f'{name}.csv')
+    merged = (demux_dir / 'Reports' / 'Demultiplex_Stats.csv').read_text().splitlines()
+    assert len(merged) == 1 + 3 + 2 and merged[0].startswith('Lane,SampleID,Sample_Project,Index')
+    located = demuxstats.locate_stats(demux_dir)
+    assert located['format'] == 'bclconvert' and located['quality'] and located['unknown']
+    rows = demuxstats.summarize_demux(demux_dir)
+    assert rows == expected_rows(indexes=('ACGTACGT-TTGGCCAA', 'TGCATGCA-CCAATTGG')) + UNKNOWN_ROWS
+
+
+def test_bclconvert_without_quality_metrics(tmp_path):
+    demux_dir = tmp_path / 'demux'
+    demuxstats.merge_csv_reports([DATA / 'bclconvert' / f'L{lane}' / 'Reports' / 'Demultiplex_Stats.csv' for lane in (1, 2)],
+                                 demux_dir / 'Reports' / 'Demultiplex_Stats.csv')
+    rows = demuxstats.summarize_demux(demux_dir)
+    assert rows == expected_rows(yields=False, indexes=('ACGTACGT-TTGGCCAA', 'TGCATGCA-CCAATTGG'))
+
+
+def test_top_unknown_barcodes_per_lane(tmp_path, monkeypatch):
+    monkeypatch.setattr(demuxstats, 'TOP_UNKNOWN', 1)
+    demux_dir = tmp_path / 'demux'
+    demuxstats.merge_stats_json([DATA / 'bcl2fastq' / f'L{lane}' / 'Stats' / 'Stats.json' for lane in (1, 2)],
+                                demux_dir / 'Stats' / 'Stats.json')
+    rows = demuxstats.summarize_demux(demux_dir, projects=PROJECTS)
+    assert [row for row in rows if row['level'] == 'unknown_barcode'] == [UNKNOWN_ROWS[0], UNKNOWN_ROWS[2]]
+
+
+def test_write_demux_summary(tmp_path):
+    assert demuxstats.summarize_demux(tmp_path) == []
+    demuxstats.write_demux_summary(tmp_path / 'out' / 'demux_summary.tsv', expected_rows(yields=False)[:2])
+    lines = (tmp_path / 'out' / 'demux_summary.tsv').read_text().splitlines()
+    assert lines[0] == '\t'.join(demuxstats.SUMMARY_COLUMNS)
+    assert lines[2] == 'lane\t1\t\t\t\t2000\t\t93.75\t\t20.0'
@@ -0,0 +1,85 @@
+import importlib.util
+from argparse import Namespace
+from functools import cmp_to_key
+from pathlib import Path
+
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+from scripts import disambiguate
+
+
+DATA = Path(__file__).resolve().parent / 'data' / 'disambiguate'
+NAMES = ['r1', 'r01', 'r001', 'r2', 'r10', 'r1a', 'r1.', 'r.1', 'a.', 'a1', 'a01b', 'A1', 'r', 'r0', 'r00', 'x9y10', 'x09y9']
+
+
+def reference():
+    """The AstraZeneca implementation, see tests/data/disambiguate/reference_disambiguate.py"""
+    spec = importlib.util.spec_from_file_location('reference_disambiguate', DATA / 'reference_disambiguate.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def records(path):
+    with pysam.AlignmentFile(str(path), 'rb') as bam:
+        return [read.to_string() for read in bam.fetch(until_eof=True)]
+
+
+def write_bam(path, reads):
+    """Name sorted BAM of (read name, flag, alignment score) tuples, aligned reads get a 100M alignment to chr1"""
+    header = {'HD': {'VN': '1.6'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}]}
+    unsorted = path.with_suffix('.unsorted.bam')
+    with pysam.AlignmentFile(str(unsorted), 'wb', header=header) as out:
+        for name, flag, score in reads:
+            read = pysam.AlignedSegment(out.header)
+            read.query_name, read.flag = name, flag
+            read.query_sequence, read.query_qualities = 'A' * 100, pysam.qualitystring_to_array('I' * 100)
+            if not flag & 0x4:
+                read.reference_id, read.reference_start, read.cigarstring = 0, 100, '100M'
+                read.set_tags([('NM', 0), ('AS', score)])
+            out.write(read)
+    pysam.sort('-n', '-o', str(path), str(unsorted))
+    return path
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_parity_with_reference(tmp_path, workers):
+    """Same outputs as the AstraZeneca tool on bwa mem alignments, regenerated with make_bams.py"""
+    host, pathogen = str(DATA / 'host.bam'), str(DATA / 'pathogen.bam')
+    reference().main(Namespace(A=host, B=pathogen, prefix='sample', output_dir=str(tmp_path / 'reference'),
+                               intermediate_dir=str(tmp_path / 'tmp'), no_sort=True, aligner='bwa'))
+    counts = disambiguate.disambiguate(host, pathogen, tmp_path / 'weave', 'sample', workers=workers)
+
+    summary = (tmp_path / 'reference' / 'sample_summary.txt').read_text()
+    assert (tmp_path / 'weave' / 'sample_summary.txt').read_text() == summary
+    # every kind of read name is in the fixtures
+    assert min(counts['A'], counts['B'], counts['ambiguous']) > 0
+    for key in disambiguate.OUTPUTS:
+        expected = records(tmp_path / 'reference' / f'sample.{key}.bam')
+        assert records(tmp_path / 'weave' / f'sample.{key}.bam') == expected, key
+
+
+def test_strnum_cmp_matches_samtools(tmp_path):
+    bam = write_bam(tmp_path / 'names.bam', [(name, 0x4, 0) for name in NAMES])
+    with pysam.AlignmentFile(str(bam), 'rb') as fh:
+        names = [read.query_name for read in fh.fetch(until_eof=True)]
+    assert names == sorted(NAMES, key=cmp_to_key(disambiguate.strnum_cmp))
+    assert disambiguate.strnum_cmp('r01', 'r1') == 0 and disambiguate.name_tie('r01') == disambiguate.name_tie('r1')
+    assert disambiguate.strnum_cmp('a.', 'a1') < 0 < disambiguate.strnum_cmp('r10', 'r9')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_tied_read_names_stay_apart(tmp_path, workers):
+    # r1 and r01 are sorted as equals and their alignments interleaved, they are still different reads
+    bam_a = write_bam(tmp_path / 'a.bam', [('r1', 0x41, 100), ('r1', 0x81, 100), ('r01', 0x41, 90), ('r01', 0x81, 90),
+                                           ('r2', 0x41, 80), ('r2', 0x81, 80)])
+    bam_b = write_bam(tmp_path / 'b.bam', [('r1', 0x41, 90), ('r1', 0x81, 90), ('r01', 0x41, 100), ('r01', 0x81, 100),
+                                           ('r001', 0x41, 100), ('r001', 0x81, 100)])
+    counts = disambiguate.disambiguate(str(bam_a), str(bam_b), tmp_path / 'out', 'sample', workers=workers)
+    assert (counts['A'], counts['B'], counts['ambiguous']) == (2, 2, 0)
+    names = lambda key: sorted({line.split('\t')[0] for line in records(tmp_path / 'out' / f'sample.{key}.bam')})
+    assert names('disambiguatedSpeciesA') == ['r1', 'r2']
+    assert names('disambiguatedSpeciesB') == ['r001', 'r01']
+    assert len(records(tmp_path / 'out' / 'sample.disambiguatedSpeciesA.bam')) == 4
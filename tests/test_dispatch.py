@@ -0,0 +1,91 @@
+import re
+import stat
+from pathlib import Path
+
+from scripts import utils
+
+
+# stand in for a snakemake invocation: marks itself running, reports how many runs are running, fails
+# with the given exit status
+SNAKEMAKE_STUB = 'touch "$0/$1"; sleep 0.2; echo "running $(ls "$0" | wc -l)"; sleep 0.3; rm "$0/$1"; exit $2'
+# stand in for sbatch: submits unless the run directory is named bad_*
+SBATCH_STUB = """#!/bin/sh
+case "$PWD" in
+    */bad_*) echo "sbatch: error: Batch job submission failed: Invalid account"; exit 1;;
+esac
+echo "Submitted batch job 1234$(basename "$PWD" | tr -dc 0-9)"
+"""
+ANSI = re.compile(r'\x1b\[[0-9;]*m')
+
+
+def local_dispatches(tmp_path, exit_codes):
+    running = tmp_path / 'running'
+    running.mkdir()
+    return [(f'run{i}', ['sh', '-c', SNAKEMAKE_STUB, running, f'run{i}', code], {}, str(tmp_path), None)
+            for i, code in enumerate(exit_codes)]
+
+
+def output_lines(capsys):
+    return [ANSI.sub('', line) for line in capsys.readouterr().out.splitlines()]
+
+
+def max_running(lines):
+    return max(int(line.rsplit(' ', 1)[1]) for line in lines if 'running' in line)
+
+
+def test_jobs_cap_concurrency(tmp_path, capsys):
+    assert utils.dispatch_runs(local_dispatches(tmp_path, [0] * 4), local=True, jobs=2)
+    lines = output_lines(capsys)
+    assert max_running(lines) == 2
+    # every line of a run carries its prefix
+    for i in range(4):
+        assert f'[run{i}] running' in '\n'.join(lines)
+    assert all(line.startswith('[run') for line in lines if 'running' in line)
+    assert lines[-5:] == ['Run summary:'] + [f'\trun{i}: ok' for i in range(4)]
+
+
+def test_jobs_one_runs_sequentially(tmp_path, capsys):
+    assert utils.dispatch_runs(local_dispatches(tmp_path, [0] * 3), local=True, jobs=1)
+    assert max_running(output_lines(capsys)) == 1
+
+
+def test_failed_run_fails_the_aggregate(tmp_path, capsys):
+    assert not utils.dispatch_runs(local_dispatches(tmp_path, [0, 1, 0]), local=True, jobs=3)
+    lines = output_lines(capsys)
+    assert lines[-4:] == ['Run summary:', '\trun0: ok', '\trun1: failed', '\trun2: ok']
+
+
+def test_single_run_is_not_prefixed(tmp_path, capsys):
+    assert not utils.dispatch_runs(local_dispatches(tmp_path, [2]), local=True, jobs=4)
+    assert output_lines(capsys) == ['running 1']
+
+
+def test_command_that_can_not_start(tmp_path, capsys):
+    dispatches = local_dispatches(tmp_path, [0]) + [('missing', [tmp_path / 'no_snakemake'], {}, str(tmp_path), None)]
+    assert not utils.dispatch_runs(dispatches, local=True, jobs=2)
+    lines = output_lines(capsys)
+    assert any(line.startswith('[missing]') and 'No such file or directory' in line for line in lines)
+    assert lines[-2:] == ['\trun0: ok', '\tmissing: failed']
+
+
+def test_headless_submissions(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(utils, 'get_current_server', lambda: 'biowulf')
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    sbatch = bin_dir / 'sbatch'
+    sbatch.write_text(SBATCH_STUB)
+    sbatch.chmod(sbatch.stat().st_mode | stat.S_IEXEC)
+    env = {'PATH': f"{bin_dir}:/usr/bin:/bin"}
+    dispatches = []
+    for name in ('run1', 'bad_run2', 'run3'):
+        Path(tmp_path, name).mkdir()
+        dispatches.append((name, ['snakemake', '--snakefile', 'Snakefile'], dict(env), str(tmp_path / name), {'mem': '24g'}))
+
+    assert not utils.dispatch_runs(dispatches, jobs=2)
+    lines = output_lines(capsys)
+    assert "[run1] >  Master job submitted in 'headless' mode on job 12341" in lines
+    assert "[bad_run2] sbatch: error: Batch job submission failed: Invalid account" in lines
+    assert lines[-4:] == ['Run summary:', '\trun1: ok (job 12341)', '\tbad_run2: failed', '\trun3: ok (job 12343)']
+    jobscript = (tmp_path / 'run1' / 'logs' / 'masterjob' / 'master_jobscript.sh').read_text()
+    assert '#SBATCH --mem=24g' in jobscript
+    assert jobscript.rstrip().endswith('snakemake --snakefile Snakefile')
@@ -0,0 +1,154 @@
+import gzip
+import random
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from scripts import fastqstats
+
+
+def random_reads(n_reads, seed=0, max_length=60):
+    """Reads of variable length, some empty, with Ns, lower case bases and Phred+33 qualities"""
+    rng = random.Random(seed)
+    reads = []
+    for i in range(n_reads):
+        length = 0 if i % 17 == 0 else rng.randint(1, max_length)
+        seq = ''.join(rng.choice('ACGTACGTACGTNacgt') for _ in range(length))
+        qual = ''.join(chr(33 + rng.randint(2, 41)) for _ in range(length))
+        reads.append((f'@read{i} 1:N:0:ACGT', seq, qual))
+    return reads
+
+
+def write_fastq(path, reads, newline='\n', truncate=0, final_newline=True):
+    text = ''.join(f'{name}{newline}{seq}{newline}+{newline}{qual}{newline}' for name, seq, qual in reads)
+    if truncate:
+        text = newline.join(text.split(newline)[:-1 - truncate]) + newline
+    if not final_newline:
+        text = text[:-len(newline)]
+    with gzip.open(path, 'wb') as fh:
+        fh.write(text.encode())
+    return path
+
+
+def reference_stats(name, reads):
+    """Statistics of `FastqStats.summary`, a read at a time in plain python"""
+    lengths, read_gc, read_quality = {}, {gc: 0 for gc in range(101)}, {}
+    cycle_quality, cycle_bases, cycle_counts = {}, {}, {}
+    counts = dict.fromkeys(fastqstats.BASES, 0)
+    for _, seq, qual in reads:
+        lengths[len(seq)] = lengths.get(len(seq), 0) + 1
+        for cycle, (base, q) in enumerate(zip(seq.upper(), qual), start=1):
+            base = base if base in 'ACGT' else 'N'
+            counts[base] += 1
+            cycle_quality[cycle] = cycle_quality.get(cycle, 0) + ord(q) - 33
+            cycle_bases[cycle] = cycle_bases.get(cycle, 0) + 1
+            cycle_counts.setdefault(cycle, dict.fromkeys(fastqstats.BASES, 0))[base] += 1
+        if seq:
+            gc = round(100 * sum(base in 'GCgc' for base in seq) / len(seq))
+            read_gc[gc] += 1
+            mean_q = max(sum(ord(q) - 33 for q in qual) // len(seq), 0)
+            read_quality[mean_q] = read_quality.get(mean_q, 0) + 1
+    bases = sum(counts.values())
+    return dict(
+        name=name,
+        reads=len(reads),
+        bases=bases,
+        mean_length=round(bases / len(reads), 2),
+        min_length=min(lengths),
+        max_length=max(lengths),
+        percent_gc=round(100 * (counts['C'] + counts['G']) / bases, 2),
+        percent_n=round(100 * counts['N'] / bases, 4),
+        mean_quality=round(sum(cycle_quality.values()) / bases, 2),
+        length_distribution=dict(sorted(lengths.items())),
+        cycle_mean_quality={c: round(cycle_quality[c] / cycle_bases[c], 2) for c in sorted(cycle_bases)},
+        cycle_base_content={c: {base: round(100 * n / cycle_bases[c], 2) for base, n in cycle_counts[c].items()}
+                            for c in sorted(cycle_bases)},
+        read_gc_distribution=read_gc,
+        read_quality_distribution=dict(sorted(read_quality.items())),
+    )
+
+
+@pytest.mark.parametrize('block_bytes', [7, 100, 4096, fastqstats.BLOCK_BYTES])
+def test_matches_reference(tmp_path, block_bytes):
+    # small blocks split records, and lines, across block boundaries
+    reads = random_reads(500)
+    fastq = write_fastq(tmp_path / 'S1_R1_001.fastq.gz', reads)
+    assert fastqstats.fastq_stats(fastq, block_bytes=block_bytes) == reference_stats('S1_R1_001', reads)
+
+
+@pytest.mark.parametrize('block_bytes', [100, fastqstats.BLOCK_BYTES])
+def test_windows_line_endings(tmp_path, block_bytes):
+    reads = random_reads(200, seed=1)
+    fastq = write_fastq(tmp_path / 'S1_R1_001.fastq.gz', reads, newline='\r\n')
+    assert fastqstats.fastq_stats(fastq, block_bytes=block_bytes) == reference_stats('S1_R1_001', reads)
+
+
+def test_missing_final_newline(tmp_path):
+    reads = random_reads(50, seed=2)
+    fastq = write_fastq(tmp_path / 'S1_R1_001.fastq.gz', reads, final_newline=False)
+    assert fastqstats.fastq_stats(fastq, block_bytes=64) == reference_stats('S1_R1_001', reads)
+
+
+@pytest.mark.parametrize('truncate', [1, 2, 3])
+def test_truncated_last_record(tmp_path, truncate):
+    fastq = write_fastq(tmp_path / 'S1_R1_001.fastq.gz', random_reads(50, seed=3), truncate=truncate)
+    with pytest.raises(ValueError, match='ends with a truncated record'):
+        fastqstats.fastq_stats(fastq, block_bytes=64)
+
+
+def test_multiqc_sections(tmp_path):
+    fastqs = [write_fastq(tmp_path / f'S1_R{mate}_001.fastq.gz', random_reads(100, seed=mate)) for mate in (1, 2)]
+    stats = fastqstats.collect_stats(fastqs, processes=2)
+    assert [s['name'] for s in stats] == ['S1_R1_001', 'S1_R2_001']
+    written = fastqstats.write_stats(stats, tmp_path / 'out', 'S1')
+    assert [path.name for path in written] == ['S1_fastq_stats.json'] + [f'S1_{section}_mqc.json' for section in fastqstats.MQC_SECTIONS]
+
+    sections = fastqstats.multiqc_sections(stats)
+    assert list(sections) == list(fastqstats.MQC_SECTIONS)
+    summary = sections['summary']
+    assert summary['id'] == 'weave_fastq_stats' and summary['plot_type'] == 'table'
+    assert summary['data']['S1_R2_001'] == {key: stats[1][key] for key in summary['headers']}
+    assert sections['quality']['data']['S1_R1_001'] == stats[0]['cycle_mean_quality']
+    assert sections['length']['data']['S1_R1_001'] == stats[0]['length_distribution']
+    # per read GC as a percentage of the reads with bases
+    for s in stats:
+        with_bases = s['reads'] - s['length_distribution'].get(0, 0)
+        assert sum(sections['gc']['data'][s['name']].values()) == pytest.approx(100 * with_bases / s['reads'], abs=1e-2)
+
+
+def fastqc_data(fastqc_dir, name):
+    """Modules of a fastqc_data.txt as {module: rows}"""
+    modules, rows = {}, None
+    for line in Path(fastqc_dir, f'{name}_fastqc', 'fastqc_data.txt').read_text().splitlines():
+        if line.startswith('>>') and line != '>>END_MODULE':
+            rows = modules.setdefault(line[2:].split('\t')[0], [])
+        elif rows is not None and line and not line.startswith('#') and line != '>>END_MODULE':
+            rows.append(line.split('\t'))
+    return modules
+
+
+@pytest.mark.skipif(shutil.which('fastqc') is None, reason='fastqc is not installed')
+def test_matches_fastqc(tmp_path):
+    # no Ns and reads of one length, FastQC leaves Ns out of its %GC and base content
+    rng = random.Random(4)
+    reads = [(f'@read{i}', ''.join(rng.choice('ACGT') for _ in range(75)), ''.join(chr(33 + rng.randint(2, 41)) for _ in range(75)))
+             for i in range(2000)]
+    fastq = write_fastq(tmp_path / 'S1_R1_001.fastq.gz', reads)
+    subprocess.run(['fastqc', '--nogroup', '--extract', '-o', str(tmp_path), str(fastq)], check=True, capture_output=True)
+    fastqc = fastqc_data(tmp_path, 'S1_R1_001')
+    stats = fastqstats.fastq_stats(fastq)
+
+    basic = dict(fastqc['Basic Statistics'])
+    assert int(basic['Total Sequences']) == stats['reads']
+    assert basic['Sequence length'] == str(stats['max_length'])
+    assert int(basic['%GC']) == int(stats['percent_gc'])
+    for cycle, mean, *_ in fastqc['Per base sequence quality']:
+        assert float(mean) == pytest.approx(stats['cycle_mean_quality'][int(cycle)], abs=0.01)
+    assert {int(length): int(float(n)) for length, n in fastqc['Sequence Length Distribution']} == stats['length_distribution']
+    for quality, n in fastqc['Per sequence quality scores']:
+        assert int(float(n)) == stats['read_quality_distribution'].get(int(quality), 0)
+    for cycle, g, a, t, c in fastqc['Per base sequence content']:
+        content = stats['cycle_base_content'][int(cycle)]
+        assert [float(g), float(a), float(t), float(c)] == pytest.approx([content[base] for base in 'GATC'], abs=0.01)
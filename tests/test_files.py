@@ -0,0 +1,250 @@
+import os
+import gzip
+from pathlib import Path
+
+import pytest
+
+from scripts import files
+from scripts.runinfo import IllumniaRunInfo
+from scripts.samplesheet import IllumniaSampleSheet
+
+
+def make_attempt(run_dir, n=1):
+    attempt = Path(run_dir, 'Analysis', str(n))
+    Path(attempt, 'Data', 'BCLConvert', 'fastq').mkdir(parents=True)
+    return attempt
+
+
+def test_demux_analysis_cache_sees_late_completion(tmp_path, monkeypatch):
+    monkeypatch.setenv('WEAVE_STATE_DIR', str(tmp_path / 'state'))
+    run_dir = tmp_path / 'run'
+    attempt = make_attempt(run_dir)
+    assert files.find_demux_analysis(run_dir) is None
+
+    # fastqs and the completion marker land deep in the attempt, the Analysis and attempt mtimes are unchanged
+    analysis_times = [os.stat(path).st_mtime_ns for path in (run_dir / 'Analysis', attempt)]
+    Path(attempt, 'Data', 'BCLConvert', 'fastq', 'S1_R1_001.fastq.gz').write_bytes(b'')
+    Path(attempt, 'Data', 'Secondary_Analysis_Complete.txt').write_text('')
+    assert [os.stat(path).st_mtime_ns for path in (run_dir / 'Analysis', attempt)] == analysis_times
+    assert files.find_demux_analysis(run_dir) == attempt.absolute()
+
+
+def test_demux_analysis_cache_hit_is_reused(tmp_path, monkeypatch):
+    monkeypatch.setenv('WEAVE_STATE_DIR', str(tmp_path / 'state'))
+    run_dir = tmp_path / 'run'
+    make_attempt(run_dir)
+    assert files.find_demux_analysis(run_dir) is None
+    scans = []
+    monkeypatch.setattr(files, 'is_analysis_complete', lambda attempt_dir: scans.append(attempt_dir))
+    assert files.find_demux_analysis(run_dir) is None
+    assert scans == []
+
+
+LANE_SHEET = """[Header]
+IEMFileVersion,4
+Experiment Name,EXP_LANES
+
+[Reads]
+151
+151
+
+[Settings]
+Adapter,CTGTCTCTTATACACATCT
+
+[Data]
+Lane,Sample_ID,Sample_Name,index,index2,Sample_Project
+1,A,,AAAACCCC,GGGGTTTT,P1
+2,B,,GGGGTTTT,AAAACCCC,P1
+2,A,,AAAACCCC,GGGGTTTT,P1
+3,C,,ACACACAC,GTGTGTGT,P2
+"""
+LANE_DIR = '{out}/demux/lanes/L{{lane}}'
+
+
+@pytest.fixture
+def lane_sheet(tmp_path):
+    path = tmp_path / 'SampleSheet.csv'
+    path.write_text(LANE_SHEET)
+    return IllumniaSampleSheet(path)
+
+
+def test_plan_lane_units(lane_sheet, tmp_path):
+    units = files.plan_lane_units(lane_sheet, tmp_path / '.config', settings={'BarcodeMismatchesIndex1': 0})
+    assert list(units) == ['1', '2', '3']
+    # run level sample ids number samples by first appearance in the sheet, lane level ids within the lane
+    assert units['1']['sids'] == {'A_S1': 'A_S1'}
+    assert units['2']['sids'] == {'B_S2': 'B_S1', 'A_S1': 'A_S2'}
+    assert units['3']['sids'] == {'C_S3': 'C_S1'}
+    lane_2 = IllumniaSampleSheet(units['2']['sample_sheet'])
+    assert [(s.Lane, s.Sample_ID) for s in lane_2.samples] == [('2', 'B'), ('2', 'A')]
+    assert lane_2.BarcodeMismatchesIndex1 == '0' and lane_2.Adapter == 'CTGTCTCTTATACACATCT'
+
+
+def test_plan_lane_units_single_lane(tmp_path):
+    path = tmp_path / 'SampleSheet.csv'
+    path.write_text(LANE_SHEET.replace('\n2,', '\n1,').replace('\n3,', '\n1,'))
+    assert files.plan_lane_units(IllumniaSampleSheet(path), tmp_path / '.config') == {}
+    assert not (tmp_path / '.config').exists()
+
+
+def demux_lanes(units, lane_dir, lanes, rnum=1):
+    """Demultiplexed fastqs of `lanes` under their lane level sample ids, moved to their run level parts as
+    rule lane_fastq_part does, every fastq a gzip member of one read named after its lane"""
+    for lane in lanes:
+        for run_sid in units[lane]['sids']:
+            project = 'P2' if run_sid.startswith('C') else 'P1'
+            demuxed = Path(files.lane_demuxed_fastq(units, lane_dir, lane, project, run_sid, rnum))
+            demuxed.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(demuxed, 'wt') as fh:
+                fh.write(f'@{run_sid}:L{lane}\nACGT\n+\nIIII\n')
+            part = Path(lane_dir.format(lane=lane), 'parts', project, f'{run_sid}_R{rnum}_001.fastq.gz')
+            part.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(demuxed, part)
+
+
+def merged_reads(units, lane_dir, project, sid, merged):
+    parts = files.lane_fastq_parts(units, lane_dir, project, sid, 1)
+    files.merge_files(parts, merged)
+    with gzip.open(merged, 'rt') as fh:
+        return [line.strip() for line in fh if line.startswith('@')]
+
+
+def test_merge_lane_fastqs(lane_sheet, tmp_path):
+    units = files.plan_lane_units(lane_sheet, tmp_path / '.config')
+    lane_dir = LANE_DIR.format(out=tmp_path)
+    demux_lanes(units, lane_dir, units)
+    assert files.lane_fastq_parts(units, lane_dir, 'P1', 'A_S1', 1) == [
+        f'{tmp_path}/demux/lanes/L{lane}/parts/P1/A_S1_R1_001.fastq.gz' for lane in (1, 2)]
+    # gzip members of the lanes concatenate into a single gzip file, in lane order
+    assert merged_reads(units, lane_dir, 'P1', 'A_S1', tmp_path / 'A_S1_R1_001.fastq.gz') == ['@A_S1:L1', '@A_S1:L2']
+    # a single part is linked, not copied
+    merged = tmp_path / 'C_S3_R1_001.fastq.gz'
+    assert merged_reads(units, lane_dir, 'P2', 'C_S3', merged) == ['@C_S3:L3']
+    assert os.path.samefile(merged, files.lane_fastq_parts(units, lane_dir, 'P2', 'C_S3', 1)[0])
+    assert not Path(str(merged) + '.part').exists()
+
+
+def test_skipped_lane_is_not_merged(lane_sheet, tmp_path):
+    units = files.plan_lane_units(lane_sheet, tmp_path / '.config')
+    # lane 1 failed the lane gate with `--lane-gate skip`
+    kept, sids = files.skip_lanes(units, {1: ['40.0% PF < 50.0%']})
+    assert list(kept) == ['2', '3'] and sids == {'A_S1', 'B_S2', 'C_S3'}
+    lane_dir = LANE_DIR.format(out=tmp_path)
+    demux_lanes(kept, lane_dir, kept)
+    assert merged_reads(kept, lane_dir, 'P1', 'A_S1', tmp_path / 'A_S1_R1_001.fastq.gz') == ['@A_S1:L2']
+    # samples only in skipped lanes are dropped
+    kept, sids = files.skip_lanes(units, {3: []})
+    assert sids == {'A_S1', 'B_S2'}
+
+
+BCL_RUN_INFO = """<?xml version="1.0"?>
+<RunInfo Version="5">
+  <Run Id="231001_A0001_0001_BHYYYYYYYY" Number="1">
+    <Reads>
+      <Read Number="1" NumCycles="3" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="2" IsIndexedRead="Y" />
+    </Reads>
+    <FlowcellLayout LaneCount="2" SurfaceCount="2" SwathCount="1" TileCount="2">
+      <TileSet TileNamingConvention="FourDigit">
+        <Tiles>
+          <Tile>1_1101</Tile><Tile>1_1102</Tile><Tile>1_2101</Tile><Tile>1_2102</Tile>
+          <Tile>2_1101</Tile><Tile>2_1102</Tile><Tile>2_2101</Tile><Tile>2_2102</Tile>
+        </Tiles>
+      </TileSet>
+    </FlowcellLayout>
+  </Run>
+</RunInfo>
+"""
+# base call files of BCL_RUN_INFO per layout: 2 lanes, 5 cycles and 4 tiles or 2 surfaces per lane
+BCL_FILE_COUNTS = {'cbcl': 2 * 5 * 2, 'bgzf': 2 * 5, 'gz': 2 * 5 * 4, 'bcl': 2 * 5 * 4}
+
+
+def make_bcl_run(run_dir, layout, run_info=BCL_RUN_INFO):
+    """Run directory with every base call file of a layout, each of the minimum sane size plus its index"""
+    run_dir.mkdir(parents=True)
+    if run_info:
+        Path(run_dir, 'RunInfo.xml').write_text(run_info)
+    info = IllumniaRunInfo(Path(run_dir, 'RunInfo.xml')) if run_info else None
+    basecalls = Path(run_dir, 'Data', 'Intensities', 'BaseCalls')
+    expected = list(files.expected_bcl_files(basecalls, info, layout)) if info else []
+    for i, bcl in enumerate(expected):
+        bcl.parent.mkdir(parents=True, exist_ok=True)
+        bcl.write_bytes(b'\0' * (files.BCL_LAYOUTS[layout][2] + i))
+    return basecalls, expected
+
+
+@pytest.mark.parametrize('layout', files.BCL_LAYOUTS)
+def test_bcl_layouts(tmp_path, layout):
+    basecalls, expected = make_bcl_run(tmp_path / 'run', layout)
+    assert len(expected) == BCL_FILE_COUNTS[layout]
+    assert files.detect_bcl_layout(basecalls, IllumniaRunInfo(tmp_path / 'run' / 'RunInfo.xml')) == layout
+    bcls = files.find_bcl_files(tmp_path / 'run')
+    min_size = files.BCL_LAYOUTS[layout][2]
+    assert bcls == [(bcl, min_size + i) for i, bcl in enumerate(expected)]
+    # the layout-less scan finds the same files
+    assert sorted(bcls) == files.scan_bcl_files(basecalls)
+
+
+def test_bcl_layout_paths(tmp_path):
+    basecalls = tmp_path / 'BaseCalls'
+    run_info = tmp_path / 'RunInfo.xml'
+    run_info.write_text(BCL_RUN_INFO)
+    first = {layout: next(files.expected_bcl_files(basecalls, IllumniaRunInfo(run_info), layout)).relative_to(basecalls)
+             for layout in files.BCL_LAYOUTS}
+    assert first == {
+        'cbcl': Path('L001/C1.1/L001_1.cbcl'),
+        'bgzf': Path('L001/0001.bcl.bgzf'),
+        'gz': Path('L001/C1.1/s_1_1101.bcl.gz'),
+        'bcl': Path('L001/C1.1/s_1_1101.bcl'),
+    }
+    assert files.detect_bcl_layout(basecalls, IllumniaRunInfo(run_info)) is None
+
+
+def test_missing_and_truncated_bcl_files(tmp_path, capsys):
+    basecalls, expected = make_bcl_run(tmp_path / 'run', 'cbcl')
+    expected[3].unlink()
+    expected[5].write_bytes(b'\0')
+    bcls = files.find_bcl_files(tmp_path / 'run')
+    assert [bcl for bcl, _ in bcls] == expected[:3] + expected[4:]
+    assert dict(bcls)[expected[5]] == 1
+    out = capsys.readouterr().out
+    assert f"Warning: missing base call file {expected[3]}" in out
+    assert f"Warning: truncated base call file {expected[5]}" in out
+    assert "run has 1 missing and 1 truncated base call files" in out
+
+
+def test_missing_bcl_reports_are_capped(tmp_path, capsys):
+    basecalls, expected = make_bcl_run(tmp_path / 'run', 'gz')
+    for bcl in expected[1:]:
+        bcl.unlink()
+    assert files.find_bcl_files(tmp_path / 'run') == [(expected[0], files.BCL_LAYOUTS['gz'][2])]
+    out = capsys.readouterr().out
+    assert out.count('Warning: missing base call file') == files.MAX_BCL_REPORTS
+    assert f"has {len(expected) - 1} missing and 0 truncated" in out
+
+
+def test_bcl_scan_without_layout(tmp_path):
+    run_dir = tmp_path / 'run'
+    basecalls = Path(run_dir, 'Data', 'Intensities', 'BaseCalls')
+    assert files.find_bcl_files(run_dir) == []
+    sized = {
+        'L001/C1.1/L001_1.cbcl': 40,
+        'L001/C2.1/L001_1.cbcl': 41,
+        'L002/0001.bcl.bgzf': 30,
+        'L001/C3.1/L001_1.cbcl': 0,           # empty, left out
+        'L001/C1.1/deeper/L001_1.cbcl': 40,   # below the lane and cycle directories
+        'L001/C1.1.tmp/L001_1.cbcl': 40,      # partial copy
+        'L001/C1.1/L001_1.filter': 40,        # not a base call file
+        'L001/s_1_1101.stats': 40,
+    }
+    for rel, size in sized.items():
+        Path(basecalls, rel).parent.mkdir(parents=True, exist_ok=True)
+        Path(basecalls, rel).write_bytes(b'\0' * size)
+    found = [(basecalls / rel, size) for rel, size in sized.items()
+             if rel.count('/') < 3 and '.tmp' not in rel and rel.endswith(files.BCL_SUFFIXES)]
+    assert files.scan_bcl_files(basecalls) == sorted(found)
+    # no RunInfo.xml, or a layout RunInfo.xml does not describe, is scanned once without the empty files
+    assert files.find_bcl_files(run_dir) == sorted((bcl, size) for bcl, size in found if size)
+    Path(run_dir, 'RunInfo.xml').write_text(BCL_RUN_INFO)
+    assert files.find_bcl_files(run_dir) == files.find_bcl_files(run_dir, IllumniaRunInfo(run_dir / 'RunInfo.xml'))
+    assert len(files.find_bcl_files(run_dir)) == 3
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from scripts import images
+
+
+@pytest.fixture
+def store(tmp_path):
+    return images.ImageStore(tmp_path / 'store')
+
+
+def test_add_hard_links(store, tmp_path):
+    sif = tmp_path / 'sifs' / 'weave_ngsqc_0.0.2.sif'
+    sif.parent.mkdir()
+    sif.write_bytes(b'image')
+    blob = store.add(sif, names=['weave'])
+    assert blob == store.blob(images.sha256_file(sif))
+    assert os.path.samefile(blob, sif) and not blob.is_symlink()
+    assert store.lookup('weave') == blob
+    # identical content imported under another name is stored once
+    other = tmp_path / 'sifs' / 'copy.sif'
+    other.write_bytes(b'image')
+    assert store.add(other) == blob
+    assert len(list(store.blobs.iterdir())) == 1
+
+
+def test_add_references_across_file_systems(store, tmp_path, monkeypatch):
+    def cross_device(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(images.os, 'link', cross_device)
+    sif = tmp_path / 'sifs' / 'bcl2fastq.sif'
+    sif.parent.mkdir()
+    sif.write_bytes(b'v1')
+    old_blob = store.add(sif, names=['bcl2fastq'])
+    assert old_blob.is_symlink() and os.readlink(old_blob) == str(sif)
+
+    # an image replaced in place is hashed again and no longer found under its old digest
+    sif.write_bytes(b'version 2')
+    os.utime(sif, (1, 1))
+    new_blob = store.add(sif, names=['bcl2fastq'])
+    assert new_blob != old_blob and not os.path.lexists(old_blob)
+    assert store.lookup('bcl2fastq') == new_blob
+    assert new_blob.read_bytes() == b'version 2'
+
+
+def test_read_only_store(store, tmp_path, monkeypatch):
+    sif_dir = tmp_path / 'sifs'
+    sif_dir.mkdir()
+    (sif_dir / 'bcl2fastq.sif').write_bytes(b'bcl2fastq')
+    (sif_dir / 'weave_bclconvert_0.0.3.sif').write_bytes(b'bclconvert')
+    blob = store.add(sif_dir / 'bcl2fastq.sif', names=['bcl2fastq'])
+    index = store.index_file.read_bytes()
+
+    def read_only():
+        # opening the lock file of a store the user can not write to
+        raise PermissionError(13, 'Permission denied', str(store.root / '.lock'))
+    monkeypatch.setattr(store, 'lock', read_only)
+    # indexed images are taken from the store without locking it, the others from the sif directory
+    containers = store.resolve(sif_dir)
+    assert containers['bcl2fastq'] == str(blob)
+    assert containers['bclconvert'] == str(sif_dir / 'weave_bclconvert_0.0.3.sif')
+    assert containers['ngsqc'] == str(sif_dir / 'weave_ngsqc_0.0.2.sif')
+    assert store.index_file.read_bytes() == index
+
+
+def test_lookup_creates_nothing(tmp_path):
+    store = images.ImageStore(tmp_path / 'store')
+    containers = store.resolve(tmp_path / 'sifs', populate=False)
+    assert containers['bcl2fastq'] == str(tmp_path / 'sifs' / 'bcl2fastq.sif')
+    assert not (tmp_path / 'store').exists()
@@ -0,0 +1,39 @@
+from scripts import indexes
+from scripts.samplesheet import IllumniaSampleSheet
+
+
+def write_sheet(path, rows, settings=()):
+    lines = ['[Header]', 'IEMFileVersion,4', '[Reads]', '151', '151', '[Settings]', *settings,
+             '[Data]', 'Lane,Sample_ID,Sample_Name,index,index2,Sample_Project']
+    lines += [','.join(row) for row in rows]
+    path.write_text('\n'.join(lines) + '\n')
+    return IllumniaSampleSheet(path)
+
+
+def test_mismatch_report_per_lane(tmp_path):
+    sheet = write_sheet(tmp_path / 'SampleSheet.csv', [
+        ('1', 's1', '', 'AAAAAAAA', 'CCCCCCCC', 'p'),
+        ('1', 's2', '', 'GGGGGGGG', 'TTTTTTTT', 'p'),
+        # one base apart on index 1 and identical on index 2, the lane only allows 0 index 1 mismatches
+        ('2', 's3', '', 'AAAAAAAA', 'CCCCCCCC', 'p'),
+        ('2', 's4', '', 'AAAAAAAT', 'CCCCCCCC', 'p'),
+    ])
+    chosen = indexes.barcode_mismatches(sheet)
+    assert chosen == (0, 2)
+    lines = indexes.mismatch_report(sheet, chosen)
+    assert lines == [
+        'lane 1: 0,2 barcode mismatches (largest collision free in lane 2,2, bcl2fastq default is 1,1)',
+        'lane 2: 0,2 barcode mismatches (largest collision free in lane 0,2, bcl2fastq default is 1,1)',
+    ]
+
+
+def test_mismatch_report_keeps_sheet_setting(tmp_path):
+    sheet = write_sheet(tmp_path / 'SampleSheet.csv', [
+        ('1', 's1', '', 'AAAAAAAA', 'CCCCCCCC', 'p'),
+        ('1', 's2', '', 'GGGGGGGG', 'TTTTTTTT', 'p'),
+    ], settings=['BarcodeMismatchesIndex1,1', 'BarcodeMismatchesIndex2,1'])
+    chosen = indexes.barcode_mismatches(sheet)
+    assert chosen == (1, 1)
+    assert indexes.mismatch_report(sheet, chosen, bclconvert=True) == [
+        'lane 1: 1,1 barcode mismatches (largest collision free in lane 2,2)'
+    ]
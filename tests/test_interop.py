@@ -0,0 +1,170 @@
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+from scripts import interop
+
+
+TILES = (1101, 1102)
+# quality bins of binned base calls: lower and upper bounds and the quality every bin is remapped to
+BINS = dict(lower=[2, 10, 20, 30], upper=[9, 19, 29, 40], remapped=[7, 15, 25, 37])
+
+
+def write(path, header, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(bytes(header) + b''.join(records))
+    return path
+
+
+def tile_metrics(path, version, lanes, area=2.0):
+    """TileMetricsOut.bin, `lanes` maps a lane to the (clusters, PF clusters) of each of its tiles"""
+    records = []
+    for lane, (clusters, pf) in lanes.items():
+        for tile in TILES:
+            if version == 2:
+                density = clusters / area
+                for code, value in ((interop.DENSITY_CODE, density), (interop.DENSITY_PF_CODE, density * pf / clusters),
+                                    (interop.CLUSTERS_CODE, clusters), (interop.CLUSTERS_PF_CODE, pf), (200, 0.1)):
+                    records.append(struct.pack('<HHHf', lane, tile, code, value))
+            else:
+                records.append(struct.pack('<HIBff', lane, tile, interop.TILE_COUNTS_CODE, clusters, pf))
+                # read records, % aligned of a read number
+                records.append(struct.pack('<HIBIf', lane, tile, ord('r'), 1, 0.5))
+    header = [2, 10] if version == 2 else [3, 15] + list(struct.pack('<f', area))
+    return write(path, header, records)
+
+
+def quality_metrics(path, version, lanes, cycles=(1, 2)):
+    """QMetricsOut.bin, `lanes` maps a lane to its fraction of base calls at Q35 (binned: the top bin), the
+    rest are Q20"""
+    binned = version >= 6
+    n_values = len(BINS['remapped']) if binned else 50
+    tile = 'I' if version == 7 else 'H'
+    header = [version, struct.calcsize(f'<H{tile}H{n_values}I')]
+    if version >= 5:
+        header += [1, len(BINS['lower'])] + BINS['lower'] + BINS['upper'] + BINS['remapped']
+    records = []
+    for lane, fraction in lanes.items():
+        for tile_number in TILES:
+            for cycle in cycles:
+                histogram = [0] * n_values
+                high = int(1000 * fraction)
+                histogram[-1 if binned else 34], histogram[2 if binned else 19] = high, 1000 - high
+                records.append(struct.pack(f'<H{tile}H{n_values}I', lane, tile_number, cycle, *histogram))
+    return write(path, header, records)
+
+
+def error_metrics(path, version, lanes):
+    """ErrorMetricsOut.bin, `lanes` maps a lane to the error rates of its cycles"""
+    records = []
+    for lane, rates in lanes.items():
+        for cycle, rate in enumerate(rates, start=1):
+            if version == 3:
+                records.append(struct.pack('<HHHf5I', lane, 1101, cycle, rate, 0, 0, 0, 0, 0))
+            else:
+                records.append(struct.pack('<HIHf', lane, 1101, cycle, rate))
+    return write(path, [version, 30 if version == 3 else 12], records)
+
+
+def extraction_metrics(path, version, lanes):
+    """ExtractionMetricsOut.bin, `lanes` maps a lane to the intensity of its first cycle, later cycles are
+    twice as bright"""
+    records = []
+    for lane, intensity in lanes.items():
+        for cycle in (1, 2):
+            value = intensity * cycle
+            if version == 2:
+                records.append(struct.pack('<HHH4f4HQ', lane, 1101, cycle, 2.5, 2.5, 3.0, 3.0, value, value, value, value, 0))
+            else:
+                records.append(struct.pack('<HIH2f2H', lane, 1101, cycle, 2.0, 4.0, value - 50, value + 50))
+    if version == 2:
+        header = [2, 38]
+    else:
+        header = [3, 20, 2]
+        for channel in (b'green', b'blue'):
+            header += list(struct.pack('<H', len(channel)) + channel)
+    return write(path, header, records)
+
+
+@pytest.mark.parametrize('version', [2, 3])
+def test_tile_metrics(tmp_path, version):
+    path = tile_metrics(tmp_path / 'TileMetricsOut.bin', version, {1: (1e6, 9e5), 2: (1e6, 4e5)})
+    assert interop.tile_lane_metrics(path) == {
+        1: dict(tiles=2, density_k=500.0, pct_pf=90.0),
+        2: dict(tiles=2, density_k=500.0, pct_pf=40.0),
+    }
+
+
+@pytest.mark.parametrize('version', [4, 5, 6, 7])
+def test_quality_metrics(tmp_path, version):
+    path = quality_metrics(tmp_path / 'QMetricsOut.bin', version, {1: 0.8, 3: 0.25})
+    assert interop.quality_lane_metrics(path) == {1: dict(pct_q30=80.0), 3: dict(pct_q30=25.0)}
+    metrics = interop.InterOpFile(path, 'quality')
+    assert metrics.header['bins'] == (BINS if version >= 5 else None)
+    assert len(metrics.records) == 2 * len(TILES) * 2
+
+
+def test_quality_metrics_of_cycles(tmp_path):
+    path = quality_metrics(tmp_path / 'QMetricsOut.bin', 4, {1: 0.8}, cycles=(1, 2))
+    with open(path, 'ab') as fh:
+        # an index cycle with every base call at Q20
+        for tile in TILES:
+            fh.write(struct.pack('<HHH50I', 1, tile, 3, *([0] * 19 + [1000] + [0] * 30)))
+    assert interop.quality_lane_metrics(path) == {1: dict(pct_q30=53.33)}
+    assert interop.quality_lane_metrics(path, cycles=[1, 2]) == {1: dict(pct_q30=80.0)}
+
+
+@pytest.mark.parametrize('version', [3, 4])
+def test_error_metrics(tmp_path, version):
+    path = error_metrics(tmp_path / 'ErrorMetricsOut.bin', version, {1: (0.2, 0.4), 2: (1.5, 1.5)})
+    assert interop.error_lane_metrics(path) == {1: dict(error_rate=0.3), 2: dict(error_rate=1.5)}
+
+
+@pytest.mark.parametrize('version, fwhm', [(2, 2.75), (3, 3.0)])
+def test_extraction_metrics(tmp_path, version, fwhm):
+    path = extraction_metrics(tmp_path / 'ExtractionMetricsOut.bin', version, {1: 400, 2: 150})
+    assert interop.extraction_lane_metrics(path) == {1: dict(intensity_c1=400.0, fwhm=fwhm), 2: dict(intensity_c1=150.0, fwhm=fwhm)}
+    if version == 3:
+        assert interop.InterOpFile(path, 'extraction').header['channels'] == ['green', 'blue']
+
+
+def test_partial_record_ignored(tmp_path):
+    path = error_metrics(tmp_path / 'ErrorMetricsOut.bin', 4, {1: (0.5,)})
+    with open(path, 'ab') as fh:
+        # a record still being written
+        fh.write(struct.pack('<HI', 2, 1101))
+    assert interop.error_lane_metrics(path) == {1: dict(error_rate=0.5)}
+
+
+@pytest.mark.parametrize('header, match', [
+    ([9, 12], 'unsupported error metrics version 9'),
+    ([4, 30], '30 byte records, expected 12'),
+    ([4], 'has no header'),
+])
+def test_unreadable_files(tmp_path, header, match):
+    path = write(tmp_path / 'ErrorMetricsOut.bin', header, [])
+    with pytest.raises(ValueError, match=match):
+        interop.InterOpFile(path, 'error')
+
+
+def test_lane_gate(tmp_path):
+    run_dir = tmp_path / 'run'
+    interop_dir = run_dir / interop.INTEROP_DIR
+    tile_metrics(interop_dir / interop.TILE_METRICS, 3, {1: (1e6, 9e5), 2: (1e6, 4e5), 3: (1e6, 8e5)})
+    quality_metrics(interop_dir / interop.QUALITY_METRICS, 6, {1: 0.9, 2: 0.9, 3: 0.5}, cycles=(1, 2, 3))
+    error_metrics(interop_dir / interop.ERROR_METRICS, 4, {1: (0.2, 0.4)})
+    # one cycle reads around an index read, quality is counted over cycles 1 and 3
+    run_info = SimpleNamespace(reads=[dict(cycles=1, is_index=False), dict(cycles=1, is_index=True), dict(cycles=1, is_index=False)])
+    metrics = interop.lane_metrics(run_dir, run_info)
+    assert [lane['lane'] for lane in metrics] == [1, 2, 3]
+    assert metrics[0] == dict(lane=1, tiles=2, density_k=500.0, pct_pf=90.0, pct_q30=90.0, error_rate=0.3,
+                              intensity_c1=None, fwhm=None)
+    assert metrics[1]['error_rate'] is None
+    assert interop.failed_lanes(metrics) == {2: ['40.0% PF < 50.0%'], 3: ['50.0% >= Q30 < 70.0%']}
+    assert interop.format_lane_metrics(metrics).splitlines()[2] == '2\t2\t500.0\t40.0\t90.0\t\t\t'
+
+
+def test_lane_gate_without_tile_metrics(tmp_path):
+    assert interop.lane_metrics(tmp_path) == []
+    assert interop.failed_lanes([]) == {}
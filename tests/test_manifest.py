@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from scripts import manifest
+
+
+def bcl_entries(basecalls, lanes=(1, 2), cycles=3, tiles=(1101, 1102)):
+    return [
+        (basecalls / f'L{lane:03d}' / f'C{cycle}.1' / f's_{lane}_{tile}.bcl.gz', 1000 * lane + 10 * cycle + tile % 100)
+        for lane in lanes for cycle in range(1, cycles + 1) for tile in tiles
+    ]
+
+
+@pytest.fixture
+def basecalls(tmp_path):
+    return tmp_path / 'run' / 'Data' / 'Intensities' / 'BaseCalls'
+
+
+def test_round_trip(tmp_path, basecalls):
+    entries = bcl_entries(basecalls)
+    path = tmp_path / '.config' / manifest.MANIFEST_NAME
+    header = manifest.write_bcl_manifest(path, basecalls, entries)
+    assert header == dict(root=str(basecalls), files=12, bytes=sum(size for _, size in entries), sha256=header['sha256'])
+    assert manifest.read_manifest_header(path) == header
+    assert list(manifest.iter_bcl_manifest(path, verify=True)) == entries
+    assert path.read_text().splitlines()[5] == 'L001/C1.1/s_1_1101.bcl.gz\t1011'
+
+
+def test_lane_filter(tmp_path, basecalls):
+    entries = bcl_entries(basecalls, lanes=(1, 2, 10))
+    path = tmp_path / manifest.MANIFEST_NAME
+    manifest.write_bcl_manifest(path, basecalls, entries)
+    for lane in (1, 2, 10):
+        assert list(manifest.iter_bcl_manifest(path, lane=lane)) == [entry for entry in entries if f'L{lane:03d}' in str(entry[0])]
+    assert list(manifest.iter_bcl_manifest(path, lane=3)) == []
+
+
+def test_verify_detects_an_edited_body(tmp_path, basecalls):
+    path = tmp_path / manifest.MANIFEST_NAME
+    manifest.write_bcl_manifest(path, basecalls, bcl_entries(basecalls))
+    path.write_text(path.read_text().replace('s_2_1102.bcl.gz\t2032', 's_2_1102.bcl.gz\t2033'))
+    # without verify the lines are read as they are
+    assert len(list(manifest.iter_bcl_manifest(path))) == 12
+    with pytest.raises(ValueError, match='does not match its checksum'):
+        list(manifest.iter_bcl_manifest(path, verify=True))
+    # a filtered read still checks every line
+    with pytest.raises(ValueError, match='does not match its checksum'):
+        list(manifest.iter_bcl_manifest(path, lane=1, verify=True))
+
+
+def test_unchanged_manifest_is_not_rewritten(tmp_path, basecalls):
+    entries = bcl_entries(basecalls)
+    path = tmp_path / manifest.MANIFEST_NAME
+    manifest.write_bcl_manifest(path, basecalls, entries)
+    os.utime(path, (1_000_000_000, 1_000_000_000))
+    manifest.write_bcl_manifest(path, basecalls, iter(entries))
+    assert path.stat().st_mtime == 1_000_000_000
+    # a base call file that grew rewrites it
+    entries[-1] = (entries[-1][0], entries[-1][1] + 1)
+    header = manifest.write_bcl_manifest(path, basecalls, entries)
+    assert path.stat().st_mtime > 1_000_000_000
+    assert manifest.read_manifest_header(path) == header
+
+
+def test_not_a_manifest(tmp_path):
+    path = tmp_path / 'bcls.txt'
+    path.write_text('L001/C1.1/s_1_1101.bcl.gz\t10\n')
+    with pytest.raises(ValueError, match='not a base call manifest'):
+        manifest.read_manifest_header(path)
+    with pytest.raises(ValueError, match='not a base call manifest'):
+        list(manifest.iter_bcl_manifest(path))
+    # an unreadable manifest is replaced
+    manifest.write_bcl_manifest(path, tmp_path, [(tmp_path / 'a.bcl', 1)])
+    assert manifest.read_manifest_header(path)['files'] == 1
+
+
+def test_file_outside_basecalls(tmp_path, basecalls):
+    entries = bcl_entries(basecalls) + [(basecalls.parent / 'BaseCalls2' / 's_1_1101.bcl.gz', 1)]
+    with pytest.raises(ValueError, match='is not under'):
+        manifest.write_bcl_manifest(tmp_path / manifest.MANIFEST_NAME, basecalls, entries)
@@ -0,0 +1,146 @@
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from scripts import perf
+
+
+DEMUXSTATS = Path(__file__).resolve().parent / 'data' / 'demuxstats'
+BENCHMARK_HEADER = 's\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\tcpu_time\n'
+SAMPLE_READS = {'S1': 2_000_000, 'S2': 4_000_000}
+
+
+def write_benchmark(path, wall, cpu, rss=1024.0, io=(10.0, 20.0), repeats=1):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(BENCHMARK_HEADER)
+        for i in range(repeats):
+            fh.write(f"{wall + i}\t0:00:{wall + i:02.0f}\t{rss}\t{rss * 2}\t-\tNA\t{io[0]}\t{io[1]}\t95.0\t{cpu + i}\n")
+
+
+def make_output(root, name, day=2, cpu_per_m=10.0, demux=True):
+    """weave output directory of a run with fastp reports, demultiplexing statistics, snakemake logs and
+    benchmarks whose cpu time is `cpu_per_m` seconds per million reads of the job"""
+    out_to = Path(root, name)
+    Path(out_to, '.config').mkdir(parents=True)
+    Path(out_to, '.config', 'config_job_0.json').write_text(json.dumps({'run_ids': name, 'projects': {'ProjA': ['S1', 'S2']}}))
+    for sid, reads in SAMPLE_READS.items():
+        fastp_json = Path(out_to, 'ProjA', sid, 'fastp', f'{sid}_fastp.json')
+        fastp_json.parent.mkdir(parents=True)
+        fastp_json.write_text(json.dumps({'summary': {'before_filtering': {'total_reads': reads, 'total_bases': reads * 150}}}))
+    if demux:
+        shutil.copytree(DEMUXSTATS / 'bcl2fastq_xml', Path(out_to, 'demux'))
+        shutil.copytree(DEMUXSTATS / 'bcl2fastq' / 'L1', Path(out_to, 'demux', 'lanes', 'L1'))
+    log = Path(out_to, '.snakemake', 'log', f'2023-10-0{day}T100000.snakemake.log')
+    log.parent.mkdir(parents=True)
+    log.write_text(f"Building DAG of jobs...\n[Mon Oct  {day} 10:00:00 2023]\nrule trim_w_fastp:\n[Mon Oct  {day} 12:30:00 2023]\n")
+
+    benchmarks = Path(out_to, perf.BENCHMARK_DIR)
+    for sid, reads in SAMPLE_READS.items():
+        write_benchmark(Path(benchmarks, 'trim_w_fastp', 'ProjA', f'{sid}.tsv'), 60, cpu_per_m * reads / 1e6)
+        for rnum in (1, 2):
+            write_benchmark(Path(benchmarks, 'fastqc_untrimmed', 'ProjA', f'{sid}_R{rnum}.tsv'), 30, 1.0 * reads / 1e6)
+    write_benchmark(Path(benchmarks, 'bcl2fastq_lane', 'L1.tsv'), 100, 20.0)
+    write_benchmark(Path(benchmarks, 'bcl2fastq', f'{name}.tsv'), 600, 3600.0, rss=8192.0, repeats=3)
+    return out_to
+
+
+@pytest.fixture
+def history(tmp_path):
+    with perf.PerfHistory(tmp_path / 'perf.sqlite') as perf_history:
+        yield perf_history
+
+
+def test_read_benchmark(tmp_path):
+    tsv = tmp_path / 'bench.tsv'
+    write_benchmark(tsv, 10, 4.0, repeats=3)
+    assert perf.read_benchmark(tsv) == dict(wall_s=11.0, cpu_s=5.0, max_rss_mb=1024.0, io_in_mb=10.0, io_out_mb=20.0)
+    tsv.write_text(BENCHMARK_HEADER + '1.5\t0:00:01\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\n')
+    assert perf.read_benchmark(tsv) == dict(wall_s=1.5, cpu_s=None, max_rss_mb=None, io_in_mb=None, io_out_mb=None)
+
+
+def test_collect(tmp_path, history):
+    out_to = make_output(tmp_path, 'RUN1')
+    assert perf.find_outputs([tmp_path]) == [out_to]
+    assert history.collect(out_to) == 8
+    jobs = {(rule, target): reads for rule, target, reads in history.db.execute('SELECT rule, target, reads FROM jobs')}
+    # jobs are normalized by the reads of their sample, of their lane or of the run
+    assert jobs == {
+        ('trim_w_fastp', 'ProjA/S1'): 2_000_000,
+        ('trim_w_fastp', 'ProjA/S2'): 4_000_000,
+        ('fastqc_untrimmed', 'ProjA/S1_R1'): 2_000_000,
+        ('fastqc_untrimmed', 'ProjA/S1_R2'): 2_000_000,
+        ('fastqc_untrimmed', 'ProjA/S2_R1'): 4_000_000,
+        ('fastqc_untrimmed', 'ProjA/S2_R2'): 4_000_000,
+        ('bcl2fastq_lane', 'L1'): perf.demux_reads(DEMUXSTATS / 'bcl2fastq' / 'L1'),
+        ('bcl2fastq', 'RUN1'): perf.demux_reads(DEMUXSTATS / 'bcl2fastq_xml'),
+    }
+    [run] = history.run_table()
+    assert run['run_id'] == 'RUN1'
+    assert run['wall_h'] == 2.5
+    assert run['jobs'] == 8
+
+    # collecting again replaces the jobs of the run
+    assert history.collect(out_to) == 8
+    assert history.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] == 8
+
+
+def test_run_reads_without_demux_statistics(tmp_path, history):
+    out_to = make_output(tmp_path, 'RUN1', demux=False)
+    history.collect(out_to)
+    reads = dict(history.db.execute('SELECT rule, reads FROM jobs WHERE rule LIKE "bcl2fastq%"').fetchall())
+    assert reads == {'bcl2fastq': sum(SAMPLE_READS.values()), 'bcl2fastq_lane': None}
+    assert history.run_table()[0]['reads_m'] == 6.0
+
+
+def test_rule_table(tmp_path, history):
+    for day, name in enumerate(('RUN1', 'RUN2'), start=2):
+        history.collect(make_output(tmp_path, name, day=day))
+    table = history.rule_table()
+    assert list(table) == ['bcl2fastq', 'bcl2fastq_lane', 'fastqc_untrimmed', 'trim_w_fastp']
+    trim = table['trim_w_fastp']
+    assert (trim['runs'], trim['jobs']) == (2, 4)
+    assert trim['cpu_per_m'] == pytest.approx(10.0)
+    # same wall time for samples of 2 and 4 million reads
+    assert trim['wall_per_m'] == pytest.approx((60 / 2 + 60 / 4) / 2)
+    assert trim['wall_total_h'] == pytest.approx(4 * 60 / 3600)
+    assert table['fastqc_untrimmed']['cpu_per_m'] == pytest.approx(1.0)
+    assert table['bcl2fastq']['max_rss_gb'] == 8.0
+    assert table['bcl2fastq']['cpu_median_s'] == 3601.0
+    assert table['bcl2fastq']['io_in_gb'] == pytest.approx(2 * 10.0 / 1024)
+
+    selected = history.rule_table([str(tmp_path / 'RUN2')], rules=['trim_w_fastp'])
+    assert list(selected) == ['trim_w_fastp']
+    assert selected['trim_w_fastp']['runs'] == 1
+
+
+def test_regression_across_two_runs(tmp_path, history, monkeypatch):
+    history.collect(make_output(tmp_path, 'RUN1', day=2, cpu_per_m=10.0))
+    history.collect(make_output(tmp_path, 'RUN2', day=3, cpu_per_m=13.0))
+    # by default a rule needs REGRESSION_MIN_RUNS earlier runs for a baseline
+    assert history.regressions() == []
+    monkeypatch.setattr(perf, 'REGRESSION_MIN_RUNS', 1)
+    assert history.regressions() == [('trim_w_fastp', 'RUN2', pytest.approx(13.0), pytest.approx(10.0))]
+    assert history.regressions(rules=['fastqc_untrimmed']) == []
+
+
+@pytest.mark.parametrize('latest, flagged', [(12.0, False), (13.0, True)])
+def test_regression_against_the_history(tmp_path, history, latest, flagged):
+    for day, cost in enumerate((10.0, 9.0, 11.0, latest), start=2):
+        history.collect(make_output(tmp_path, f'RUN{day}', day=day, cpu_per_m=cost))
+    expected = [('trim_w_fastp', 'RUN5', pytest.approx(latest), pytest.approx(10.0))] if flagged else []
+    assert history.regressions() == expected
+
+
+def test_performance_report(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('WEAVE_STATE_DIR', str(tmp_path / 'state'))
+    assert not perf.performance([tmp_path / 'missing'])
+    assert 'No job benchmarks found' in capsys.readouterr().out
+    make_output(tmp_path / 'outputs', 'RUN1')
+    assert perf.performance([tmp_path / 'outputs'])
+    out = capsys.readouterr().out
+    assert 'Collected 8 job benchmarks for RUN1' in out
+    assert 'trim_w_fastp' in out
+    assert (tmp_path / 'state' / 'perf.sqlite').exists()
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import pytest
+
+from scripts import references
+
+
+def test_reference_store_has_no_home_default(monkeypatch):
+    monkeypatch.delenv('WEAVE_REFERENCE_STORE', raising=False)
+    monkeypatch.setattr(references, 'get_resource_config', lambda: {'sif': '/data/SIFs/'})
+    with pytest.raises(ValueError, match='reference_store'):
+        references.ReferenceRegistry()
+
+
+def test_reference_store_from_host_config(monkeypatch, tmp_path):
+    monkeypatch.delenv('WEAVE_REFERENCE_STORE', raising=False)
+    monkeypatch.setattr(references, 'get_resource_config', lambda: {'reference_store': str(tmp_path / 'registry')})
+    assert references.ReferenceRegistry().root == tmp_path / 'registry'
+    monkeypatch.setenv('WEAVE_REFERENCE_STORE', str(tmp_path / 'env'))
+    assert references.reference_store_dir() == tmp_path / 'env'
+
+
+def test_register(tmp_path):
+    fasta = tmp_path / 'genomes' / 'host.fa'
+    fasta.parent.mkdir()
+    fasta.write_text('>chr1\nACGTACGT\n')
+    registry = references.ReferenceRegistry(tmp_path / 'registry')
+    entry = registry.register(fasta)
+    digest = references.sha256_file(fasta)
+    assert entry == dict(fasta=str(fasta), digest=digest, prefix=str(tmp_path / 'registry' / digest / 'bwa-0.7' / 'genome'),
+                         dir=str(tmp_path / 'registry' / digest / 'bwa-0.7'), ready=False)
+    assert Path(entry['dir']).parent.is_dir()
+    assert registry.index()[str(fasta)][2] == digest
+
+
+def test_dry_run_creates_nothing(tmp_path):
+    fasta = tmp_path / 'host.fa'
+    fasta.write_text('>chr1\nACGTACGT\n')
+    registry = references.ReferenceRegistry(tmp_path / 'registry', dry_run=True)
+    entry = registry.register(fasta)
+    assert entry['digest'] == references.sha256_file(fasta)
+    assert entry['ready'] is False
+    assert not (tmp_path / 'registry').exists()
@@ -0,0 +1,136 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from scripts.runindex import SequencingRunIndex
+
+
+RUN_INFO = Path(__file__).resolve().parents[1] / '.tests' / 'paired_end' / 'RunInfo.xml'
+BREADCRUMBS = ('RTAComplete.txt', 'CopyComplete.txt', 'SampleSheet.csv')
+
+
+def touch_mtime(path, step=10):
+    """Move the modification time of a directory forward, changes within the timestamp resolution of the
+    file system would otherwise go unnoticed"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + step * 10**9))
+
+
+def make_run(parent, name, crumbs=BREADCRUMBS, run_info=True):
+    run = Path(parent, name)
+    run.mkdir(parents=True)
+    for crumb in crumbs:
+        Path(run, crumb).touch()
+    if run_info:
+        shutil.copy(RUN_INFO, Path(run, 'RunInfo.xml'))
+    return run
+
+
+@pytest.fixture
+def seqroot(tmp_path):
+    root = tmp_path / 'seq'
+    make_run(root, '230907_NB000_0215_AHXXXXXXXX')
+    make_run(root / 'NovaSeq', '231001_A0001_0001_BHYYYYYYYY')
+    return root
+
+
+@pytest.fixture
+def index(tmp_path):
+    with SequencingRunIndex(tmp_path / 'run_index.sqlite') as run_index:
+        yield run_index
+
+
+def test_refresh_and_lookup(seqroot, index):
+    index.refresh(seqroot)
+    first = seqroot / '230907_NB000_0215_AHXXXXXXXX'
+    second = seqroot / 'NovaSeq' / '231001_A0001_0001_BHYYYYYYYY'
+    assert index.lookup(seqroot, first.name) == [first]
+    assert index.lookup(seqroot, second.name) == [second]
+    # first level directories are indexed by name as well
+    assert index.lookup(seqroot, 'NovaSeq') == [seqroot / 'NovaSeq']
+    assert index.lookup(seqroot, 'missing') == []
+    assert index.staged(seqroot) == [first, second]
+    info = index.info(seqroot, first)
+    assert info['rta_complete'] and info['copy_complete'] and info['sample_sheet'] and info['run_info']
+    assert info['runinfo']['lanes'] == 4
+    assert info['runinfo']['cycles'] == 316
+    assert index.info(seqroot, seqroot / 'missing') is None
+
+
+def test_refresh_is_incremental(seqroot, index):
+    index.refresh(seqroot)
+    mtime_ns = os.stat(seqroot).st_mtime_ns
+    make_run(seqroot, 'late_run')
+    os.utime(seqroot, ns=(mtime_ns, mtime_ns))
+    # the sequencing root did not change, it is not listed again
+    index.refresh(seqroot)
+    assert index.lookup(seqroot, 'late_run') == []
+    touch_mtime(seqroot)
+    index.refresh(seqroot)
+    assert index.lookup(seqroot, 'late_run') == [seqroot / 'late_run']
+
+
+def test_breadcrumb_appears_later(seqroot, index):
+    run = make_run(seqroot, 'copying_run', crumbs=('SampleSheet.csv',))
+    index.refresh(seqroot)
+    assert run not in index.staged(seqroot)
+    assert index.info(seqroot, run)['rta_complete'] is False
+
+    Path(run, 'RTAComplete.txt').touch()
+    touch_mtime(run)
+    index.refresh(seqroot)
+    assert run in index.staged(seqroot)
+    assert run not in index.staged(seqroot, copy_complete=True)
+
+    Path(run, 'CopyComplete.txt').touch()
+    touch_mtime(run)
+    index.refresh(seqroot)
+    assert run in index.staged(seqroot, copy_complete=True)
+
+
+def test_removed_runs(seqroot, index):
+    index.refresh(seqroot)
+    shutil.rmtree(seqroot / 'NovaSeq')
+    touch_mtime(seqroot)
+    index.refresh(seqroot)
+    assert index.lookup(seqroot, 'NovaSeq') == []
+    assert index.lookup(seqroot, '231001_A0001_0001_BHYYYYYYYY') == []
+    shutil.rmtree(seqroot)
+    index.refresh(seqroot)
+    assert index.staged(seqroot) == []
+    assert index.lookup(seqroot, '230907_NB000_0215_AHXXXXXXXX') == []
+
+
+def test_sync_children(tmp_path, index):
+    seqroot, parent = str(tmp_path), str(tmp_path / 'NovaSeq')
+    index.sync_children(seqroot, parent, [f'{parent}/run_a', f'{parent}/run_b'])
+    index.sync_children(seqroot, f'{parent}/run_a', [f'{parent}/run_a/nested'])
+    assert index.lookup(seqroot, 'run_b') == [Path(parent, 'run_b')]
+    index.sync_children(seqroot, parent, [f'{parent}/run_b', f'{parent}/run_c'])
+    # a removed directory takes its own children with it
+    assert index.lookup(seqroot, 'run_a') == []
+    assert index.lookup(seqroot, 'nested') == []
+    assert [index.lookup(seqroot, name) for name in ('run_b', 'run_c')] == [[Path(parent, 'run_b')], [Path(parent, 'run_c')]]
+
+
+def test_demux_state(tmp_path, monkeypatch):
+    monkeypatch.setenv('WEAVE_STATE_DIR', str(tmp_path / 'state'))
+    with SequencingRunIndex() as index:
+        assert index.get_demux_state('/seq/run1', 'sig1') == (False, None)
+        index.set_demux_state('/seq/run1', 'sig1', 2)
+        index.set_demux_state('/seq/run2', 'sig2', None)
+        assert index.get_demux_state('/seq/run1', 'sig1') == (True, '2')
+        assert index.get_demux_state('/seq/run1', 'sig0') == (False, None)
+    assert (tmp_path / 'state' / 'run_index.sqlite').exists()
+    with SequencingRunIndex() as index:
+        assert index.get_demux_state(Path('/seq/run1'), 'sig1') == (True, '2')
+        assert index.get_demux_state('/seq/run2', 'sig2') == (True, None)
+
+
+def test_unwritable_index(tmp_path, seqroot):
+    with SequencingRunIndex(tmp_path / 'missing' / 'run_index.sqlite') as index:
+        index.refresh(seqroot)
+        assert len(index.staged(seqroot)) == 2
+    assert not (tmp_path / 'missing').exists()
@@ -0,0 +1,163 @@
+import datetime
+from pathlib import Path
+
+import pytest
+
+from scripts.samplesheet import IllumniaSampleSheet, SampleRecord
+
+
+TESTS = Path(__file__).resolve().parents[1] / '.tests'
+
+V1_LANE_SHEET = """[Header]
+IEMFileVersion,4
+Date,2023-10-01
+Instrument Type,NovaSeq6000
+Description,,
+,,,,,,
+[Reads]
+151
+151
+
+[Settings]
+Adapter,CTGTCTCTTATACACATCT
+BarcodeMismatchesIndex1,
+[Data]
+Lane,Sample_ID,Sample_Name,index,index2,Sample_Project,Description
+1,S1,,ACGTACGT,TTGGCCAA,ProjA,first
+1,S2,,CATGCATG,AACCGGTT,ProjB,
+2,S1,,ACGTACGT,TTGGCCAA,ProjA,first again
+,S3,,GGGGAAAA,CCCCTTTT,ProjA,every lane
+,,,,,,
+"""
+
+V2_SHEET = """[Header],,,
+FileFormatVersion,2,,
+RunName,v2_run,,
+InstrumentPlatform,NovaSeqXSeries,,
+,,,
+[Reads],,,
+Read1Cycles,151,,
+Read2Cycles,151,,
+Index1Cycles,10,,
+,,,
+[BCLConvert_Settings],,,
+SoftwareVersion,4.1.7,,
+AdapterRead1,CTGTCTCTTATACACATCT,,
+AdapterRead2,CTGTCTCTTATACACATCT,,
+,,,
+[BCLConvert_Data],,,
+Lane,Sample_ID,Index,Sample_Project
+1,V1,AAAACCCCGG,ProjX
+2,V2,CCCCAAAAGG,ProjX
+2,V3,GGGGTTTTAA,ProjY
+"""
+
+
+def write_sheet(tmp_path, text, name='SampleSheet.csv'):
+    path = tmp_path / name
+    path.write_text(text)
+    return path
+
+
+def test_paired_end_fixture():
+    sheet = IllumniaSampleSheet(TESTS / 'paired_end' / 'paired_end.csv')
+    assert sheet.is_paired_end
+    assert sheet.adapters == [150, 150]
+    assert sheet.Investigator_Name == 'Joe Doe'
+    assert sheet.Date == datetime.datetime(2023, 9, 7)
+    assert sheet.Adapter == 'CTGTCTCTTATACACATCT'
+    assert not hasattr(sheet, 'Description')
+    assert sheet.projects == ['EXP_PROJ_Doe']
+    assert sheet.project == 'EXP_PROJ_Doe'
+    assert len(sheet.samples) == 14
+    assert sheet.lanes == []
+    assert sheet.lane_groups() == {None: sheet.samples}
+
+    record = sheet.samples[0]
+    assert isinstance(record, SampleRecord)
+    # v1 `index`/`index2` columns are read as `Index`/`Index2`
+    assert (record.Sample_ID, record.Index, record['Index2']) == ('LIB_04565_01', 'TTACCGAC', 'CGTATTCG')
+    assert 'index' not in record
+    assert record.Description == 'CD4DP C 04_23_23'
+    # empty values are absent
+    assert 'Sample_Name' not in record
+    assert record.get('Sample_Name', 'none') == 'none'
+    with pytest.raises(AttributeError):
+        record.Sample_Name
+    with pytest.raises(KeyError):
+        record['Sample_Name']
+    assert list(record) == ['Sample_ID', 'Sample_Plate', 'Sample_Well', 'I7_Index_ID', 'Index', 'I5_Index_ID', 'Index2',
+                            'Sample_Project', 'Description']
+    assert len(record) == 9
+
+
+def test_single_end_fixture():
+    sheet = IllumniaSampleSheet(TESTS / 'single_end' / 'single_end.csv')
+    assert sheet.is_single_end
+    assert sheet.adapters == [148]
+    assert sheet.instrument == 'NB551182'
+    assert sheet.projects == ['EXP_PROJ_SE']
+    assert [record.Sample_ID for record in sheet.samples][:2] == ['LIB_04942_01', 'LIB_04943_01']
+    assert sheet.samples[0].Index == 'GCAATATTCA'
+    # an empty Lane column is no lane
+    assert sheet.lanes == []
+    assert list(sheet.by_lane) == [None]
+
+
+def test_v1_sheet_indexes(tmp_path):
+    sheet = IllumniaSampleSheet(write_sheet(tmp_path, V1_LANE_SHEET))
+    assert sheet.data_section == 'Data'
+    assert sheet.is_paired_end
+    assert sheet.Instrument_Type == 'NovaSeq6000'
+    assert [record.Sample_ID for record in sheet.samples] == ['S1', 'S2', 'S1', 'S3']
+    assert {project: [r.Sample_ID for r in records] for project, records in sheet.by_project.items()} == \
+        {'ProjA': ['S1', 'S1', 'S3'], 'ProjB': ['S2']}
+    assert sheet.projects == ['ProjA', 'ProjB']
+    with pytest.raises(AssertionError):
+        sheet.project
+    assert {lane: [r.Sample_ID for r in records] for lane, records in sheet.by_lane.items()} == \
+        {1: ['S1', 'S2'], 2: ['S1'], None: ['S3']}
+    assert sheet.lanes == [1, 2]
+    # samples without a lane are demultiplexed in every lane
+    assert {lane: [r.Sample_ID for r in records] for lane, records in sheet.lane_groups().items()} == \
+        {1: ['S1', 'S2', 'S3'], 2: ['S1', 'S3']}
+    assert [record.get('Description') for record in sheet.unique_samples()] == ['first', None, 'every lane']
+    assert sheet.samples[0].Index == 'ACGTACGT'
+
+
+def test_settings_without_a_value_are_absent(tmp_path):
+    sheet = IllumniaSampleSheet(write_sheet(tmp_path, V1_LANE_SHEET))
+    # an empty `BarcodeMismatchesIndex1,` row is not an empty mismatch setting, the demultiplexer default applies
+    assert not hasattr(sheet, 'BarcodeMismatchesIndex1')
+    assert not hasattr(sheet, 'Description')
+    assert sheet.Date == datetime.datetime(2023, 10, 1)
+
+
+def test_v2_sheet(tmp_path):
+    sheet = IllumniaSampleSheet(write_sheet(tmp_path, V2_SHEET))
+    assert sheet.data_section == 'BCLConvert_Data'
+    assert sheet.platform == 'NovaSeqXSeries'
+    # adapters of the bcl-convert settings give the endedness
+    assert sheet.Read01 == sheet.Read02 == 'CTGTCTCTTATACACATCT'
+    assert sheet.is_paired_end
+    assert sheet.projects == ['ProjX', 'ProjY']
+    assert {lane: [r.Sample_ID for r in records] for lane, records in sheet.by_lane.items()} == {1: ['V1'], 2: ['V2', 'V3']}
+    assert sheet.samples[2]['Index'] == 'GGGGTTTTAA'
+    assert 'Index2' not in sheet.samples[2]
+
+
+def test_write(tmp_path):
+    sheet = IllumniaSampleSheet(write_sheet(tmp_path, V2_SHEET))
+    written = sheet.write(tmp_path / 'out.csv', settings={'BarcodeMismatchesIndex1': 0, 'SoftwareVersion': '4.2.7'},
+                          samples=sheet.by_lane[2])
+    rewritten = IllumniaSampleSheet(written)
+    assert rewritten.BarcodeMismatchesIndex1 == '0'
+    assert rewritten.SoftwareVersion == '4.2.7'
+    assert [record.Sample_ID for record in rewritten.samples] == ['V2', 'V3']
+    assert rewritten.data_header == sheet.data_header
+
+
+def test_missing_project(tmp_path):
+    text = V2_SHEET.replace('2,V3,GGGGTTTTAA,ProjY', '2,V3,GGGGTTTTAA,')
+    with pytest.raises(AttributeError, match='Sample_Project'):
+        IllumniaSampleSheet(write_sheet(tmp_path, text))
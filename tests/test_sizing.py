@@ -0,0 +1,117 @@
+import copy
+
+import pytest
+
+from scripts import sizing
+from scripts.manifest import write_bcl_manifest
+
+
+MISEQ_RUN_INFO = """<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="231001_M00001_0001_000000000-ABCDE" Number="1">
+    <Flowcell>000000000-ABCDE</Flowcell>
+    <Instrument>M00001</Instrument>
+    <Date>231001</Date>
+    <Reads>
+      <Read Number="1" NumCycles="151" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="4" NumCycles="151" IsIndexedRead="N" />
+    </Reads>
+    <FlowcellLayout LaneCount="1" SurfaceCount="2" SwathCount="1" TileCount="14" />
+  </Run>
+</RunInfo>
+"""
+
+# MiSeq-like: one lane, a few GB of base calls
+SMALL = dict(cycles=318, lanes=1, tiles=28, bcl_gb=2, samples=8, lane_units=0)
+# NovaSeq S4-like, lane sharded: 2 TB of base calls over 8 lane units
+LARGE = dict(cycles=318, lanes=4, tiles=624, bcl_gb=2000, samples=400, lane_units=8)
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    (tmp_path / 'RunInfo.xml').write_text(MISEQ_RUN_INFO)
+    return tmp_path
+
+
+def test_scale():
+    assert sizing.scale(4096, 100) == 4096
+    assert sizing.scale({"base": 8, "per_gb": 0.25}, 10) == 11
+    assert sizing.scale({"base": 8, "per_gb": 0.25, "max": 34}, 1000) == 34
+    assert sizing.scale({"base": 720, "per_gb": 6, "min": 7200}, 1) == 7200
+    assert sizing.scale({"base": 2048, "max": 4096}, 1000) == 2048
+    # float noise is not rounded up to the next unit
+    assert sizing.scale({"base": 0, "per_gb": 0.1}, 30) == 3
+
+
+def test_small_workload():
+    sized = sizing.size_rules(SMALL)
+    assert 'workload' not in sized
+    assert set(sized) == set(sizing.DEFAULT_MODEL) - {sizing.WORKLOAD}
+    assert sized['bcl2fastq'] == dict(threads=9, mem_mb=16256, runtime=64)
+    assert sized['trim_w_fastp'] == dict(threads=5, mem_mb=4160, runtime=31)
+    assert sized['fastq_stats'] == dict(threads=4, mem_mb=2048, runtime=16)
+    assert sized['masterjob'] == dict(threads=2, mem_mb=8208, runtime=7200)
+    assert sizing.sbatch_opts(sized['masterjob']) == {'cpus-per-task': 2, 'mem': '9g', 'time': '05-00:00:00'}
+
+
+def test_large_workload():
+    sized = sizing.size_rules(LARGE)
+    assert sized['bcl2fastq'] == dict(threads=34, mem_mb=128000, runtime=2880)
+    # lane rules are sized for one of the 8 lane units, not one of the 4 flowcell lanes
+    assert sized['bcl2fastq_lane'] == dict(threads=34, mem_mb=48000, runtime=560)
+    assert sized['trim_w_fastp'] == dict(threads=7, mem_mb=5376, runtime=50)
+    assert sized['masterjob'] == dict(threads=2, mem_mb=24192, runtime=12720)
+    assert sizing.sbatch_opts(sized['masterjob']) == {'cpus-per-task': 2, 'mem': '24g', 'time': '08-20:00:00'}
+
+    huge = sizing.size_rules(dict(LARGE, bcl_gb=6000))
+    assert huge['masterjob'] == dict(threads=2, mem_mb=32768, runtime=14400)
+    assert sizing.sbatch_opts(huge['masterjob'])['time'] == '10-00:00:00'
+
+
+def test_lane_basis_without_lane_units():
+    sized = sizing.size_rules(dict(LARGE, lane_units=0))
+    assert sized['bcl2fastq_lane']['runtime'] == 60 + 2 * 500
+
+
+def test_host_override():
+    default_model = copy.deepcopy(sizing.DEFAULT_MODEL)
+    host_model = {
+        "bcl2fastq": {"threads": 16},
+        "masterjob": {"runtime": {"base": 1440, "per_gb": 6, "min": 7200, "max": 10080}},
+        "my_rule": {"basis": "sample", "threads": 2, "mem_mb": {"base": 1024, "per_gb": 100}},
+    }
+    sized = sizing.size_rules(LARGE, host_model)
+    # a single resource is replaced, the others of the rule keep their defaults
+    assert sized['bcl2fastq'] == dict(threads=16, mem_mb=128000, runtime=2880)
+    assert sized['masterjob'] == dict(threads=2, mem_mb=24192, runtime=10080)
+    assert sized['my_rule'] == dict(threads=2, mem_mb=1524)
+    assert sized['bclconvert'] == sizing.size_rules(LARGE)['bclconvert']
+    small = sizing.size_rules(SMALL, host_model)
+    assert small['masterjob']['runtime'] == 7200
+    assert sizing.DEFAULT_MODEL == default_model
+
+
+def test_estimate_workload_from_run_info(run_dir):
+    workload = sizing.estimate_workload(run_dir, n_samples=8)
+    assert workload == dict(cycles=318, lanes=1, tiles=28, bcl_gb=pytest.approx(22.26), samples=8, lane_units=0)
+    # missing manifest, estimated from the flowcell layout as well
+    assert sizing.estimate_workload(run_dir, run_dir / 'missing.manifest', n_samples=8) == workload
+    host_model = {"workload": {"bytes_per_tile_cycle": 4e6}}
+    overridden = sizing.estimate_workload(run_dir, n_samples=8, host_model=host_model)
+    assert overridden['bcl_gb'] == pytest.approx(35.616)
+    assert 'workload' not in sizing.size_rules(overridden, host_model)
+
+
+def test_estimate_workload_from_manifest(run_dir):
+    basecalls = run_dir / 'Data' / 'Intensities' / 'BaseCalls'
+    entries = [(basecalls / 'L001' / f'C{cycle}.1' / 's_1_1101.bcl.gz', 1_500_000_000) for cycle in (1, 2)]
+    manifest = run_dir / 'bcl.manifest'
+    write_bcl_manifest(manifest, basecalls, entries)
+    workload = sizing.estimate_workload(run_dir, manifest, n_samples=0, n_lane_units=1)
+    assert workload == dict(cycles=318, lanes=1, tiles=28, bcl_gb=3.0, samples=1, lane_units=1)
+
+
+def test_estimate_workload_without_run_info(tmp_path):
+    assert sizing.estimate_workload(tmp_path) == dict(cycles=0, lanes=1, tiles=0, bcl_gb=0.0, samples=1, lane_units=0)
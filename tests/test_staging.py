@@ -0,0 +1,50 @@
+from collections import namedtuple
+
+import pytest
+
+from scripts import staging
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run_dir = tmp_path / 'run'
+    for rel, size in [('RunInfo.xml', 10), ('Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl', 100),
+                      ('Data/Intensities/BaseCalls/L001/C2.1/L001_1.cbcl', 200), ('Data/Intensities/s.locs', 5)]:
+        path = run_dir / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * size)
+    return run_dir
+
+
+def manifest(run_dir, tmp_path, **sizes):
+    entries = [(str(p.relative_to(run_dir)), p.stat().st_size) for p in sorted(run_dir.rglob('*')) if p.is_file()]
+    path = tmp_path / 'stage_manifest.tsv'
+    staging.write_stage_manifest(path, [(rel, sizes.get(rel, size)) for rel, size in entries])
+    return path
+
+
+def test_stage_in_copies_and_verifies(run_dir, tmp_path):
+    stage_dir = tmp_path / 'scratch' / 'weave_stage_run'
+    assert staging.stage_in(manifest(run_dir, tmp_path), run_dir, stage_dir, need_kb=1, workers=2)
+    assert (stage_dir / staging.STAGE_VERIFIED).exists()
+    assert (stage_dir / 'out').is_dir()
+    staged = sorted(str(p.relative_to(stage_dir / 'run')) for p in (stage_dir / 'run').rglob('*') if p.is_file())
+    assert staged == [rel for rel, _ in staging.read_stage_manifest(tmp_path / 'stage_manifest.tsv')]
+    assert (stage_dir / 'run' / 'Data/Intensities/BaseCalls/L001/C2.1/L001_1.cbcl').stat().st_size == 200
+
+
+def test_stage_in_size_mismatch(run_dir, tmp_path):
+    stage_dir = tmp_path / 'scratch' / 'weave_stage_run'
+    changed = manifest(run_dir, tmp_path, **{'Data/Intensities/s.locs': 6})
+    with pytest.raises(ValueError, match='size verification'):
+        staging.stage_in(changed, run_dir, stage_dir, need_kb=1)
+    assert not stage_dir.exists()
+
+
+def test_stage_in_skipped_without_space(run_dir, tmp_path, monkeypatch, capsys):
+    usage = namedtuple('usage', 'total used free')
+    monkeypatch.setattr(staging.shutil, 'disk_usage', lambda path: usage(2 ** 30, 2 ** 30 - 1024, 1024))
+    stage_dir = tmp_path / 'scratch' / 'weave_stage_run'
+    assert not staging.stage_in(manifest(run_dir, tmp_path), run_dir, stage_dir, need_kb=10)
+    assert not stage_dir.exists()
+    assert 'staging: skipped, 1 KB free' in capsys.readouterr().out
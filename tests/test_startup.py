@@ -0,0 +1,52 @@
+import sys
+import json
+import subprocess
+from conftest import REPO
+
+
+# imports the weave entrypoint as a module with the host lookup, host config and seq dir walkers instrumented
+PROBE = r"""
+import json, socket, pathlib, importlib.machinery, importlib.util
+from time import perf_counter
+calls = dict(gethostname=0, iterdir=0, resource_config=0)
+real_gethostname, real_iterdir = socket.gethostname, pathlib.Path.iterdir
+def gethostname():
+    calls['gethostname'] += 1
+    return real_gethostname()
+def iterdir(self):
+    calls['iterdir'] += 1
+    return real_iterdir(self)
+socket.gethostname, pathlib.Path.iterdir = gethostname, iterdir
+start = perf_counter()
+loader = importlib.machinery.SourceFileLoader('weave_cli', 'weave')
+module = importlib.util.module_from_spec(importlib.util.spec_from_loader('weave_cli', loader))
+loader.exec_module(module)
+from scripts import config
+calls['resource_config'] = config.get_resource_config.cache_info().misses
+calls['server'] = config.get_current_server.cache_info().misses
+calls['seq_dirs'] = config.get_biowulf_seq_dirs.cache_info().misses + config.get_bigsky_seq_dirs.cache_info().misses
+calls['seconds'] = perf_counter() - start
+print(json.dumps(calls))
+"""
+
+
+def test_import_does_not_touch_host_config():
+    probe = subprocess.run([sys.executable, '-c', PROBE], cwd=REPO, capture_output=True, text=True, check=True)
+    calls = json.loads(probe.stdout.strip().splitlines()[-1])
+    assert calls['gethostname'] == 0
+    assert calls['server'] == 0
+    assert calls['resource_config'] == 0
+    assert calls['seq_dirs'] == 0
+    assert calls['iterdir'] == 0
+    # generous bound, a regression that walks sequencing roots or resolves containers takes far longer
+    assert calls['seconds'] < 10
+
+
+def test_directory_configs_resolve_on_access():
+    from scripts import config
+    loaded = []
+    table = config.LazyConfig(dict(eager='value', deferred=config.lazy(lambda: loaded.append(1) or 'loaded')))
+    assert loaded == []
+    assert table['deferred'] == 'loaded'
+    assert table['deferred'] == 'loaded'
+    assert loaded == [1]
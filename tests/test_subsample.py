@@ -0,0 +1,46 @@
+import gzip
+
+import pytest
+
+from scripts import subsample
+
+
+def write_fastq(path, n_reads, mate=1, truncate=0):
+    lines = []
+    for i in range(n_reads):
+        lines += [f"@read{i} {mate}:N:0:1\n", "ACGT\n", "+\n", "IIII\n"]
+    with gzip.open(path, 'wt') as fh:
+        fh.write(''.join(lines[:len(lines) - truncate]))
+    return path
+
+
+def read_names(path):
+    with gzip.open(path, 'rt') as fh:
+        return [line.split()[0] for i, line in enumerate(fh) if i % 4 == 0]
+
+
+@pytest.mark.parametrize('n_reads', [10, 1000])
+def test_pairs_stay_together(tmp_path, n_reads):
+    mates = [write_fastq(tmp_path / f'R{m}.fastq.gz', 100, mate=m) for m in (1, 2)]
+    outs = [tmp_path / 'out' / f'R{m}.fastq.gz' for m in (1, 2)]
+    sampled = subsample.reservoir_sample(mates, outs, n_reads=n_reads, sample_id='s1')
+    assert sampled == dict(sample='s1', reads=100, sampled=min(n_reads, 100), seed=subsample.DEFAULT_SEED)
+    names = read_names(outs[0])
+    assert names == read_names(outs[1])
+    assert names == sorted(names, key=lambda name: int(name[5:]))
+
+
+@pytest.mark.parametrize('n_reads', [10, 1000])
+@pytest.mark.parametrize('extra_mate', [0, 1])
+def test_one_extra_record_in_a_mate(tmp_path, n_reads, extra_mate):
+    mates = [write_fastq(tmp_path / f'R{m}.fastq.gz', 100 + (m - 1 == extra_mate), mate=m) for m in (1, 2)]
+    outs = [tmp_path / f'out_R{m}.fastq.gz' for m in (1, 2)]
+    with pytest.raises(ValueError, match='different numbers of reads'):
+        subsample.reservoir_sample(mates, outs, n_reads=n_reads, sample_id='s1')
+
+
+@pytest.mark.parametrize('truncate', [1, 3])
+def test_truncated_last_record(tmp_path, truncate):
+    fastq = write_fastq(tmp_path / 'R1.fastq.gz', 100, truncate=truncate)
+    with pytest.raises(ValueError, match='Truncated last record'):
+        subsample.reservoir_sample([fastq], [tmp_path / 'out.fastq.gz'], n_reads=10, sample_id='s1')
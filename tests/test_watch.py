@@ -0,0 +1,19 @@
+import os
+
+from scripts import watch
+
+
+def test_newest_mtime_sees_base_call_writes(tmp_path):
+    run_dir = tmp_path / '230101_A01234_0001_AHXXXXXXX'
+    cycle = run_dir / 'Data' / 'Intensities' / 'BaseCalls' / 'L001' / 'C1.1'
+    cycle.mkdir(parents=True)
+    (run_dir / 'InterOp').mkdir()
+    for path in [cycle, *cycle.relative_to(run_dir).parents, 'InterOp']:
+        os.utime(run_dir / path, (1000, 1000))
+    assert watch.newest_mtime(run_dir) == 1000
+
+    # a copy writing base call files leaves the run directory itself untouched
+    (cycle / 'L001_1.cbcl').write_bytes(b'')
+    assert os.stat(run_dir).st_mtime == 1000
+    assert watch.newest_mtime(run_dir) == os.stat(cycle).st_mtime > 1000
+    assert watch.newest_mtime(tmp_path / 'missing') is None
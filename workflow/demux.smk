@@ -1,17 +1,118 @@
+import os
+import re
+import csv
+import json
 import shutil
+from scripts import staging
+from scripts.files import lane_demuxed_fastq, lane_fastq_parts, merge_files
+from scripts.demuxstats import summarize_demux, write_demux_summary, merge_csv_reports, merge_stats_json
 
 
 demux_expand_args = {
-    "project": config["project"],
+    "project": list(config["projects"]),
     "out_to": config["out_to"],
     "rid": config["run_ids"],
     "rnums": config["rnums"],
     "sids": config['sids'],
 }
 demux_noop_args = dict.fromkeys(demux_expand_args.keys(), [])
+analysis_dir = config.get("analysis_dir") or config["demux_input_dir"] + "/Analysis/1"
+# per lane demultiplexing units, empty if the whole flowcell is demultiplexed at once
+lane_units = config.get("demux_lanes") or {}
+single_bcl2fastq = not config['bclconvert'] and not lane_units
+single_bclconvert = bool(config['bclconvert']) and not lane_units
+bcl2fastq_args = demux_expand_args if single_bcl2fastq else demux_noop_args
+bclconvert_args = demux_expand_args if single_bclconvert else demux_noop_args
+lane_dir = config["out_to"] + "/demux/lanes/L{lane}"
+# node-local scratch staging of the base calls per demultiplexing unit ("run" or lane), empty unless requested
+stage_plans = config.get("stage_scratch") or {}
+# staging jobs are grouped with the demultiplexing job of their unit, so both run on the same node
+stage_group = "stage_demux" if stage_plans else None
+STAGE_IN = r"""
+stage_dir="${TMPDIR:-/tmp}/weave_stage_@UNIT@"
+trap 'rm -rf "$stage_dir"' EXIT
+if [ -f "$stage_dir/@VERIFIED@" ]; then
+    shared_out="$demux_out"; run_dir="$stage_dir/run"; demux_out="$stage_dir/out"
+else
+    echo "staging: no verified copy in $stage_dir, reading the run directory in place" >&2
+fi
+"""
+STAGE_OUT = r"""
+if [ -n "${shared_out:-}" ]; then mkdir -p "$shared_out" && cp -r "$demux_out/." "$shared_out/"; fi
+"""
 
 
-localrules: fastq_linker_from_dragen
+def stage_name(unit):
+    return config["run_ids"] + "_" + unit
+
+
+def stage_in(unit):
+    """Shell pointing `$run_dir` and `$demux_out` at the verified scratch copy of a demultiplexing unit's
+    base calls, made by rule `stage_base_calls`. Scratch is removed when the job exits."""
+    if not stage_plans.get(unit):
+        return ""
+    return STAGE_IN.replace("@UNIT@", stage_name(unit)).replace("@VERIFIED@", staging.STAGE_VERIFIED)
+
+
+def stage_out(unit):
+    """Shell copying the demultiplexed outputs of a staged unit back to the output directory, once"""
+    return STAGE_OUT if stage_plans.get(unit) else ""
+
+
+def staged_marker(unit):
+    return [config["out_to"] + f"/.config/.staged_{unit}"] if stage_plans.get(unit) else []
+
+
+def stage_disk_mb(unit):
+    plan = stage_plans.get(unit)
+    return plan["need_kb"] // 1024 + 1 if plan else 0
+
+
+def bcl2fastq_threads(wildcards, threads):
+    """Split the threads of a bcl2fastq job between loading, processing and writing"""
+    io_threads = max(1, min(8, threads // 4))
+    return f"-r {io_threads} -p {max(1, threads - 2 * io_threads)} -w {io_threads}"
+
+
+def bclconvert_threads(wildcards, threads):
+    """Split the threads of a bcl-convert job over parallel tiles"""
+    tiles = max(1, threads // 25)
+    per_tile = max(1, threads // (5 * tiles) * 2)
+    return f"--bcl-num-conversion-threads {per_tile} --bcl-num-compression-threads {per_tile} " + \
+        f"--bcl-num-decompression-threads {max(1, per_tile * 2 // 5)} --bcl-num-parallel-tiles {tiles}"
+
+
+localrules: fastq_linker_from_dragen, merge_lane_reports, demux_summary, lane_fastq_part, lane_undetermined_part
+
+
+wildcard_constraints:
+    lane = r"\d+",
+    unit = r"run|\d+",
+
+
+rule stage_base_calls:
+    """
+        Copy the base calls of a demultiplexing unit ("run" or a lane) to node-local scratch with parallel 
+        copy workers and verify every file's size against the staging manifest
+    """
+    input:
+        manifest               = lambda w: stage_plans[w.unit]["manifest"],
+    output:
+        staged                 = temp(config["out_to"] + "/.config/.staged_{unit}"),
+    params:
+        run_dir                = config['demux_input_dir'],
+        need_kb                = lambda w: stage_plans[w.unit]["need_kb"],
+    group: stage_group
+    benchmark: benchmark_tsv("stage_base_calls", "{unit}")
+    threads: rule_res("stage_base_calls", "threads", 8)
+    resources:
+        mem_mb = rule_res("stage_base_calls", "mem_mb", 4096),
+        runtime = rule_res("stage_base_calls", "runtime", 2*60),
+        disk_mb = lambda w: stage_disk_mb(w.unit),
+    run:
+        staging.stage_in(input.manifest, params.run_dir, staging.scratch_dir(stage_name(wildcards.unit)), params.need_kb, 
+                         workers=threads)
+        Path(output.staged).touch()
 
 
 rule bcl2fastq:
@@ -21,32 +122,43 @@ rule bcl2fastq:
         Copyright (c) 2007-2017 Illumina, Inc.
     """
     input:
-        run_dir                = config['demux_input_dir'] if not config['bclconvert'] else [],
-        binary_base_calls      = expand("{files}", files=config['bcl_files'] if not config['bclconvert'] else demux_noop_args),
-        samplesheet            = config["sample_sheet"] if not config['bclconvert'] else [],
+        run_dir                = config['demux_input_dir'] if single_bcl2fastq else [],
+        bcl_manifest           = config['bcl_manifest'] if single_bcl2fastq else [],
+        samplesheet            = config["sample_sheet"] if single_bcl2fastq else [],
+        staged                 = staged_marker("run") if single_bcl2fastq else [],
     output:
-        seq_data               = expand("{out_to}/demux/{project}/{sids}_R{rnums}_001.fastq.gz", **demux_expand_args if not config['bclconvert'] else demux_noop_args),
-        undetermined           = expand("{out_to}/demux/Undetermined_S0_R{rnums}_001.fastq.gz", **demux_expand_args if not config['bclconvert'] else demux_noop_args),
-        stats                  = expand("{out_to}/demux/Stats/Stats.json", **demux_expand_args if not config['bclconvert'] else demux_noop_args),
-        breadcrumb             = expand("{out_to}/demux/.B2F_DEMUX_COMPLETE", **demux_expand_args if not config['bclconvert'] else demux_noop_args),
+        seq_data               = per_sample("{out_to}/demux/{project}/{sids}_R{rnums}_001.fastq.gz", out_to=config["out_to"], rnums=config["rnums"]) if single_bcl2fastq else [],
+        undetermined           = expand("{out_to}/demux/Undetermined_S0_R{rnums}_001.fastq.gz", **bcl2fastq_args),
+        stats                  = expand("{out_to}/demux/Stats/Stats.json", **bcl2fastq_args),
+        breadcrumb             = expand("{out_to}/demux/.B2F_DEMUX_COMPLETE", **bcl2fastq_args),
     params:
+        stage_in               = stage_in("run"),
+        stage_out              = stage_out("run"),
         out_dir                = config["out_to"] + "/demux",
-    container: config["resources"]["sif"] + "bcl2fastq.sif",
-    log: config["out_to"] + "/logs/bcl2fastq/" + config["run_ids"] + "_" + config["project"] + ".log",
-    threads: 34
+        mismatches             = "--barcode-mismatches " + config["barcode_mismatches"] if config.get("barcode_mismatches") else "",
+        threads                = bcl2fastq_threads,
+    container: config["containers"]["bcl2fastq"],
+    log: config["out_to"] + "/logs/bcl2fastq/" + config["run_ids"] + ".log",
+    group: stage_group
+    benchmark: benchmark_tsv("bcl2fastq", config["run_ids"])
+    threads: rule_res("bcl2fastq", "threads", 34)
     resources: 
-        mem_mb = int(64e3),
-        runtime = 4*60,
+        mem_mb = rule_res("bcl2fastq", "mem_mb", int(64e3)),
+        runtime = rule_res("bcl2fastq", "runtime", 4*60),
+        disk_mb = stage_disk_mb("run"),
     shell: 
         """
+            run_dir={input.run_dir}; demux_out={params.out_dir}
+            {params.stage_in}
             bcl2fastq \
             --sample-sheet {input.samplesheet} \
-            --runfolder-dir {input.run_dir} \
+            --runfolder-dir "$run_dir" \
             --min-log-level=TRACE \
-            -r 8 -p 16 -w 8 \
+            {params.threads} {params.mismatches} \
             --fastq-compression-level 9 \
             --no-lane-splitting \
-            -o {params.out_dir}
+            -o "$demux_out"
+            {params.stage_out}
             touch {output.breadcrumb}
         """
 
@@ -77,68 +189,271 @@ rule bclconvert:
     """
     input:
         run_dir                = config['demux_input_dir'],
-        binary_base_calls      = expand("{files}", files=config['bcl_files'] if config['bclconvert'] else demux_noop_args),
-        samplesheet            = expand("{ss}", ss=config['sample_sheet'] if config['bclconvert'] else demux_noop_args),
-        runinfo                = expand("{run}/RunInfo.xml", run=config['demux_input_dir'] if config['bclconvert'] else demux_noop_args),
+        bcl_manifest           = config['bcl_manifest'] if single_bclconvert else [],
+        samplesheet            = expand("{ss}", ss=config['sample_sheet'] if single_bclconvert else demux_noop_args),
+        runinfo                = expand("{run}/RunInfo.xml", run=config['demux_input_dir'] if single_bclconvert else demux_noop_args),
+        staged                 = staged_marker("run") if single_bclconvert else [],
     params:
+        stage_in               = stage_in("run"),
+        stage_out              = stage_out("run"),
         out_dir                = config["out_to"] + "/demux/",
-        proj_dir               = config["out_to"] + "/demux/" + config["project"],
+        threads                = bclconvert_threads,
     output:
-        seq_data               = expand("{out_to}/demux/{project}/{sids}_R{rnums}_001.fastq.gz", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        undetermined           = expand("{out_to}/demux/Undetermined_S0_R{rnums}_001.fastq.gz", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        stats                  = expand("{out_to}/demux/Reports/Demultiplex_Stats.csv", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        ametrics               = expand("{out_to}/demux/Reports/Quality_Metrics.csv", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        qmetrics               = expand("{out_to}/demux/Reports/Adapter_Metrics.csv", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        top_unknown            = expand("{out_to}/demux/Reports/Top_Unknown_Barcodes.csv", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-        breadcrumb             = expand("{out_to}/demux/.BC_DEMUX_COMPLETE", **demux_expand_args if config['bclconvert'] else demux_noop_args),
-    container: config["resources"]["sif"] + "weave_bclconvert_0.0.3.sif",
-    threads: 50
+        seq_data               = per_sample("{out_to}/demux/{project}/{sids}_R{rnums}_001.fastq.gz", out_to=config["out_to"], rnums=config["rnums"]) if single_bclconvert else [],
+        undetermined           = expand("{out_to}/demux/Undetermined_S0_R{rnums}_001.fastq.gz", **bclconvert_args),
+        stats                  = expand("{out_to}/demux/Reports/Demultiplex_Stats.csv", **bclconvert_args),
+        ametrics               = expand("{out_to}/demux/Reports/Quality_Metrics.csv", **bclconvert_args),
+        qmetrics               = expand("{out_to}/demux/Reports/Adapter_Metrics.csv", **bclconvert_args),
+        top_unknown            = expand("{out_to}/demux/Reports/Top_Unknown_Barcodes.csv", **bclconvert_args),
+        breadcrumb             = expand("{out_to}/demux/.BC_DEMUX_COMPLETE", **bclconvert_args),
+    container: config["containers"]["bclconvert"],
+    group: stage_group
+    benchmark: benchmark_tsv("bclconvert", config["run_ids"])
+    threads: rule_res("bclconvert", "threads", 50)
     resources: 
-        mem_mb = int(64e3),
-        runtime = 4*60,
+        mem_mb = rule_res("bclconvert", "mem_mb", int(64e3)),
+        runtime = rule_res("bclconvert", "runtime", 4*60),
+        disk_mb = stage_disk_mb("run"),
     shell:
         """
+        run_dir={input.run_dir}; demux_out={params.out_dir}
+        {params.stage_in}
         bcl-convert \
-        --bcl-input-directory {input.run_dir} \
+        --bcl-input-directory "$run_dir" \
         --force \
-        --output-directory {params.out_dir} \
+        --output-directory "$demux_out" \
         --sample-sheet {input.samplesheet} \
         --fastq-gzip-compression-level 9 \
         --bcl-sampleproject-subdirectories true \
-        --bcl-num-conversion-threads 10 \
-        --bcl-num-compression-threads 10 \
-        --bcl-num-decompression-threads 4 \
-        --bcl-num-parallel-tiles 2 \
+        {params.threads} \
         --no-lane-splitting true
+        {params.stage_out}
         touch {output.breadcrumb}
         """
 
 
+rule bcl2fastq_lane:
+    """
+        Demultiplex a single lane of the flowcell with bcl2fastq, see rule `bcl2fastq`
+    """
+    input:
+        run_dir                = config['demux_input_dir'],
+        bcl_manifest           = config['bcl_manifest'],
+        samplesheet            = lambda w: lane_units[w.lane]["sample_sheet"],
+        staged                 = lambda w: staged_marker(w.lane),
+    output:
+        stats                  = lane_dir + "/Stats/Stats.json",
+        breadcrumb             = lane_dir + "/.B2F_DEMUX_COMPLETE",
+    params:
+        stage_in               = lambda w: stage_in(w.lane),
+        stage_out              = lambda w: stage_out(w.lane),
+        out_dir                = lane_dir,
+        mismatches             = "--barcode-mismatches " + config["barcode_mismatches"] if config.get("barcode_mismatches") else "",
+        threads                = bcl2fastq_threads,
+    container: config["containers"]["bcl2fastq"],
+    log: config["out_to"] + "/logs/bcl2fastq/" + config["run_ids"] + "_L{lane}.log",
+    group: stage_group
+    benchmark: benchmark_tsv("bcl2fastq_lane", "L{lane}")
+    threads: rule_res("bcl2fastq_lane", "threads", 34)
+    resources: 
+        mem_mb = rule_res("bcl2fastq_lane", "mem_mb", int(64e3)),
+        runtime = rule_res("bcl2fastq_lane", "runtime", 4*60),
+        disk_mb = lambda w: stage_disk_mb(w.lane),
+    shell: 
+        """
+            run_dir={input.run_dir}; demux_out={params.out_dir}
+            {params.stage_in}
+            bcl2fastq \
+            --sample-sheet {input.samplesheet} \
+            --runfolder-dir "$run_dir" \
+            --tiles s_{wildcards.lane} \
+            --min-log-level=TRACE \
+            {params.threads} {params.mismatches} \
+            --fastq-compression-level 9 \
+            --no-lane-splitting \
+            -o "$demux_out"
+            {params.stage_out}
+            touch {output.breadcrumb}
+        """
+
+
+rule bclconvert_lane:
+    """
+        Demultiplex a single lane of the flowcell with bcl-convert, see rule `bclconvert`
+    """
+    input:
+        run_dir                = config['demux_input_dir'],
+        bcl_manifest           = config['bcl_manifest'],
+        samplesheet            = lambda w: lane_units[w.lane]["sample_sheet"],
+        runinfo                = config['demux_input_dir'] + "/RunInfo.xml",
+        staged                 = lambda w: staged_marker(w.lane),
+    output:
+        stats                  = lane_dir + "/Reports/Demultiplex_Stats.csv",
+        breadcrumb             = lane_dir + "/.BC_DEMUX_COMPLETE",
+    params:
+        stage_in               = lambda w: stage_in(w.lane),
+        stage_out              = lambda w: stage_out(w.lane),
+        out_dir                = lane_dir,
+        threads                = bclconvert_threads,
+    container: config["containers"]["bclconvert"],
+    group: stage_group
+    benchmark: benchmark_tsv("bclconvert_lane", "L{lane}")
+    threads: rule_res("bclconvert_lane", "threads", 50)
+    resources: 
+        mem_mb = rule_res("bclconvert_lane", "mem_mb", int(64e3)),
+        runtime = rule_res("bclconvert_lane", "runtime", 4*60),
+        disk_mb = lambda w: stage_disk_mb(w.lane),
+    shell:
+        """
+        run_dir={input.run_dir}; demux_out={params.out_dir}
+        {params.stage_in}
+        bcl-convert \
+        --bcl-input-directory "$run_dir" \
+        --force \
+        --output-directory "$demux_out" \
+        --sample-sheet {input.samplesheet} \
+        --bcl-only-lane {wildcards.lane} \
+        --fastq-gzip-compression-level 9 \
+        --bcl-sampleproject-subdirectories true \
+        {params.threads} \
+        --no-lane-splitting true
+        {params.stage_out}
+        touch {output.breadcrumb}
+        """
+
+
+lane_breadcrumb = lane_dir + ("/.BC_DEMUX_COMPLETE" if config['bclconvert'] else "/.B2F_DEMUX_COMPLETE")
+
+
+rule lane_fastq_part:
+    """
+        Move a fastq file of a lane's demultiplexing output to its run level sample id, as a temporary part 
+        of the run level fastq file
+    """
+    input:
+        breadcrumb             = lane_breadcrumb,
+    output:
+        part                   = temp(lane_dir + "/parts/{project}/{sids}_R{rnums}_001.fastq.gz"),
+    params:
+        demuxed                = lambda w: lane_demuxed_fastq(lane_units, lane_dir, w.lane, w.project, w.sids, w.rnums),
+    benchmark: benchmark_tsv("lane_fastq_part", "L{lane}/{project}/{sids}_R{rnums}")
+    run:
+        os.replace(params.demuxed, output.part)
+
+
+rule lane_undetermined_part:
+    """
+        Move the undetermined reads of a lane's demultiplexing output to a temporary part of the run level file
+    """
+    input:
+        breadcrumb             = lane_breadcrumb,
+    output:
+        part                   = temp(lane_dir + "/parts/Undetermined_S0_R{rnums}_001.fastq.gz"),
+    params:
+        demuxed                = lane_dir + "/Undetermined_S0_R{rnums}_001.fastq.gz",
+    benchmark: benchmark_tsv("lane_undetermined_part", "L{lane}/Undetermined_R{rnums}")
+    run:
+        os.replace(params.demuxed, output.part)
+
+
+rule merge_lane_fastq:
+    """
+        Concatenate the per lane fastq files of a sample into the run level fastq file
+    """
+    input:
+        lambda w: lane_fastq_parts(lane_units, lane_dir, w.project, w.sids, w.rnums),
+    output:
+        config["out_to"] + "/demux/{project}/{sids}_R{rnums}_001.fastq.gz" if lane_units else [],
+    benchmark: benchmark_tsv("merge_lane_fastq", "{project}/{sids}_R{rnums}")
+    resources:
+        mem_mb = rule_res("merge_lane_fastq", "mem_mb", 2048),
+        runtime = rule_res("merge_lane_fastq", "runtime", 2*60),
+    run:
+        merge_files(input, output[0])
+
+
+rule merge_lane_undetermined:
+    """
+        Concatenate the per lane undetermined reads
+    """
+    input:
+        lambda w: expand(lane_dir + "/parts/Undetermined_S0_R{rnums}_001.fastq.gz", lane=sorted(lane_units, key=int), rnums=w.rnums),
+    output:
+        config["out_to"] + "/demux/Undetermined_S0_R{rnums}_001.fastq.gz" if lane_units else [],
+    benchmark: benchmark_tsv("merge_lane_undetermined", "Undetermined_R{rnums}")
+    resources:
+        mem_mb = rule_res("merge_lane_undetermined", "mem_mb", 2048),
+        runtime = rule_res("merge_lane_undetermined", "runtime", 2*60),
+    run:
+        merge_files(input, output[0])
+
+
+rule merge_lane_reports:
+    """
+        Merge per lane demultiplexing statistics into run level statistics
+    """
+    input:
+        stats                  = expand(lane_dir + ("/Reports/Demultiplex_Stats.csv" if config['bclconvert'] else "/Stats/Stats.json"), lane=sorted(lane_units, key=int)),
+        breadcrumbs            = expand(lane_breadcrumb, lane=sorted(lane_units, key=int)),
+    output:
+        stats                  = (config["out_to"] + ("/demux/Reports/Demultiplex_Stats.csv" if config['bclconvert'] else "/demux/Stats/Stats.json")) if lane_units else [],
+        reports                = expand(config["out_to"] + "/demux/Reports/{name}.csv", name=["Quality_Metrics", "Adapter_Metrics", "Top_Unknown_Barcodes"]) if lane_units and config['bclconvert'] else [],
+        breadcrumb             = (config["out_to"] + ("/demux/.BC_DEMUX_COMPLETE" if config['bclconvert'] else "/demux/.B2F_DEMUX_COMPLETE")) if lane_units else [],
+    benchmark: benchmark_tsv("merge_lane_reports", config["run_ids"])
+    run:
+        if config['bclconvert']:
+            merge_csv_reports(input.stats, output.stats)
+            for run_report in output.reports:
+                merge_csv_reports([re.sub(r"/Demultiplex_Stats.csv$", "/" + os.path.basename(run_report), part) for part in input.stats], run_report)
+        else:
+            merge_stats_json(input.stats, output.stats)
+        shell("touch {output.breadcrumb}")
+
+
 rule fastq_linker_from_dragen:
     input:
-        read1                  = expand(config["demux_input_dir"] + "/Analysis/1/Data/fastq/{full_sid}_R1_001.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
-        read2                  = expand(config["demux_input_dir"] + "/Analysis/1/Data/fastq/{full_sid}_R2_001.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
-        adapter_metrics        = config["demux_input_dir"] + "/Analysis/1/Data/Reports/Adapter_Metrics.csv" if not config['demux_data'] else [],
-        qual_metrics           = config["demux_input_dir"] + "/Analysis/1/Data/Reports/Quality_Metrics.csv" if not config['demux_data'] else [],
-        demux_stats            = config["demux_input_dir"] + "/Analysis/1/Data/Reports/Demultiplex_Stats.csv" if not config['demux_data'] else [],
+        read1                  = expand(analysis_dir + "/Data/fastq/{full_sid}_R1_001.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
+        read2                  = expand(analysis_dir + "/Data/fastq/{full_sid}_R2_001.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
+        adapter_metrics        = analysis_dir + "/Data/Reports/Adapter_Metrics.csv" if not config['demux_data'] else [],
+        qual_metrics           = analysis_dir + "/Data/Reports/Quality_Metrics.csv" if not config['demux_data'] else [],
+        demux_stats            = analysis_dir + "/Data/Reports/Demultiplex_Stats.csv" if not config['demux_data'] else [],
     output:
-        out_read1              = expand(config["out_to"] + "/demux/" + config["project"] + "/{full_sid}_R1_dragen.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
-        out_read2              = expand(config["out_to"] + "/demux/" + config["project"] + "/{full_sid}_R2_dragen.fastq.gz", full_sid=config["sids"]) if not config['demux_data'] else [],
+        out_read1              = [config["out_to"] + f"/demux/{sid_projects[sid]}/{sid}_R1_dragen.fastq.gz" for sid in config["sids"]] if not config['demux_data'] else [],
+        out_read2              = [config["out_to"] + f"/demux/{sid_projects[sid]}/{sid}_R2_dragen.fastq.gz" for sid in config["sids"]] if not config['demux_data'] else [],
         breadcrumb             = expand(config["out_to"] + "/demux/.breadcrumb/{full_sid}", full_sid=config["sids"]) if not config['demux_data'] else [],
         adapter_metrics_out    = config["out_to"] + "/demux/dragen_reports/Adapter_Metrics.csv" if not config['demux_data'] else [],
         qual_metrics_out       = config["out_to"] + "/demux/dragen_reports/Quality_Metrics.csv" if not config['demux_data'] else [],
         demux_stats_out        = config["out_to"] + "/demux/dragen_reports/Demultiplex_Stats.csv" if not config['demux_data'] else [],
+    benchmark: benchmark_tsv("fastq_linker_from_dragen", config["run_ids"])
     run:
         demux_dir = Path(config["out_to"], 'demux').resolve()
         bc_dir = Path(demux_dir, '.breadcrumb').resolve()
         if not bc_dir.exists():
             bc_dir.mkdir(mode=0o755)
         for r1, r2, sid in zip(input.read1, input.read2, config["sids"]):
-            Path(demux_dir, config["project"], f"{sid}_R1_dragen.fastq.gz").absolute().symlink_to(Path(r1))
-            Path(demux_dir, config["project"], f"{sid}_R2_dragen.fastq.gz").absolute().symlink_to(Path(r2))
+            Path(demux_dir, sid_projects[sid], f"{sid}_R1_dragen.fastq.gz").absolute().symlink_to(Path(r1))
+            Path(demux_dir, sid_projects[sid], f"{sid}_R2_dragen.fastq.gz").absolute().symlink_to(Path(r2))
             Path(bc_dir, sid).touch(mode=0o755)
         shutil.copyfile(input.adapter_metrics, output.adapter_metrics_out)
         shutil.copyfile(input.qual_metrics, output.qual_metrics_out)
         shutil.copyfile(input.demux_stats, output.demux_stats_out)
 
-    
\ No newline at end of file
+    
+
+
+rule demux_summary:
+    """
+        Per lane and per sample yield, perfect index and undetermined fractions of the run, summarized 
+        from the demultiplexing statistics as soon as demultiplexing finishes
+    """
+    input:
+        stats                  = demux_stats,
+    output:
+        summary                = config["out_to"] + "/demux/demux_summary.tsv",
+    params:
+        demux_dir              = config["out_to"] + "/demux",
+        # bcl2fastq statistics do not record the project of a sample
+        projects               = {re.sub(r"_S[0-9]+$", "", sid): project for sid, project in sid_projects.items()},
+    benchmark: benchmark_tsv("demux_summary", config["run_ids"])
+    run:
+        write_demux_summary(output.summary, summarize_demux(params.demux_dir, projects=params.projects))
@@ -1,24 +1,56 @@
+from scripts.subsample import reservoir_sample
+
+
 if not config['demux_data']:
     trim_input_affix = 'dragen'
 else:
     trim_input_affix = '001'
+# fast QC/QA (--qc-mode fast) runs the QC tools on a seeded sample of the reads of every sample
+qc_sampling = config.get("qc_sampling") or {}
+qc_reads_dir = config["out_to"] + ("/{project}/{sids}/sampled/" if qc_sampling else "/demux/{project}/")
+
+
+rule subsample_reads:
+    """
+        Seeded uniform sample of the reads of a sample for fast QC/QA, a single streaming pass 
+        over the demultiplexed reads with mates sampled in lockstep
+    """
+    input:
+        reads           = expand(config["out_to"] + "/demux/{{project}}/{{sids}}_R{rnum}_" + trim_input_affix + ".fastq.gz", rnum=config["rnums"]),
+    output:
+        reads           = expand(config["out_to"] + "/{{project}}/{{sids}}/sampled/{{sids}}_R{rnum}_" + trim_input_affix + ".fastq.gz", rnum=config["rnums"]),
+        report          = config["out_to"] + "/{project}/{sids}/sampled/{sids}_sampling_mqc.tsv",
+    params:
+        n_reads         = qc_sampling.get("reads"),
+        seed            = qc_sampling.get("seed"),
+    threads: rule_res("subsample_reads", "threads", 1)
+    resources:
+        mem_mb = rule_res("subsample_reads", "mem_mb", 4096),
+        runtime = rule_res("subsample_reads", "runtime", 4*60),
+    benchmark: benchmark_tsv("subsample_reads", "{project}/{sids}")
+    run:
+        reservoir_sample(input.reads, output.reads, n_reads=params.n_reads, seed=params.seed, sample_id=wildcards.sids, 
+                         report=output.report)
 
 
 rule trim_w_fastp:
     input:
-        in_read1        = config["out_to"] + "/demux/" + config["project"] + "/{sids}_R1_" + trim_input_affix + ".fastq.gz",
-        in_read2        = config["out_to"] + "/demux/" + config["project"] + "/{sids}_R2_" + trim_input_affix + ".fastq.gz" if len(config['rnums']) == 2 else [],
+        in_read1        = qc_reads_dir + "{sids}_R1_" + trim_input_affix + ".fastq.gz",
+        in_read2        = qc_reads_dir + "{sids}_R2_" + trim_input_affix + ".fastq.gz" if len(config['rnums']) == 2 else [],
     output:
-        html            = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}.html",
-        json            = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_fastp.json",
-        out_read1       = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R1.fastq.gz",
-        out_read2       = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.1.sif"
-    threads: 4,
+        html            = config["out_to"] + "/{project}/{sids}/fastp/{sids}.html",
+        json            = config["out_to"] + "/{project}/{sids}/fastp/{sids}_fastp.json",
+        out_read1       = config["out_to"] + "/{project}/{sids}/fastp/{sids}_trimmed_R1.fastq.gz",
+        out_read2       = config["out_to"] + "/{project}/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
+    containerized: config["containers"]["ngsqc_0.0.1"]
+    threads: rule_res("trim_w_fastp", "threads", 4),
     params:
         read_args = lambda _, output, input: f"--in2 {input.in_read2} --out2 {output.out_read2} --detect_adapter_for_pe""" if len(config['rnums']) == 2 else ""
-    resources: mem_mb = 8192,
-    log: config["out_to"] + "/logs/" + config["project"] + "/fastp/{sids}.log",
+    resources:
+        mem_mb = rule_res("trim_w_fastp", "mem_mb", 8192),
+        runtime = rule_res("trim_w_fastp", "runtime", 24*60),
+    log: config["out_to"] + "/logs/{project}/fastp/{sids}.log",
+    benchmark: benchmark_tsv("trim_w_fastp", "{project}/{sids}")
     shell:
         """
         fastp \
@@ -30,20 +62,23 @@ rule trim_w_fastp:
 
 rule fastq_screen:
     input:
-        read                = config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R{rnum}.fastq.gz",
+        read                = config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R{rnum}.fastq.gz",
     output:
-        txt                 = config['out_to'] + "/" + config["project"] + "/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.txt",
-        png                 = config['out_to'] + "/" + config["project"] + "/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.png",
-        html                = config['out_to'] + "/" + config["project"] + "/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.html",
+        txt                 = config['out_to'] + "/{project}/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.txt",
+        png                 = config['out_to'] + "/{project}/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.png",
+        html                = config['out_to'] + "/{project}/{sids}/fastq_screen/{sids}_trimmed_R{rnum}_screen.html",
     params:
         config_file         = "/etc/fastq_screen.conf",
         subset              = 1000000,
         aligner             = "bowtie2",
-        output_dir          = lambda w: config['out_to'] + "/" + config["project"] + "/" + w.sids + "/fastq_screen/",
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.1.sif"
-    threads: 4,
-    resources: mem_mb = 8192,
-    log: config['out_to'] + "/logs/" + config["project"] + "/fastq_screen/{sids}_R{rnum}.log",
+        output_dir          = lambda w: config['out_to'] + "/" + w.project + "/" + w.sids + "/fastq_screen/",
+    containerized: config["containers"]["ngsqc_0.0.1"]
+    threads: rule_res("fastq_screen", "threads", 4),
+    resources:
+        mem_mb = rule_res("fastq_screen", "mem_mb", 8192),
+        runtime = rule_res("fastq_screen", "runtime", 24*60),
+    log: config['out_to'] + "/logs/{project}/fastq_screen/{sids}_R{rnum}.log",
+    benchmark: benchmark_tsv("fastq_screen", "{project}/{sids}_R{rnum}")
     shell:
         """
             fastq_screen --outdir {params.output_dir} \
@@ -58,26 +93,27 @@ rule fastq_screen:
 
 rule kaiju_annotation:
     input:
-        read1               = config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R1.fastq.gz", 
-        read2               = config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
+        read1               = config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R1.fastq.gz", 
+        read2               = config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
     output:
-        kaiju_report        = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}.tsv",
-        kaiju_order         = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}_order.tsv",
-        kaiju_family        = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}_family.tsv",
-        kaiju_species       = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}_species.tsv",
-        kaiju_phylum        = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}_phylum.tsv",
-        kaiju_genus         = config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}_genus.tsv",
+        kaiju_report        = config['out_to'] + "/{project}/{sids}/kaiju/{sids}.tsv",
+        kaiju_order         = config['out_to'] + "/{project}/{sids}/kaiju/{sids}_order.tsv",
+        kaiju_family        = config['out_to'] + "/{project}/{sids}/kaiju/{sids}_family.tsv",
+        kaiju_species       = config['out_to'] + "/{project}/{sids}/kaiju/{sids}_species.tsv",
+        kaiju_phylum        = config['out_to'] + "/{project}/{sids}/kaiju/{sids}_phylum.tsv",
+        kaiju_genus         = config['out_to'] + "/{project}/{sids}/kaiju/{sids}_genus.tsv",
     params:
         nodes               = config["resources"]["mounts"]["kaiju"]["to"] + "/nodes.dmp",
         names               = config["resources"]["mounts"]["kaiju"]["to"] + "/names.dmp",
         database            = config["resources"]["mounts"]["kaiju"]["to"] + "/kaiju_db_nr_euk.fmi",
         reads_in_arg        = lambda wc, input, output: f"-j {input.read1} -i {input.read2}" if input.read2 else f"-i {input.read1}",
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.1.sif"
-    log: config['out_to'] + "/logs/" + config["project"] + "/kaiju/{sids}.log",
-    threads: 24
+    containerized: config["containers"]["ngsqc_0.0.1"]
+    log: config['out_to'] + "/logs/{project}/kaiju/{sids}.log",
+    benchmark: benchmark_tsv("kaiju_annotation", "{project}/{sids}")
+    threads: rule_res("kaiju_annotation", "threads", 24)
     resources: 
-        mem_mb = 220000, 
-        runtime = 60*24*2
+        mem_mb = rule_res("kaiju_annotation", "mem_mb", 220000), 
+        runtime = rule_res("kaiju_annotation", "runtime", 60*24*2)
     shell:
         """
         kaiju \
@@ -96,21 +132,22 @@ rule kaiju_annotation:
 
 rule kraken_annotation:
     input:
-        read1               = config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R1.fastq.gz", 
-        read2               = config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
+        read1               = config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R1.fastq.gz", 
+        read2               = config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if len(config['rnums']) == 2 else [],
     output:
-        kraken_report       = config['out_to'] + "/" + config["project"] + "/{sids}/kraken/{sids}.tsv",
-        kraken_log          = config['out_to'] + "/" + config["project"] + "/{sids}/kraken/{sids}.log",
+        kraken_report       = config['out_to'] + "/{project}/{sids}/kraken/{sids}.tsv",
+        kraken_log          = config['out_to'] + "/{project}/{sids}/kraken/{sids}.log",
     params:
         kraken_db           = config["resources"]["mounts"]["kraken2"]["to"],
         reads_in_arg        = lambda wc, input, output: f"{input.read1} {input.read2}" if input.read2 else f"{input.read1}",
         ended_arg           = lambda wc, input, output: "--paired " if input.read2 else "",
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.1.sif",
-    log: config['out_to'] + "/logs/" + config["project"] + "/kraken/{sids}.log",
-    threads: 24
+    containerized: config["containers"]["ngsqc_0.0.1"],
+    log: config['out_to'] + "/logs/{project}/kraken/{sids}.log",
+    benchmark: benchmark_tsv("kraken_annotation", "{project}/{sids}")
+    threads: rule_res("kraken_annotation", "threads", 24)
     resources: 
-        mem_mb = 220000,
-        runtime = 60*24*2
+        mem_mb = rule_res("kraken_annotation", "mem_mb", 220000),
+        runtime = rule_res("kraken_annotation", "runtime", 60*24*2)
     shell:
         """
         kraken2 \
@@ -1,7 +1,4 @@
-qc_expand_args = {
-    "rnums": config["rnums"],
-    "sids": config['sids'],
-}
+from scripts.fastqstats import MQC_SECTIONS
 
 
 if not config['demux_data']:
@@ -13,21 +10,36 @@ else:
         demux_stats = config['out_to'] + "/demux/Reports/Demultiplex_Stats.csv"
     else:
         demux_stats = config['out_to'] + "/demux/Stats/Stats.json"
-    
+# aligner indexes of the disambiguate genomes from the shared reference registry
+reference_indexes = {"host": config.get("host_index") or {}, "pathogen": config.get("pathogen_index") or {}}
+
+
+def reference_index(genome):
+    """Index marker of a disambiguate genome, empty when its index was already built at launch"""
+    if not reference_indexes[genome] or reference_indexes[genome].get("ready"):
+        return []
+    return config["out_to"] + "/.config/references/" + genome + ".bwa_index"
+
+
+wildcard_constraints:
+    genome = "host|pathogen",
+
 
 rule fastqc_untrimmed:
     input:
-        samples       = config['out_to'] + "/demux/" + config["project"] + "/{sids}_R{rnums}_" + trim_input_suffix + ".fastq.gz",
+        samples       = qc_reads_dir + "{sids}_R{rnums}_" + trim_input_suffix + ".fastq.gz",
     output:   
-        html          = config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.html",
-        fqreport      = config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.zip",
+        html          = config['out_to'] + "/{project}/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.html",
+        fqreport      = config['out_to'] + "/{project}/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.zip",
     params:
-        output_dir    = lambda w: config['out_to'] + "/" + config["project"] + "/" + w.sids + "/fastqc_untrimmed/"
-    log: config['out_to'] + "/logs/" + config["project"] + "/fastqc_untrimmed/{sids}_R{rnums}.log"
-    threads: 4
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.2.sif"
+        output_dir    = lambda w: config['out_to'] + "/" + w.project + "/" + w.sids + "/fastqc_untrimmed/"
+    log: config['out_to'] + "/logs/{project}/fastqc_untrimmed/{sids}_R{rnums}.log"
+    benchmark: benchmark_tsv("fastqc_untrimmed", "{project}/{sids}_R{rnums}")
+    threads: rule_res("fastqc_untrimmed", "threads", 4)
+    containerized: config["containers"]["ngsqc"]
     resources: 
-        mem_mb = 8096
+        mem_mb = rule_res("fastqc_untrimmed", "mem_mb", 8096),
+        runtime = rule_res("fastqc_untrimmed", "runtime", 24*60),
     shell:
         """
         mkdir -p {params.output_dir}
@@ -35,21 +47,51 @@ rule fastqc_untrimmed:
         """
    
 
+rule fastq_stats:
+    """
+        Native read statistics of the untrimmed and trimmed reads of a sample (--qc-stats native), read count, 
+        length distribution, per cycle mean quality and base content, GC and N rate as MultiQC custom content,
+        an alternative to fastqc_untrimmed and fastqc_trimmed. Fastqs are read concurrently, one process each.
+    """
+    input:
+        untrimmed     = [qc_reads_dir + "{sids}_R" + rnum + "_" + trim_input_suffix + ".fastq.gz" for rnum in config["rnums"]],
+        trimmed       = expand(config["out_to"] + "/{{project}}/{{sids}}/fastp/{{sids}}_trimmed_R{rnum}.fastq.gz", rnum=config["rnums"]),
+    output:
+        stats         = config['out_to'] + "/{project}/{sids}/fastq_stats/{sids}_fastq_stats.json",
+        mqc           = expand(config['out_to'] + "/{{project}}/{{sids}}/fastq_stats/{{sids}}_{section}_mqc.json", section=MQC_SECTIONS),
+    params:
+        python        = sys.executable,
+        output_dir    = lambda w: config['out_to'] + "/" + w.project + "/" + w.sids + "/fastq_stats/",
+    log: config['out_to'] + "/logs/{project}/fastq_stats/{sids}.log"
+    benchmark: benchmark_tsv("fastq_stats", "{project}/{sids}")
+    threads: rule_res("fastq_stats", "threads", 4)
+    resources: 
+        mem_mb = rule_res("fastq_stats", "mem_mb", 4096),
+        runtime = rule_res("fastq_stats", "runtime", 12*60),
+    shell:
+        """
+        {params.python} {workflow.basedir}/scripts/fastqstats.py -t {threads} -o {params.output_dir} --prefix {wildcards.sids} \
+            {input.untrimmed} {input.trimmed} > {log} 2>&1
+        """
+
+
 rule fastqc_trimmed:
     input:
-        in_read       = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R{rnums}.fastq.gz",
+        in_read       = config["out_to"] + "/{project}/{sids}/fastp/{sids}_trimmed_R{rnums}.fastq.gz",
     output:
-        html          = config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.html",
-        fqreport      = config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.zip",
+        html          = config['out_to'] + "/{project}/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.html",
+        fqreport      = config['out_to'] + "/{project}/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.zip",
     params:
-        output_dir    = lambda w: config['out_to'] + "/" + config["project"] + "/" + w.sids + "/fastqc_trimmed/",
+        output_dir    = lambda w: config['out_to'] + "/" + w.project + "/" + w.sids + "/fastqc_trimmed/",
         tmpdir        = lambda wc: '/tmp/' + wc.sids,
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.2.sif"
-    threads: 4
+    containerized: config["containers"]["ngsqc"]
+    threads: rule_res("fastqc_trimmed", "threads", 4)
     resources: 
-        mem_mb        = 8096,
+        mem_mb        = rule_res("fastqc_trimmed", "mem_mb", 8096),
+        runtime       = rule_res("fastqc_trimmed", "runtime", 24*60),
         disk_mb       = int(500e3) if config.get('use_scratch', True) else 0,
-    log: config['out_to'] + "/logs/" + config["project"] + "/fastqc_trimmed/{sids}_R{rnums}.log"
+    log: config['out_to'] + "/logs/{project}/fastqc_trimmed/{sids}_R{rnums}.log"
+    benchmark: benchmark_tsv("fastqc_trimmed", "{project}/{sids}_R{rnums}")
     shell:
         """
         # Setups temporary directory for
@@ -78,90 +120,177 @@ rule fastqc_trimmed:
         """
 
 
-rule bwa:
+rule bwa_index:
+    """
+        Build the bwa index of a disambiguate genome in the shared reference registry, keyed by the genome's content. 
+        Concurrent runs of the same genome wait on the genome's build lock and reuse the index it produced.
+    """
     input:
-        in_read1       = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R1.fastq.gz" if config.get('disambiguate', False) else [],
-        in_read2       = config["out_to"] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if config.get('disambiguate', False) and len(config['rnums']) == 2 else [],
+        fasta          = lambda w: reference_indexes[w.genome]["fasta"],
     output:
-        aligntoA       = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.AligntoGenomeA.bam",
-        aligntoB       = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.AligntoGenomeB.bam",
+        marker         = config["out_to"] + "/.config/references/{genome}.bwa_index",
     params:
-        host_genome    = config.get('host_genome', ''),
-        path_genome    = config.get('pathogen_genome', ''),
-    threads: 32
-    resources: mem_mb = 64768
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.2.sif"
-    log: config['out_to'] + "/logs/" + config["project"] + "/bwa_mem/{sids}.log"
+        index_dir      = lambda w: reference_indexes[w.genome]["dir"],
+        prefix         = lambda w: reference_indexes[w.genome]["prefix"],
+    threads: rule_res("bwa_index", "threads", 1)
+    resources:
+        mem_mb = rule_res("bwa_index", "mem_mb", 16384),
+        runtime = rule_res("bwa_index", "runtime", 8*60),
+    containerized: config["containers"]["ngsqc"]
+    log: config['out_to'] + "/logs/bwa_index/{genome}.log"
+    benchmark: benchmark_tsv("bwa_index", "{genome}")
     shell:
         """
-        bwa mem -t {threads} {params.host_genome} {input.in_read1} {input.in_read2} | samtools sort -@ {threads} -n -o {output.aligntoA} -
-        bwa mem -t {threads} {params.path_genome} {input.in_read1} {input.in_read2} | samtools sort -@ {threads} -n -o {output.aligntoB} -
+        index_dir={params.index_dir}
+        mkdir -p "$(dirname "$index_dir")"
+        (
+            flock 9
+            if [ ! -e "$index_dir/.ready" ]; then
+                build_dir="$index_dir.build.$$"
+                rm -rf "$build_dir" && mkdir -p "$build_dir"
+                bwa index -p "$build_dir/genome" {input.fasta}
+                rm -rf "$index_dir" && mv "$build_dir" "$index_dir"
+                touch "$index_dir/.ready"
+            fi
+        ) 9> "$(dirname "$index_dir")/.build.lock"
+        echo {params.prefix} > {output.marker}
         """
 
 
-rule disambiguate:
+rule bwa:
     input:
-        aligntoA       = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.AligntoGenomeA.bam",
-        aligntoB       = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.AligntoGenomeB.bam",
+        in_read1       = config["out_to"] + "/{project}/{sids}/fastp/{sids}_trimmed_R1.fastq.gz" if config.get('disambiguate', False) else [],
+        in_read2       = config["out_to"] + "/{project}/{sids}/fastp/{sids}_trimmed_R2.fastq.gz" if config.get('disambiguate', False) and len(config['rnums']) == 2 else [],
+        host_index     = reference_index("host"),
+        pathogen_index = reference_index("pathogen"),
     output:
-        ambiguousA     = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.ambiguousSpeciesA.bam",
-        ambiguousB     = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.ambiguousSpeciesB.bam",
-        disambiguousA  = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.disambiguatedSpeciesA.bam",
-        disambiguousB  = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}.disambiguatedSpeciesB.bam",
-        dis_summary    = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/{sids}_summary.txt",
+        aligntoA       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeA.bam",
+        aligntoB       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeB.bam",
     params:
-        host_genome    = config.get('host_genome', ''),
-        path_genome    = config.get('pathogen_genome', ''),
-        this_sid       = lambda wc: wc.sids,
-        out_dir        = config["out_to"] + "/" + config["project"] + "/{sids}/disambiguate/",
-    containerized: config["resources"]["sif"] + "ngs_disambiguate_2018.05.03.sif"
-    log: config['out_to'] + "/logs/" + config["project"] + "/disambiguate/{sids}.log"
-    threads: 32
-    resources: mem_mb = 64768
+        host_genome    = reference_indexes["host"].get("prefix", config.get('host_genome', '')),
+        path_genome    = reference_indexes["pathogen"].get("prefix", config.get('pathogen_genome', '')),
+    threads: rule_res("bwa", "threads", 32)
+    resources:
+        mem_mb = rule_res("bwa", "mem_mb", 64768),
+        runtime = rule_res("bwa", "runtime", 24*60),
+    containerized: config["containers"]["ngsqc"]
+    log: config['out_to'] + "/logs/{project}/bwa_mem/{sids}.log"
+    benchmark: benchmark_tsv("bwa", "{project}/{sids}")
     shell:
         """
-        ngs_disambiguate -s {params.this_sid} -o {params.out_dir} -a bwa {input.aligntoA} {input.aligntoB}
+        bwa mem -t {threads} {params.host_genome} {input.in_read1} {input.in_read2} | samtools sort -@ {threads} -n -o {output.aligntoA} -
+        bwa mem -t {threads} {params.path_genome} {input.in_read1} {input.in_read2} | samtools sort -@ {threads} -n -o {output.aligntoB} -
         """
 
 
+if config.get("disambiguate_engine", "ngs_disambiguate") == "weave":
+    rule disambiguate:
+        """
+            Disambiguate the host and pathogen alignments of a sample with weave's engine, the AstraZeneca 
+            bwa algorithm and outputs, with read names sharded across worker processes in one streaming pass
+        """
+        input:
+            aligntoA       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeA.bam",
+            aligntoB       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeB.bam",
+        output:
+            ambiguousA     = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.ambiguousSpeciesA.bam",
+            ambiguousB     = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.ambiguousSpeciesB.bam",
+            disambiguousA  = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.disambiguatedSpeciesA.bam",
+            disambiguousB  = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.disambiguatedSpeciesB.bam",
+            dis_summary    = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}_summary.txt",
+        params:
+            script         = os.path.realpath(os.path.join(workflow.basedir, "scripts", "disambiguate.py")),
+            this_sid       = lambda wc: wc.sids,
+            out_dir        = config["out_to"] + "/{project}/{sids}/disambiguate/",
+        containerized: config["containers"]["ngsqc"]
+        log: config['out_to'] + "/logs/{project}/disambiguate/{sids}.log"
+        benchmark: benchmark_tsv("disambiguate", "{project}/{sids}")
+        threads: rule_res("disambiguate", "threads", 32)
+        resources:
+            mem_mb = rule_res("disambiguate", "mem_mb", 64768),
+            runtime = rule_res("disambiguate", "runtime", 24*60),
+        shell:
+            """
+            python3 {params.script} -t {threads} -s {params.this_sid} -o {params.out_dir} \\
+                {input.aligntoA} {input.aligntoB} > {log} 2>&1
+            """
+else:
+    rule disambiguate:
+        input:
+            aligntoA       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeA.bam",
+            aligntoB       = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.AligntoGenomeB.bam",
+        output:
+            ambiguousA     = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.ambiguousSpeciesA.bam",
+            ambiguousB     = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.ambiguousSpeciesB.bam",
+            disambiguousA  = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.disambiguatedSpeciesA.bam",
+            disambiguousB  = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}.disambiguatedSpeciesB.bam",
+            dis_summary    = config["out_to"] + "/{project}/{sids}/disambiguate/{sids}_summary.txt",
+        params:
+            host_genome    = config.get('host_genome', ''),
+            path_genome    = config.get('pathogen_genome', ''),
+            this_sid       = lambda wc: wc.sids,
+            out_dir        = config["out_to"] + "/{project}/{sids}/disambiguate/",
+        containerized: config["containers"]["disambiguate"]
+        log: config['out_to'] + "/logs/{project}/disambiguate/{sids}.log"
+        benchmark: benchmark_tsv("disambiguate", "{project}/{sids}")
+        threads: rule_res("disambiguate", "threads", 32)
+        resources:
+            mem_mb = rule_res("disambiguate", "mem_mb", 64768),
+            runtime = rule_res("disambiguate", "runtime", 24*60),
+        shell:
+            """
+            ngs_disambiguate -s {params.this_sid} -o {params.out_dir} -a bwa {input.aligntoA} {input.aligntoB}
+            """
 
-rule multiqc_report:
-    input:
-        # demux status
-        demux_stats,
+
+def project_qc_reports(wildcards):
+    """QC/QA reports of the samples of a single project"""
+    this_project = {"project": wildcards.project, "sids": projects[wildcards.project], "rnums": config["rnums"]}
+    return flatten([
         # fastqc on untrimmed reads
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.zip", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/fastqc_untrimmed/{sids}_R{rnums}_" + trim_input_suffix + "_fastqc.zip", **this_project) if not native_stats else [],
         # fastqc on trimmed reads
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.zip", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/fastqc_trimmed/{sids}_trimmed_R{rnums}_fastqc.zip", **this_project) if not native_stats else [],
+        # native read statistics of untrimmed and trimmed reads
+        expand(config['out_to'] + "/{project}/{sids}/fastq_stats/{sids}_fastq_stats.json", **this_project) if native_stats else [],
         # fastp trimming metrics
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/fastp/{sids}_trimmed_R{rnums}.fastq.gz", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/fastp/{sids}_trimmed_R{rnums}.fastq.gz", **this_project),
         # fastq screen
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/fastq_screen/{sids}_trimmed_R{rnums}_screen.html", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/fastq_screen/{sids}_trimmed_R{rnums}_screen.html", **this_project),
         # kraken2
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/kraken/{sids}.tsv", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/kraken/{sids}.tsv", **this_project),
         # kaiju
-        expand(config['out_to'] + "/" + config["project"] + "/{sids}/kaiju/{sids}.tsv", **qc_expand_args),
+        expand(config['out_to'] + "/{project}/{sids}/kaiju/{sids}.tsv", **this_project),
+        # read sampling of fast QC/QA
+        expand(config['out_to'] + "/{project}/{sids}/sampled/{sids}_sampling_mqc.tsv", **this_project) if qc_sampling else [],
+    ])
+
+
+rule multiqc_report:
+    input:
+        # demux status
+        demux_stats,
+        project_qc_reports,
     output:
-        mqc_report      = expand(config['out_to'] + "/{project}" + \
-                           "/multiqc/Run-{rid}-Project-{project}_multiqc_report.html",
-                           project=config['project'], rid=config['run_ids']),
+        mqc_report      = config['out_to'] + "/{project}/multiqc/Run-" + config['run_ids'] + "-Project-{project}_multiqc_report.html",
     params:
-        input_dir       = config['out_to'],
-        output_dir      = config['out_to'] + "/" + config["project"] + "/multiqc/",
-        report_title    = "Run: " + config["run_ids"] + ", Project: " + config["project"],
-    containerized: config["resources"]["sif"] + "weave_ngsqc_0.0.2.sif"
-    threads: 4
-    resources: mem_mb = 8096
-    log: 
-        expand(
-            config['out_to'] + "/logs/multiqc/multiqc_{rid}_{project}.log", 
-            project=config['project'], rid=config['run_ids']
-        )
+        input_dirs      = lambda w: config['out_to'] + "/" + w.project + " " + os.path.dirname(demux_stats),
+        output_dir      = config['out_to'] + "/{project}/multiqc/",
+        report_title    = lambda w: "Run: " + config["run_ids"] + ", Project: " + w.project + (" (sampled QC)" if qc_sampling else ""),
+        comment         = f"--comment 'QC/QA ran on a seeded sample of {qc_sampling.get('reads')} reads per sample (seed {qc_sampling.get('seed')}), " + \
+                          "not on every read.'" if qc_sampling else "",
+    containerized: config["containers"]["ngsqc"]
+    threads: rule_res("multiqc_report", "threads", 4)
+    resources:
+        mem_mb = rule_res("multiqc_report", "mem_mb", 8096),
+        runtime = rule_res("multiqc_report", "runtime", 24*60),
+    log: config['out_to'] + "/logs/multiqc/multiqc_" + config['run_ids'] + "_{project}.log"
+    benchmark: benchmark_tsv("multiqc_report", "{project}")
     shell:
         """
         multiqc -q -ip \
-        --title \"{params.report_title}\" \
+        --title \"{params.report_title}\" {params.comment} \
         -o {params.output_dir} \
-        {params.input_dir} \
-        --ignore ".cache" --ignore ".config" --ignore ".snakemake" --ignore ".slurm" --ignore ".singularity" --ignore ".logs"
+        {params.input_dirs} \
+        --ignore ".cache" --ignore ".config" --ignore ".snakemake" --ignore ".slurm" --ignore ".singularity" --ignore ".logs" --ignore "lanes"
         """